@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+'''
+Benchmark the accelerator share allocation strategies.
+
+It registers a fake accelerator plugin with the given number of devices per
+NUMA node, and runs the same random sequence of kernel allocations and
+releases against each strategy.  It reports the time per allocation and
+release, the ratio of the failed allocations, the average number of devices
+per kernel, and the average ratio of the idle devices.
+
+usage: scripts/bench-accel-alloc.py [--nodes 2] [--devices-per-node 4] ...
+'''
+
+import argparse
+from decimal import Decimal
+import random
+import time
+
+import attr
+
+from ai.backend.agent.accelalloc import AcceleratorAllocMap, alloc_strategies
+from ai.backend.agent.accelerator import (
+    AbstractAccelerator, AbstractAcceleratorInfo, accelerator_types,
+)
+
+
+@attr.s(auto_attribs=True)
+class FakeAcceleratorInfo(AbstractAcceleratorInfo):
+
+    def is_fractional(self):
+        return True
+
+    def max_share(self):
+        return Decimal(self.processing_units)
+
+    def share_to_spec(self, share):
+        return (int(self.memory_size * share / self.max_share()),
+                int(self.processing_units * share / self.max_share()))
+
+    def spec_to_share(self, requested_memory, requested_proc_units):
+        return max(Decimal(requested_memory) / self.memory_size,
+                   Decimal(requested_proc_units) / self.processing_units)
+
+
+class FakeAccelerator(AbstractAccelerator):
+
+    slot_key = 'fake'
+    devices = []
+
+    @classmethod
+    def list_devices(cls):
+        return cls.devices
+
+    @classmethod
+    def get_hooks(cls, distro, arch):
+        return []
+
+    @classmethod
+    async def generate_docker_args(cls, docker, limit_gpus=None):
+        return {}
+
+
+def generate_ops(total_share, num_ops, load, seed):
+    '''
+    Generate a random sequence of allocations and releases which keeps the
+    allocated shares around the given ratio of all shares.
+    '''
+    rng = random.Random(seed)
+    shares = [Decimal(s) for s in ('0.1', '0.25', '0.5', '1', '1.5', '2')]
+    capacity = total_share * Decimal(load)
+    ops = []
+    live = []
+    while len(ops) < num_ops:
+        share = rng.choice(shares)
+        while live and sum(live) + share > capacity:
+            idx = rng.randrange(len(live))
+            ops.append(('free', idx))
+            live.pop(idx)
+        ops.append(('alloc', share))
+        live.append(share)
+    return ops
+
+
+def run(alloc_map, ops):
+    live = []
+    num_failed = 0
+    num_devices = 0
+    idle_ratio = 0.0
+    alloc_time = 0.0
+    free_time = 0.0
+    for op, arg in ops:
+        if op == 'alloc':
+            begin = time.perf_counter()
+            try:
+                _, shares = alloc_map.alloc(arg, cpu_nodes=(0,))
+            except RuntimeError:
+                shares = {}
+                num_failed += 1
+            alloc_time += time.perf_counter() - begin
+            live.append(shares)
+            num_devices += len(shares)
+            idle_ratio += (sum(1 for q in alloc_map.used.values() if q == 0) /
+                           len(alloc_map.used))
+        else:
+            shares = live.pop(arg)
+            begin = time.perf_counter()
+            alloc_map.free(shares)
+            free_time += time.perf_counter() - begin
+    num_allocs = sum(1 for op, _ in ops if op == 'alloc')
+    num_frees = len(ops) - num_allocs
+    return {
+        'alloc_usec': alloc_time / num_allocs * 1e6,
+        'free_usec': free_time / max(num_frees, 1) * 1e6,
+        'failed': num_failed / num_allocs,
+        'devices_per_kernel': num_devices / max(num_allocs - num_failed, 1),
+        'idle_devices': idle_ratio / num_allocs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=2)
+    parser.add_argument('--devices-per-node', type=int, default=4)
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--load', type=float, default=0.8,
+                        help='The target ratio of the allocated shares.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    FakeAccelerator.devices = [
+        FakeAcceleratorInfo(f'fake{n}-{i}', f'{n:02x}:{i:02x}', n, 2 ** 30, 1)
+        for n in range(args.nodes)
+        for i in range(args.devices_per_node)
+    ]
+    accelerator_types['fake'] = FakeAccelerator
+    devices = accelerator_types['fake'].list_devices()
+    total_share = sum(dev.max_share() for dev in devices)
+    ops = generate_ops(total_share, args.ops, args.load, args.seed)
+    print(f'{len(devices)} devices, {args.nodes} nodes, '
+          f'{args.ops} operations')
+    print(f'{"strategy":<19} {"alloc-usec":>10} {"free-usec":>10} '
+          f'{"failed":>7} {"dev/kernel":>10} {"idle-dev":>9}')
+    for strategy in alloc_strategies:
+        alloc_map = AcceleratorAllocMap(devices, strategy=strategy)
+        r = run(alloc_map, ops)
+        print(f'{strategy:<19} {r["alloc_usec"]:>10.1f} {r["free_usec"]:>10.1f} '
+              f'{r["failed"]:>7.1%} {r["devices_per_kernel"]:>10.2f} '
+              f'{r["idle_devices"]:>9.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+'''
+Benchmark the CPU core allocators on synthetic topologies.
+
+It runs the same random sequence of kernel allocations and releases against
+the legacy allocator and the topology-aware allocator with each policy.  It
+reports the time per allocation and release, the ratio of the allocated
+cores whose SMT siblings are used by other kernels, and the average number
+of L3 domains per kernel.
+
+usage: scripts/bench-cpu-alloc.py [--nodes 2] [--l3-per-node 8] ...
+'''
+
+import argparse
+import random
+import time
+from unittest import mock
+
+from ai.backend.agent.cpualloc import (
+    CPUTopology, TopologyAwareCPUAllocMap, alloc_policies,
+)
+from ai.backend.agent.resources import CPUAllocMap
+from ai.backend.agent.vendor.linux import libnuma
+
+
+def create_legacy_map(topo):
+    core_topo = tuple(topo.nodes[n] for n in sorted(topo.nodes))
+    node_of_cpu = {c: info.node for c, info in topo.cores.items()}
+    patches = [
+        mock.patch.object(libnuma, 'get_core_topology', return_value=core_topo),
+        mock.patch.object(libnuma, 'get_available_cores',
+                          return_value=set(topo.cores)),
+        mock.patch.object(libnuma, 'num_nodes', return_value=len(core_topo)),
+        mock.patch.object(libnuma, 'node_of_cpu', side_effect=node_of_cpu.get),
+    ]
+    for p in patches:
+        p.start()
+    return CPUAllocMap(), patches
+
+
+def generate_ops(topo, num_ops, load, seed):
+    '''
+    Generate a random sequence of allocations and releases which keeps the
+    number of allocated cores around the given ratio of all cores.
+    '''
+    rng = random.Random(seed)
+    max_cores = max(len(cores) for cores in topo.nodes.values())
+    capacity = len(topo.cores) * load
+    ops = []
+    live = []
+    while len(ops) < num_ops:
+        num_cores = rng.choice([1, 2, 4, 8, 16, max_cores // 4])
+        while live and sum(live) + num_cores > capacity:
+            idx = rng.randrange(len(live))
+            ops.append(('free', idx))
+            live.pop(idx)
+        ops.append(('alloc', num_cores))
+        live.append(num_cores)
+    return ops
+
+
+def run(alloc_map, topo, ops):
+    live = []
+    siblings_shared = 0
+    num_allocated = 0
+    num_domains = 0
+    alloc_time = 0.0
+    free_time = 0.0
+    for op, arg in ops:
+        if op == 'alloc':
+            begin = time.perf_counter()
+            _, cores = alloc_map.alloc(arg)
+            alloc_time += time.perf_counter() - begin
+            live.append(cores)
+            num_allocated += len(cores)
+            num_domains += len({topo.cores[c].l3 for c in cores})
+            for c in cores:
+                if any(alloc_map.core_shares_of(s) > 0
+                       for s in topo.cores[c].siblings if s not in cores):
+                    siblings_shared += 1
+        else:
+            cores = live.pop(arg)
+            begin = time.perf_counter()
+            alloc_map.free(cores)
+            free_time += time.perf_counter() - begin
+    num_allocs = sum(1 for op, _ in ops if op == 'alloc')
+    num_frees = len(ops) - num_allocs
+    return {
+        'alloc_usec': alloc_time / num_allocs * 1e6,
+        'free_usec': free_time / max(num_frees, 1) * 1e6,
+        'shared_siblings': siblings_shared / max(num_allocated, 1),
+        'l3_per_kernel': num_domains / max(num_allocs, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=2)
+    parser.add_argument('--l3-per-node', type=int, default=8)
+    parser.add_argument('--cores-per-l3', type=int, default=8)
+    parser.add_argument('--threads-per-core', type=int, default=2)
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--load', type=float, default=0.8,
+                        help='The target ratio of the allocated cores.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    topo = CPUTopology.synthetic(num_nodes=args.nodes,
+                                 l3_per_node=args.l3_per_node,
+                                 cores_per_l3=args.cores_per_l3,
+                                 threads_per_core=args.threads_per_core)
+    ops = generate_ops(topo, args.ops, args.load, args.seed)
+    print(f'{len(topo.cores)} cores, {args.nodes} nodes, '
+          f'{len(topo.l3_domains)} L3 domains, {args.ops} operations')
+    print(f'{"allocator":<10} {"alloc-usec":>10} {"free-usec":>10} '
+          f'{"shared-smt":>11} {"L3/kernel":>10}')
+
+    legacy_map, patches = create_legacy_map(topo)
+    try:
+        node_of = {c: info.node for c, info in topo.cores.items()}
+        legacy_map.core_shares_of = \
+            lambda c: legacy_map.core_shares[node_of[c]][c]
+        results = {'legacy': run(legacy_map, topo, ops)}
+    finally:
+        for p in patches:
+            p.stop()
+    for policy in alloc_policies:
+        alloc_map = TopologyAwareCPUAllocMap(topo, policy=policy)
+        alloc_map.core_shares_of = alloc_map.core_shares.__getitem__
+        results[policy] = run(alloc_map, topo, ops)
+    for name, r in results.items():
+        print(f'{name:<10} {r["alloc_usec"]:>10.1f} {r["free_usec"]:>10.1f} '
+              f'{r["shared_siblings"]:>11.1%} {r["l3_per_kernel"]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
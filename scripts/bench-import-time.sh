@@ -0,0 +1,33 @@
+#! /bin/bash
+# Measure the import time of the agent server module to catch startup
+# regressions.
+#
+# usage: scripts/bench-import-time.sh [num-runs] [max-msec]
+# It exits with 1 if the median import time exceeds max-msec.
+
+PYTHON=${PYTHON:-python}
+runs=${1:-5}
+max_msec=${2:-0}
+
+samples=()
+for i in $(seq "$runs"); do
+    usec=$($PYTHON -X importtime -c 'import ai.backend.agent.server' 2>&1 \
+           | awk -F'|' '$3 ~ /^ ai\.backend\.agent\.server$/ { gsub(/ /, "", $2); print $2 }')
+    if [ -z "$usec" ]; then
+        echo "Failed to import ai.backend.agent.server."
+        exit 1
+    fi
+    samples+=("$usec")
+done
+median=$(printf '%s\n' "${samples[@]}" | sort -n | awk '{ a[NR] = $1 } END { print a[int((NR + 1) / 2)] }')
+median_msec=$((median / 1000))
+echo "ai.backend.agent.server import time: ${median_msec} msec (median of ${runs} runs)"
+
+echo "Slowest top-level imports of the last run:"
+$PYTHON -X importtime -c 'import ai.backend.agent.server' 2>&1 \
+    | awk -F'|' '$3 ~ /^   [^ ]/ { print }' | sort -t'|' -k2 -n -r | head -n 10
+
+if [ "$max_msec" -gt 0 ] && [ "$median_msec" -gt "$max_msec" ]; then
+    echo "The import time exceeds ${max_msec} msec."
+    exit 1
+fi
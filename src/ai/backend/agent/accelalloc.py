@@ -0,0 +1,262 @@
+'''
+Allocation of accelerator device shares.
+
+The shares of the accelerator devices are given as decimals, but
+:class:`AcceleratorAllocMap` counts them in integer quanta of 0.01 share, so
+an allocation does no decimal arithmetic.  It also keeps the sums of the
+used and free quanta per NUMA node up to date, so choosing a node does not
+scan all devices.
+
+The placement strategies are:
+
+``worst-fit``
+    Choose the least loaded node and fill the devices with the most free
+    shares first, spreading the load across the devices.  This is the
+    behavior of the previous versions.
+
+``best-fit``
+    Choose the node and the device with the least free shares that still
+    fit the request, packing the fractional allocations into the devices
+    already in use.
+
+``numa-affine``
+    Like ``worst-fit``, but prefer the NUMA nodes of the CPU cores allocated
+    to the kernel, falling back to the other nodes.
+
+``whole-device-first``
+    Allocate the whole part of the request from the idle devices, and the
+    remainder best-fit into the devices already in use.
+
+A new strategy is added by subclassing :class:`AllocStrategy` and
+registering it in :data:`alloc_strategies`.
+'''
+
+from abc import ABCMeta, abstractmethod
+from collections import defaultdict
+from decimal import Decimal
+from typing import (
+    Collection, Container, Dict, Iterable, List, Mapping, Optional, Sequence,
+    Tuple,
+)
+
+from .accelerator import AbstractAcceleratorInfo, ProcessorIdType
+
+# The numbers of quanta allocated from each device.
+AllocPlan = Dict[ProcessorIdType, int]
+
+
+def to_quanta(share: Decimal) -> int:
+    # int() truncates the fraction of the non-negative shares.
+    return int(Decimal(share).scaleb(2))
+
+
+def from_quanta(quanta: int) -> Decimal:
+    return Decimal(quanta).scaleb(-2)
+
+
+class AllocStrategy(metaclass=ABCMeta):
+
+    def select_nodes(self, alloc_map: 'AcceleratorAllocMap', quanta: int,
+                     cpu_nodes: Container[int]) -> List[Optional[int]]:
+        '''
+        Return the NUMA nodes which have enough free quanta in total, in the
+        order to try.  The default is the least loaded node first.
+        '''
+        nodes = [n for n, free in alloc_map.node_free.items() if free >= quanta]
+        return sorted(nodes, key=alloc_map.node_used.__getitem__)
+
+    @abstractmethod
+    def order_devices(self, alloc_map: 'AcceleratorAllocMap',
+                      dev_ids: Sequence[ProcessorIdType],
+                      quanta: int) -> List[ProcessorIdType]:
+        '''
+        Return the given devices in the order to fill.
+        '''
+        return []
+
+    def plan(self, alloc_map: 'AcceleratorAllocMap', node: Optional[int],
+             quanta: int) -> Optional[AllocPlan]:
+        '''
+        Decide the quanta to allocate from the devices in the given node, or
+        return None if they cannot hold the request.
+        '''
+        dev_ids = alloc_map.devices_per_node[node]
+        return alloc_map.fill(self.order_devices(alloc_map, dev_ids, quanta),
+                              quanta)
+
+
+class WorstFitStrategy(AllocStrategy):
+
+    def order_devices(self, alloc_map, dev_ids, quanta):
+        return sorted(dev_ids, key=lambda p: -alloc_map.free_quanta(p))
+
+
+class BestFitStrategy(AllocStrategy):
+
+    def select_nodes(self, alloc_map, quanta, cpu_nodes):
+        # The node of the tightest device which holds the whole request
+        # comes first, and then the tightest node.
+        def key(n):
+            fits = [free for free in map(alloc_map.free_quanta,
+                                         alloc_map.devices_per_node[n])
+                    if free >= quanta]
+            if fits:
+                return (0, min(fits), alloc_map.node_free[n])
+            return (1, alloc_map.node_free[n], 0)
+        nodes = [n for n, free in alloc_map.node_free.items() if free >= quanta]
+        return sorted(nodes, key=key)
+
+    def order_devices(self, alloc_map, dev_ids, quanta):
+        # The tightest device which holds the whole request comes first.
+        # If there is none, the request is split across the least number of
+        # devices.
+        def key(p):
+            free = alloc_map.free_quanta(p)
+            return (0, free) if free >= quanta else (1, -free)
+        return sorted(dev_ids, key=key)
+
+
+class NumaAffineStrategy(WorstFitStrategy):
+
+    def select_nodes(self, alloc_map, quanta, cpu_nodes):
+        nodes = super().select_nodes(alloc_map, quanta, cpu_nodes)
+        return sorted(nodes, key=lambda n: n not in cpu_nodes)
+
+
+class WholeDeviceFirstStrategy(BestFitStrategy):
+
+    def plan(self, alloc_map, node, quanta):
+        dev_ids = alloc_map.devices_per_node[node]
+        plan = {}
+        remaining = quanta
+        idle_devices = sorted(
+            (p for p in dev_ids if alloc_map.used[p] == 0),
+            key=lambda p: -alloc_map.capacity[p])
+        for p in idle_devices:
+            if alloc_map.capacity[p] <= remaining:
+                plan[p] = alloc_map.capacity[p]
+                remaining -= plan[p]
+        if remaining == 0:
+            return plan
+        rest = [p for p in dev_ids if p not in plan]
+        rest_plan = alloc_map.fill(
+            self.order_devices(alloc_map, rest, remaining), remaining)
+        if rest_plan is None:
+            return None
+        plan.update(rest_plan)
+        return plan
+
+
+alloc_strategies: Dict[str, AllocStrategy] = {
+    'worst-fit': WorstFitStrategy(),
+    'best-fit': BestFitStrategy(),
+    'numa-affine': NumaAffineStrategy(),
+    'whole-device-first': WholeDeviceFirstStrategy(),
+}
+default_alloc_strategy = 'worst-fit'
+
+
+class AcceleratorAllocMap:
+    '''
+    The allocated shares of the accelerator devices of a type.
+
+    The devices which are not fractional are allocated only as a whole.
+    '''
+
+    def __init__(self,
+                 devices: Collection[AbstractAcceleratorInfo],
+                 limit_mask: Container[ProcessorIdType] = None, *,
+                 strategy: str = default_alloc_strategy):
+        if strategy not in alloc_strategies:
+            raise ValueError(f'unknown accelerator allocation strategy: '
+                             f'{strategy}')
+        self.limit_mask = limit_mask
+        self.strategy = alloc_strategies[strategy]
+        self.devices = {dev.device_id: dev for dev in devices}
+        self.capacity: Dict[ProcessorIdType, int] = {}
+        self.used: Dict[ProcessorIdType, int] = {}
+        self.devices_per_node: Dict[Optional[int], List[ProcessorIdType]] = \
+            defaultdict(list)
+        self.node_used: Dict[Optional[int], int] = {}
+        self.node_free: Dict[Optional[int], int] = {}
+        self._fractional: Dict[ProcessorIdType, bool] = {}
+        for dev in devices:
+            if limit_mask is not None and dev.device_id not in limit_mask:
+                continue
+            p = dev.device_id
+            self.capacity[p] = to_quanta(dev.max_share())
+            self.used[p] = 0
+            self._fractional[p] = dev.is_fractional()
+            self.devices_per_node[dev.numa_node].append(p)
+            self.node_used.setdefault(dev.numa_node, 0)
+            self.node_free[dev.numa_node] = \
+                self.node_free.get(dev.numa_node, 0) + self.capacity[p]
+
+    @property
+    def device_shares(self) -> Dict[ProcessorIdType, Decimal]:
+        return {p: from_quanta(q) for p, q in self.used.items()}
+
+    def free_quanta(self, dev_id: ProcessorIdType) -> int:
+        return self.capacity[dev_id] - self.used[dev_id]
+
+    def fill(self, dev_ids: Iterable[ProcessorIdType],
+             quanta: int) -> Optional[AllocPlan]:
+        '''
+        Take the given quanta from the devices in the given order, or return
+        None if they cannot hold the request.
+        '''
+        plan = {}
+        remaining = quanta
+        for p in dev_ids:
+            free = self.capacity[p] - self.used[p]
+            if free <= 0:
+                continue
+            if not self._fractional[p] and \
+                    (free < self.capacity[p] or remaining < free):
+                continue
+            plan[p] = min(free, remaining)
+            remaining -= plan[p]
+            if remaining == 0:
+                return plan
+        return None
+
+    def alloc(self, requested_share: Decimal, node: int = None, *,
+              cpu_nodes: Container[int] = ()) \
+            -> Tuple[Optional[int], Dict[ProcessorIdType, Decimal]]:
+        '''
+        Allocate the requested shares from the devices in a NUMA node, or
+        the given node, and return a tuple of the node and the allocated
+        shares per device.  The NUMA nodes of the kernel's CPU cores may be
+        given as a hint for the strategy.
+        '''
+        quanta = to_quanta(requested_share)
+        assert quanta > 0, 'You cannot allocate zero share of devices.'
+        if node is None:
+            nodes = self.strategy.select_nodes(self, quanta, cpu_nodes)
+        else:
+            nodes = [node] if self.node_free.get(node, 0) >= quanta else []
+        for n in nodes:
+            plan = self.strategy.plan(self, n, quanta)
+            if plan is not None:
+                break
+        else:
+            raise RuntimeError('Cannot allocate requested shares '
+                               f'in NUMA node {node}')
+        self._apply(plan, 1)
+        return n, {p: from_quanta(q) for p, q in plan.items()}
+
+    def _apply(self, plan: AllocPlan, sign: int):
+        for p, q in plan.items():
+            node = self.devices[p].numa_node
+            self.used[p] += sign * q
+            self.node_used[node] += sign * q
+            self.node_free[node] -= sign * q
+
+    def update(self, allocated_shares: Mapping[ProcessorIdType, Decimal]):
+        '''
+        Manually add the given shares as if they are allocated by us.
+        '''
+        self._apply({p: to_quanta(s) for p, s in allocated_shares.items()}, 1)
+
+    def free(self, allocated_shares: Mapping[ProcessorIdType, Decimal]):
+        self._apply({p: to_quanta(s) for p, s in allocated_shares.items()}, -1)
@@ -0,0 +1,144 @@
+'''
+Bounded cleanup of terminated kernels.
+
+After a node-wide OOM or an agent reset, hundreds of kernel containers may
+die at once.  Instead of spawning a cleanup task per container death,
+:class:`KernelCleanupQueue` runs the cleanups with a fixed number of workers.
+Submitting a kernel waits while the queue is full, which slows down the
+consumer of the container death events.
+
+:class:`ContainerDeleter` deletes the requested containers concurrently
+through the delete lane of the Docker governor.  It never prunes by label,
+as a prune also removes the stopped containers of the kernels being
+restarted, of the other agents sharing the Docker daemon, and the ones
+created but not started yet.
+'''
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Sequence
+
+import aiodocker
+from aiodocker.exceptions import DockerError
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .governor import DockerGovernor
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.cleanup'))
+
+default_num_workers = 8
+default_max_pending = 256
+
+
+class ContainerDeleter:
+    '''
+    Deletes the given containers concurrently, ignoring the missing ones.
+    '''
+
+    def __init__(self, docker: aiodocker.Docker, *,
+                 governor: DockerGovernor):
+        self.docker = docker
+        self.governor = governor
+
+    async def delete(self, container_ids: Sequence[str]):
+        '''
+        Delete the given containers, ignoring the missing ones.
+        '''
+        await asyncio.gather(*[
+            self._delete_one(cid) for cid in container_ids if cid
+        ])
+
+    async def _delete_one(self, container_id: str):
+        container = self.docker.containers.container(container_id)
+        try:
+            async with self.governor.lane('delete'):
+                await container.delete()
+        except DockerError as e:
+            if e.status == 409 and 'already in progress' in e.message:
+                pass
+            elif e.status == 404:
+                pass
+            else:
+                log.warning('container deletion: {0!r}', e)
+
+
+class KernelCleanupQueue:
+    '''
+    Runs the cleanups of terminated kernels with a fixed number of workers.
+
+    The queue depth and the time from submission to the completion of each
+    cleanup are reported as the ``ai.backend.agent.cleanup.queue_depth``
+    gauge and the ``ai.backend.agent.cleanup.latency`` timing metrics.
+    '''
+
+    def __init__(self, clean_func: Callable[[str], Awaitable[Any]], *,
+                 num_workers: int = default_num_workers,
+                 max_pending: int = default_max_pending,
+                 stats_monitor=None,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.clean_func = clean_func
+        self.num_workers = num_workers
+        self.stats_monitor = stats_monitor
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._submitted: Dict[str, float] = {}
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return len(self._submitted)
+
+    def _report_depth(self):
+        if self.stats_monitor is not None:
+            self.stats_monitor.report_stats(
+                'gauge', 'ai.backend.agent.cleanup.queue_depth', self.depth)
+
+    def start(self):
+        for _ in range(self.num_workers):
+            self._workers.append(self.loop.create_task(self._work()))
+
+    async def stop(self):
+        '''
+        Stop the workers.  The kernels not cleaned up yet are dropped.
+        '''
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def submit(self, kernel_id: str):
+        '''
+        Schedule the cleanup of the given kernel, waiting while the queue is
+        full.  It is no-op if the kernel is already in the queue.
+        '''
+        if kernel_id in self._submitted:
+            return
+        self._submitted[kernel_id] = time.monotonic()
+        self._report_depth()
+        try:
+            await self._queue.put(kernel_id)
+        except asyncio.CancelledError:
+            del self._submitted[kernel_id]
+            raise
+
+    async def join(self):
+        await self._queue.join()
+
+    async def _work(self):
+        while True:
+            kernel_id = await self._queue.get()
+            try:
+                await self.clean_func(kernel_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('failed to clean up the kernel {0}', kernel_id)
+            finally:
+                submitted_at = self._submitted.pop(kernel_id)
+                self._queue.task_done()
+                self._report_depth()
+                if self.stats_monitor is not None:
+                    self.stats_monitor.report_stats(
+                        'timing', 'ai.backend.agent.cleanup.latency',
+                        (time.monotonic() - submitted_at) * 1000)
@@ -0,0 +1,342 @@
+'''
+Topology-aware allocation of CPU cores.
+
+:class:`TopologyAwareCPUAllocMap` is a drop-in replacement of
+:class:`~ai.backend.agent.resources.CPUAllocMap` which takes the SMT siblings
+and the L3 cache domains of the cores into account.  It keeps a priority
+queue of the cores per NUMA node, so an allocation of ``k`` cores takes
+``O(k log n)`` time instead of scanning all cores for each allocated core.
+
+The placement policies are:
+
+``pack``
+    Place the cores of a kernel in the least loaded L3 domain as much as
+    possible, preferring the SMT siblings of the busy cores to leave the
+    other physical cores free.
+
+``spread``
+    Prefer the least loaded L3 domains and the cores whose siblings are
+    idle, maximizing the cache and memory bandwidth of each kernel.
+
+``isolate``
+    Avoid the siblings of busy cores as much as possible, even if it means
+    sharing a core with another kernel later, to minimize the interference
+    between kernels.
+
+Each NUMA node has a priority queue of its L3 domains, and each L3 domain
+has a priority queue of its cores.  When the share of a core changes, new
+entries are pushed for the core, its siblings and their L3 domains, and the
+outdated entries are discarded when they reach the top.
+'''
+
+import heapq
+import logging
+from pathlib import Path
+from typing import Collection, Dict, FrozenSet, List, Optional, Set, Tuple
+
+import attr
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .resources import plan_multi_node
+from .vendor.linux import libnuma
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.cpualloc'))
+
+sysfs_cpu_path = Path('/sys/devices/system/cpu')
+alloc_policies = ('pack', 'spread', 'isolate')
+
+# (priority key, core or L3 domain ID, version)
+HeapEntry = Tuple[tuple, int, int]
+
+
+def parse_cpu_list(s: str) -> Set[int]:
+    '''
+    Parse the CPU list format of sysfs such as "0-3,8,10-11".
+    '''
+    cores = set()
+    for item in s.strip().split(','):
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        cores.update(range(int(first), int(last or first) + 1))
+    return cores
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class CoreInfo:
+    core: int
+    node: int
+    l3: int                    # the ID of the L3 cache domain
+    siblings: FrozenSet[int]   # the other hardware threads of the same core
+
+
+class CPUTopology:
+    '''
+    The NUMA nodes, L3 cache domains and SMT siblings of the CPU cores.
+    '''
+
+    def __init__(self, cores: Collection[CoreInfo]):
+        self.cores: Dict[int, CoreInfo] = {info.core: info for info in cores}
+        self.nodes: Dict[int, List[int]] = {}
+        self.l3_domains: Dict[int, List[int]] = {}
+        for core, info in sorted(self.cores.items()):
+            self.nodes.setdefault(info.node, []).append(core)
+            self.l3_domains.setdefault(info.l3, []).append(core)
+
+    @classmethod
+    def read(cls, limit_cpus: Collection[int] = None, *,
+             sysfs_path: Path = sysfs_cpu_path) -> 'CPUTopology':
+        '''
+        Read the topology of the available cores from sysfs.  The unknown
+        parts fall back to libnuma, one L3 domain per node and no siblings.
+        '''
+        available = set(libnuma.get_available_cores())
+        if limit_cpus is not None:
+            available &= set(limit_cpus)
+        cores = []
+        for core in sorted(available):
+            cpu_path = sysfs_path / f'cpu{core}'
+            node_paths = sorted(cpu_path.glob('node[0-9]*'))
+            if node_paths:
+                node = int(node_paths[0].name[4:])
+            else:
+                node = libnuma.node_of_cpu(core)
+            try:
+                siblings = parse_cpu_list(
+                    (cpu_path / 'topology' / 'thread_siblings_list').read_text())
+            except (OSError, ValueError):
+                siblings = set()
+            l3 = -1 - node
+            for index_path in sorted(cpu_path.glob('cache/index[0-9]*')):
+                try:
+                    if (index_path / 'level').read_text().strip() != '3':
+                        continue
+                    l3 = min(parse_cpu_list(
+                        (index_path / 'shared_cpu_list').read_text()))
+                except (OSError, ValueError):
+                    pass
+                break
+            cores.append(CoreInfo(core, node, l3,
+                                  frozenset((siblings & available) - {core})))
+        return cls(cores)
+
+    @classmethod
+    def synthetic(cls, *, num_nodes: int, l3_per_node: int,
+                  cores_per_l3: int, threads_per_core: int = 2) -> 'CPUTopology':
+        '''
+        Create a topology numbered in the same way as Linux on x86 servers,
+        where the first hardware threads of all physical cores come first.
+        '''
+        num_physical = num_nodes * l3_per_node * cores_per_l3
+        cores = []
+        for physical in range(num_physical):
+            domain = physical // cores_per_l3
+            threads = {physical + t * num_physical
+                       for t in range(threads_per_core)}
+            for core in threads:
+                cores.append(CoreInfo(
+                    core,
+                    domain // l3_per_node,
+                    domain * cores_per_l3,
+                    frozenset(threads - {core})))
+        return cls(cores)
+
+
+class TopologyAwareCPUAllocMap:
+    '''
+    Allocates the CPU cores within a NUMA node following the given placement
+    policy.
+    '''
+
+    def __init__(self, topology: CPUTopology, *, policy: str = 'pack'):
+        if policy not in alloc_policies:
+            raise ValueError(f'unknown CPU allocation policy: {policy}')
+        self.topology = topology
+        self.policy = policy
+        self.num_cores = len(topology.cores)
+        self.num_nodes = len(topology.nodes)
+        self.core_shares: Dict[int, int] = {c: 0 for c in topology.cores}
+        self.alloc_per_node: Dict[int, int] = {n: 0 for n in topology.nodes}
+        self._l3_loads: Dict[int, int] = {d: 0 for d in topology.l3_domains}
+        self._l3_nodes: Dict[int, int] = {
+            d: topology.cores[cores[0]].node
+            for d, cores in topology.l3_domains.items()
+        }
+        # flattened for the hot paths
+        self._l3_of = {c: info.l3 for c, info in topology.cores.items()}
+        self._siblings = {c: tuple(sorted(info.siblings))
+                          for c, info in topology.cores.items()}
+        self._core_vers: Dict[int, int] = {c: 0 for c in topology.cores}
+        self._l3_vers: Dict[int, int] = {d: 0 for d in topology.l3_domains}
+        self._core_heaps: Dict[int, List[HeapEntry]] = {}
+        self._l3_heaps: Dict[int, List[HeapEntry]] = {}
+        for node in topology.nodes:
+            self._rebuild(node)
+
+    def _core_key(self, core: int) -> tuple:
+        shares = self.core_shares
+        share = shares[core]
+        if self.policy == 'pack':
+            busy_siblings = 0
+            for s in self._siblings[core]:
+                if shares[s] > 0:
+                    busy_siblings += 1
+            return (share, -busy_siblings, core)
+        sibling_load = 0
+        for s in self._siblings[core]:
+            sibling_load += shares[s]
+        if self.policy == 'spread':
+            return (share, sibling_load, core)
+        else:  # isolate
+            return (share + sibling_load, share, core)
+
+    def _l3_key(self, domain: int, best_core_key: tuple) -> tuple:
+        load = self._l3_loads[domain]
+        if self.policy == 'pack':
+            return (best_core_key[0], load, domain)
+        elif self.policy == 'spread':
+            return (best_core_key[0], load, best_core_key[1], domain)
+        else:  # isolate
+            return (best_core_key[0], best_core_key[1], load, domain)
+
+    def _push_core(self, core: int):
+        ver = self._core_vers[core] + 1
+        self._core_vers[core] = ver
+        heapq.heappush(self._core_heaps[self._l3_of[core]],
+                       (self._core_key(core), core, ver))
+
+    def _peek_core(self, domain: int, stash: List[HeapEntry],
+                   excluded: Set[int]) -> Optional[HeapEntry]:
+        heap = self._core_heaps[domain]
+        while heap:
+            _, core, ver = heap[0]
+            if ver != self._core_vers[core]:
+                heapq.heappop(heap)
+            elif core in excluded:
+                stash.append(heapq.heappop(heap))
+            else:
+                return heap[0]
+        return None
+
+    def _push_l3(self, domain: int,
+                 stash: List[HeapEntry] = None, excluded: Set[int] = None):
+        self._l3_vers[domain] += 1
+        top = self._peek_core(domain, stash if stash is not None else [],
+                              excluded or set())
+        if top is None:
+            return  # no more cores available in this allocation
+        heapq.heappush(self._l3_heaps[self._l3_nodes[domain]],
+                       (self._l3_key(domain, top[0]), domain,
+                        self._l3_vers[domain]))
+
+    def _rebuild(self, node: int):
+        self._l3_heaps[node] = []
+        for domain, cores in self.topology.l3_domains.items():
+            if self._l3_nodes[domain] != node:
+                continue
+            heap = [(self._core_key(c), c, self._core_vers[c]) for c in cores]
+            heapq.heapify(heap)
+            self._core_heaps[domain] = heap
+            self._push_l3(domain)
+
+    def _compact(self, nodes: Collection[int]):
+        for node in nodes:
+            size = sum(len(self._core_heaps[d])
+                       for d, n in self._l3_nodes.items() if n == node)
+            if size > 4 * len(self.topology.nodes[node]):
+                self._rebuild(node)
+
+    def _add_share(self, core: int, delta: int,
+                   stash: List[HeapEntry] = None, excluded: Set[int] = None):
+        domain = self._l3_of[core]
+        self.core_shares[core] += delta
+        self.alloc_per_node[self._l3_nodes[domain]] += delta
+        self._l3_loads[domain] += delta
+        self._push_core(core)
+        for sibling in self._siblings[core]:
+            self._push_core(sibling)
+            if self._l3_of[sibling] != domain:
+                self._push_l3(self._l3_of[sibling], stash, excluded)
+        self._push_l3(domain, stash, excluded)
+
+    def alloc_from(self, node: int, num_cores: int) -> Set[int]:
+        '''
+        Allocate up to the given number of distinct cores in the node.
+        '''
+        allocated: Set[int] = set()
+        stash: List[HeapEntry] = []
+        touched: Set[int] = set()
+        l3_heap = self._l3_heaps[node]
+        current = None
+        try:
+            while len(allocated) < num_cores:
+                while l3_heap and l3_heap[0][2] != self._l3_vers[l3_heap[0][1]]:
+                    heapq.heappop(l3_heap)
+                top = None
+                if current is not None:
+                    # "pack" keeps filling the same L3 domain unless the
+                    # others have less shared cores.
+                    top = self._peek_core(current, stash, allocated)
+                    if (top is not None and l3_heap and
+                            l3_heap[0][0][0] < top[0][0]):
+                        top = None
+                if top is None:
+                    if not l3_heap:
+                        break
+                    _, current, _ = heapq.heappop(l3_heap)
+                    touched.add(current)
+                    top = self._peek_core(current, stash, allocated)
+                    if top is None:
+                        current = None
+                        continue
+                heapq.heappop(self._core_heaps[current])
+                allocated.add(top[1])
+                self._add_share(top[1], 1, stash, allocated)
+                if self.policy != 'pack':
+                    current = None
+        finally:
+            for entry in stash:
+                heapq.heappush(self._core_heaps[self._l3_of[entry[1]]], entry)
+            for domain in touched:
+                self._push_l3(domain)
+        self._compact([node])
+        return allocated
+
+    def alloc(self, num_cores: int) -> Tuple[int, Set[int]]:
+        '''
+        Find a most free NUMA node and allocate the cores in it following
+        the placement policy.  Return a tuple of the NUMA node index and the
+        set of allocated cores.
+        '''
+        node = min(self.alloc_per_node, key=self.alloc_per_node.__getitem__)
+        return node, self.alloc_from(node, num_cores)
+
+    def alloc_multi_node(self, num_cores: int) -> Tuple[List[int], Set[int]]:
+        '''
+        Allocate the cores like :meth:`alloc`, but span the allocation evenly
+        across the minimum number of NUMA nodes if the requested cores do not
+        fit in the node.  Return a tuple of the list of NUMA node indices and
+        the set of allocated cores.
+        '''
+        node_sizes = {n: len(cores) for n, cores in self.topology.nodes.items()}
+        plan = plan_multi_node(num_cores, node_sizes, self.alloc_per_node)
+        cores: Set[int] = set()
+        for node, count in plan.items():
+            cores |= self.alloc_from(node, count)
+        return sorted(plan), cores
+
+    def update(self, core_set: Collection[int]):
+        '''
+        Manually add a given core set as if it is allocated by us.
+        '''
+        for core in core_set:
+            self._add_share(core, 1)
+        self._compact({self.topology.cores[c].node for c in core_set})
+
+    def free(self, core_set: Collection[int]):
+        '''
+        Remove the given set of CPU cores from the allocated shares.
+        '''
+        for core in core_set:
+            self._add_share(core, -1)
+        self._compact({self.topology.cores[c].node for c in core_set})
@@ -0,0 +1,121 @@
+'''
+Content-addressed deduplication of kernel output files.
+
+Notebooks often rewrite the same CSV or image files with identical contents
+in every run.  The index remembers the digests of the objects uploaded by
+this agent so that such files are referenced instead of being re-uploaded.
+
+The deduplicated objects are stored under keys derived from their SHA-256
+digests, so an object never changes once its URL is handed out, even if the
+file it came from is rewritten later.
+'''
+
+from collections import OrderedDict
+import hashlib
+import logging
+from pathlib import Path
+from typing import Mapping, MutableMapping, Optional, Tuple
+
+import attr
+
+from ai.backend.common.logging import BraceStyleAdapter
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.dedup'))
+
+hash_block_size = 1024 * 1024  # 1 MiB
+default_max_objects = 65536
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class ContentDigest:
+    size: int
+    sha256: str
+
+
+class ContentHasher:
+    '''
+    Computes the digest of a byte stream incrementally.
+    '''
+
+    __slots__ = ('size', '_sha256')
+
+    def __init__(self):
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def update(self, data: bytes):
+        self.size += len(data)
+        self._sha256.update(data)
+
+    def digest(self) -> ContentDigest:
+        return ContentDigest(self.size, self._sha256.hexdigest())
+
+
+def digest_of(path: Path) -> ContentDigest:
+    '''
+    Read the file and return its digest.
+    (blocking; run it in an executor)
+    '''
+    hasher = ContentHasher()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(hash_block_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.digest()
+
+
+class ContentIndex:
+    '''
+    Maps the digests of uploaded objects to their URLs, shared by all kernels
+    of the agent, and keeps a per-kernel manifest of the digests of output
+    files by their relative paths.
+
+    The agent-wide index is bounded by ``max_objects`` and evicts the least
+    recently used entries first.
+    '''
+
+    def __init__(self, *, max_objects: int = default_max_objects):
+        self.max_objects = max_objects
+        self._objects: MutableMapping[ContentDigest, str] = OrderedDict()
+        self._manifests: MutableMapping[
+            str, MutableMapping[str, Tuple[ContentDigest, str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    def manifest(self, kernel_id: str) -> Mapping[str, Tuple[ContentDigest, str]]:
+        return self._manifests.get(kernel_id, {})
+
+    def lookup(self, kernel_id: str, relpath: str,
+               digest: ContentDigest) -> Optional[str]:
+        '''
+        Return the URL of an existing object with the same contents, if any.
+        '''
+        entry = self._manifests.get(kernel_id, {}).get(relpath)
+        if entry is not None and entry[0] == digest:
+            return entry[1]
+        url = self._objects.get(digest)
+        if url is not None:
+            self._objects.move_to_end(digest)
+            self._manifests.setdefault(kernel_id, {})[relpath] = (digest, url)
+        return url
+
+    def add(self, kernel_id: str, relpath: str,
+            digest: ContentDigest, url: str):
+        self._manifests.setdefault(kernel_id, {})[relpath] = (digest, url)
+        if digest in self._objects:
+            self._objects.move_to_end(digest)
+        self._objects[digest] = url
+        while len(self._objects) > self.max_objects:
+            self._objects.popitem(last=False)
+
+    def discard_kernel(self, kernel_id: str):
+        '''
+        Forget the manifest of the kernel.
+
+        The uploaded objects outlive the kernel, so they remain in the
+        agent-wide index to be referenced by other kernels.
+        '''
+        self._manifests.pop(kernel_id, None)
@@ -0,0 +1,470 @@
+'''
+Packing more kernels into a node by deflating the idle ones.
+
+A kernel keeps its CFS quota while it sits idle, e.g., a notebook which
+nobody has executed anything for an hour.  In the density mode,
+:class:`CPUDeflator` shrinks the CFS quota and shares of the kernels which
+have not executed any code for a while and use almost no CPU, and restores
+them right before the next execution.  The CPU capacity reclaimed from the
+deflated kernels is advertised to the manager as overcommittable slots.
+
+Likewise, an idle kernel keeps its page cache and anonymous memory.
+:class:`MemoryReclaimer` pushes them out of the idle kernels' cgroups bit
+by bit, so that the host memory goes to the active kernels first.
+'''
+
+import asyncio
+import errno
+import logging
+from pathlib import Path
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import aiodocker
+from aiodocker.exceptions import DockerError
+import attr
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .governor import DockerGovernor
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.density'))
+
+cpu_period = 100_000            # usec, the docker default
+default_cpu_shares = 1024
+deflated_cpu_quota = 10_000     # usec per period (0.1 core)
+deflated_cpu_shares = 128
+default_idle_cpu_usage = 0.02   # cores
+default_reclaim_ratio = 0.5             # of the usage per reclaim
+default_max_reclaim_bytes = 256 * (2 ** 20)     # per run
+default_max_active_io = 16 * (2 ** 20)  # bytes per second
+default_reclaim_cooldown = 600.0        # seconds
+
+
+def get_cpu_quota(cpu_share) -> int:
+    '''
+    Return the CFS quota per period for the given number of cores.
+    '''
+    return int(cpu_period * cpu_share)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class IdleCandidate:
+    kernel_id: str
+    container_id: str
+    cpu_quota: int
+    last_used: float                    # time.monotonic()
+    cpu_used: Optional[float] = None    # the cumulative CPU time in msec
+    io_bytes: Optional[float] = None    # the cumulative block I/O in bytes
+    busy: bool = False                  # running code or restarting
+
+
+@attr.s(auto_attribs=True, slots=True)
+class DeflatedKernel:
+    container_id: str
+    cpu_quota: int
+    deflated_quota: int
+
+
+def _estimate_rate(samples: Dict[str, Tuple[float, float]], key: str,
+                   value: Optional[float], now: float) -> Optional[float]:
+    # The average increase per second of a cumulative counter since the
+    # last sample.
+    if value is None:
+        return None
+    prev = samples.get(key)
+    samples[key] = (now, value)
+    if prev is None or now <= prev[0] or value < prev[1]:
+        return None
+    return (value - prev[1]) / (now - prev[0])
+
+
+class CPUDeflator:
+    '''
+    Shrinks the CFS quota and shares of the idle kernels and restores them
+    on demand.
+
+    A kernel is idle if it has not been used for ``idle_threshold`` seconds
+    and its CPU usage since the last check is below ``idle_cpu_usage``
+    cores.  The number of deflated kernels and the reclaimed cores are
+    reported as the ``ai.backend.agent.density.deflated`` and
+    ``ai.backend.agent.density.reclaimed_cpu`` gauges.
+    '''
+
+    def __init__(self, docker: aiodocker.Docker, *,
+                 governor: DockerGovernor,
+                 idle_threshold: float,
+                 idle_cpu_usage: float = default_idle_cpu_usage,
+                 stats_monitor=None,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.docker = docker
+        self.governor = governor
+        self.idle_threshold = idle_threshold
+        self.idle_cpu_usage = idle_cpu_usage
+        self.stats_monitor = stats_monitor
+        self._deflated: Dict[str, DeflatedKernel] = {}
+        self._last_active: Dict[str, float] = {}
+        self._samples: Dict[str, Tuple[float, float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.idle_threshold > 0
+
+    @property
+    def reclaimed_cpu(self) -> float:
+        '''
+        The number of cores reclaimed from the deflated kernels.
+        '''
+        return sum(d.cpu_quota - d.deflated_quota
+                   for d in self._deflated.values()) / cpu_period
+
+    def is_deflated(self, kernel_id: str) -> bool:
+        return kernel_id in self._deflated
+
+    def adopt(self, kernel_id: str, container_id: str,
+              cpu_quota: int, current_quota: int):
+        '''
+        Register a kernel deflated before the agent has restarted, so that
+        it is inflated on its next execution.
+        '''
+        self._deflated[kernel_id] = DeflatedKernel(container_id, cpu_quota,
+                                                   current_quota)
+
+    def forget(self, kernel_id: str):
+        self._deflated.pop(kernel_id, None)
+        self._last_active.pop(kernel_id, None)
+        self._samples.pop(kernel_id, None)
+        self._locks.pop(kernel_id, None)
+
+    def _get_lock(self, kernel_id: str) -> asyncio.Lock:
+        lock = self._locks.get(kernel_id)
+        if lock is None:
+            lock = self._locks[kernel_id] = asyncio.Lock()
+        return lock
+
+    def _report_stats(self):
+        if self.stats_monitor is None:
+            return
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.density.deflated', len(self._deflated))
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.density.reclaimed_cpu',
+            self.reclaimed_cpu)
+
+    async def _update(self, container_id: str, cpu_quota: int, cpu_shares: int):
+        # It is a cheap cgroup update like inspections.
+        async with self.governor.lane('inspect'):
+            await self.docker._query_json(
+                f'containers/{container_id}/update', method='POST',
+                data={'CpuQuota': cpu_quota, 'CpuShares': cpu_shares})
+
+    def _estimate_usage(self, c: IdleCandidate, now: float) -> Optional[float]:
+        # The average usage since the last check, in the number of cores.
+        rate = _estimate_rate(self._samples, c.kernel_id, c.cpu_used, now)
+        return None if rate is None else rate / 1000
+
+    async def deflate_idle(self, candidates: Iterable[IdleCandidate]) -> List[str]:
+        '''
+        Deflate the idle kernels among the given ones and return their IDs.
+        '''
+        if not self.enabled:
+            return []
+        now = time.monotonic()
+        live = set()
+        deflated = []
+        for c in candidates:
+            live.add(c.kernel_id)
+            usage = self._estimate_usage(c, now)
+            if c.busy or c.kernel_id in self._deflated:
+                continue
+            last_active = max(c.last_used, self._last_active.get(c.kernel_id, 0))
+            if now - last_active < self.idle_threshold:
+                continue
+            if usage is None or usage > self.idle_cpu_usage:
+                continue
+            if c.cpu_quota <= deflated_cpu_quota:
+                continue
+            async with self._get_lock(c.kernel_id):
+                if self._last_active.get(c.kernel_id, 0) >= now:
+                    # It has started an execution in the meantime.
+                    continue
+                # Register it first, so that an execution starting during
+                # the update waits for it and inflates the kernel again.
+                self._deflated[c.kernel_id] = DeflatedKernel(
+                    c.container_id, c.cpu_quota, deflated_cpu_quota)
+                try:
+                    await self._update(c.container_id, deflated_cpu_quota,
+                                       deflated_cpu_shares)
+                except DockerError as e:
+                    self._deflated.pop(c.kernel_id, None)
+                    log.warning('cannot deflate the kernel {0}: {1!r}',
+                                c.kernel_id, e)
+                    continue
+            log.debug('deflated the idle kernel {0}', c.kernel_id)
+            deflated.append(c.kernel_id)
+        self._samples = {k: v for k, v in self._samples.items() if k in live}
+        self._report_stats()
+        return deflated
+
+    async def inflate(self, kernel_id: str):
+        '''
+        Restore the CFS quota and shares of the kernel if it is deflated.
+        It also marks the kernel active, so call it before every execution.
+        '''
+        self._last_active[kernel_id] = time.monotonic()
+        if kernel_id not in self._deflated:
+            return
+        async with self._get_lock(kernel_id):
+            d = self._deflated.get(kernel_id)
+            if d is None:
+                return
+            try:
+                await self._update(d.container_id, d.cpu_quota,
+                                   default_cpu_shares)
+            except DockerError as e:
+                log.warning('cannot inflate the kernel {0}: {1!r}',
+                            kernel_id, e)
+                if e.status != 404:
+                    return
+            self._deflated.pop(kernel_id, None)
+            log.debug('inflated the kernel {0}', kernel_id)
+        self._report_stats()
+
+
+def get_memory_cgroup(container_id: str,
+                      cgroup_root: Path = Path('/sys/fs/cgroup')) \
+        -> Optional[Tuple[Path, int]]:
+    '''
+    Return the memory cgroup directory of the container and the cgroup
+    version, or None if it is not found.
+    '''
+    if (cgroup_root / 'cgroup.controllers').exists():
+        version = 2
+        candidates = [
+            cgroup_root / 'system.slice' / f'docker-{container_id}.scope',
+            cgroup_root / 'docker' / container_id,
+        ]
+    else:
+        version = 1
+        candidates = [
+            cgroup_root / 'memory' / 'docker' / container_id,
+            cgroup_root / 'memory' / 'system.slice' / f'docker-{container_id}.scope',
+        ]
+    for path in candidates:
+        if path.is_dir():
+            return path, version
+    return None
+
+
+def _read_int(path: Path) -> int:
+    return int(path.read_text().strip())
+
+
+def _read_memory_stat(path: Path) -> Dict[str, int]:
+    stat = {}
+    for line in path.read_text().splitlines():
+        key, _, value = line.partition(' ')
+        stat[key] = int(value)
+    return stat
+
+
+def _reclaim_v2(path: Path, amount: int) -> int:
+    before = _read_int(path / 'memory.current')
+    try:
+        (path / 'memory.reclaim').write_text(str(amount))
+    except OSError as e:
+        # It fails with EAGAIN if it could not reclaim the whole amount,
+        # though it may have reclaimed a part of it.
+        if e.errno != errno.EAGAIN:
+            raise
+    return max(0, before - _read_int(path / 'memory.current'))
+
+
+def _reclaim_v1(path: Path, amount: int, budget: int) -> int:
+    before = _read_int(path / 'memory.usage_in_bytes')
+    # The kernel reclaims the usage beyond the soft limit first when the
+    # host runs short of memory.
+    (path / 'memory.soft_limit_in_bytes').write_text(str(before - amount))
+    stat = _read_memory_stat(path / 'memory.stat')
+    cache = stat.get('total_cache', stat.get('cache', 0))
+    if cache > 0 and before <= budget:
+        # Drop the page cache right away.  It reclaims the anonymous memory
+        # as well, so only when the whole usage fits in the budget.
+        (path / 'memory.force_empty').write_text('0')
+    return max(0, before - _read_int(path / 'memory.usage_in_bytes'))
+
+
+def _reset_soft_limit(path: Path):
+    (path / 'memory.soft_limit_in_bytes').write_text('-1')
+
+
+class MemoryReclaimer:
+    '''
+    Reclaims the page cache and anonymous memory of the idle kernels.
+
+    A kernel is idle under the same conditions as :class:`CPUDeflator`.
+    Each reclaim asks the kernel's memory cgroup to give up
+    ``reclaim_ratio`` of its usage, via ``memory.reclaim`` on cgroup v2,
+    or via the soft limit on cgroup v1.  On cgroup v1, ``memory.force_empty``
+    also drops the page cache of the kernels whose whole usage fits in the
+    remaining budget.  The soft limit is lifted again on the next execution.
+
+    To keep it from competing with the I/O of the active kernels, the
+    reclaims are done one kernel at a time up to ``max_reclaim_bytes`` per
+    run, the whole run is skipped while the active kernels do more than
+    ``max_active_io`` bytes of block I/O per second, and a kernel is not
+    reclaimed again within ``cooldown`` seconds.  The total reclaimed bytes
+    are reported as the ``ai.backend.agent.density.reclaimed_mem`` gauge.
+    '''
+
+    min_reclaim_bytes = 2 ** 20
+
+    def __init__(self, *,
+                 idle_threshold: float,
+                 idle_cpu_usage: float = default_idle_cpu_usage,
+                 reclaim_ratio: float = default_reclaim_ratio,
+                 max_reclaim_bytes: int = default_max_reclaim_bytes,
+                 max_active_io: float = default_max_active_io,
+                 cooldown: float = default_reclaim_cooldown,
+                 cgroup_root: Path = Path('/sys/fs/cgroup'),
+                 stats_monitor=None,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.idle_threshold = idle_threshold
+        self.idle_cpu_usage = idle_cpu_usage
+        self.reclaim_ratio = reclaim_ratio
+        self.max_reclaim_bytes = max_reclaim_bytes
+        self.max_active_io = max_active_io
+        self.cooldown = cooldown
+        self.cgroup_root = cgroup_root
+        self.stats_monitor = stats_monitor
+        self.reclaimed_bytes = 0
+        self.kernel_reclaimed_bytes: Dict[str, int] = {}
+        self._last_active: Dict[str, float] = {}
+        self._last_reclaimed: Dict[str, float] = {}
+        self._soft_limited: Dict[str, Path] = {}
+        self._cpu_samples: Dict[str, Tuple[float, float]] = {}
+        self._io_samples: Dict[str, Tuple[float, float]] = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.idle_threshold > 0
+
+    def activate(self, kernel_id: str):
+        '''
+        Mark the kernel active and lift its soft limit if any.  Call it
+        before every execution.
+        '''
+        self._last_active[kernel_id] = time.monotonic()
+        self._last_reclaimed.pop(kernel_id, None)
+        path = self._soft_limited.pop(kernel_id, None)
+        if path is not None:
+            try:
+                _reset_soft_limit(path)
+            except OSError as e:
+                log.warning('cannot reset the memory soft limit of '
+                            'the kernel {0}: {1!r}', kernel_id, e)
+
+    def forget(self, kernel_id: str):
+        self.kernel_reclaimed_bytes.pop(kernel_id, None)
+        self._last_active.pop(kernel_id, None)
+        self._last_reclaimed.pop(kernel_id, None)
+        self._soft_limited.pop(kernel_id, None)
+        self._cpu_samples.pop(kernel_id, None)
+        self._io_samples.pop(kernel_id, None)
+
+    def _report_stats(self):
+        if self.stats_monitor is None:
+            return
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.density.reclaimed_mem',
+            self.reclaimed_bytes)
+
+    def _reclaim(self, container_id: str, budget: int) \
+            -> Tuple[Optional[Path], int]:
+        # Runs in a thread since a reclaim may take a while.
+        found = get_memory_cgroup(container_id, self.cgroup_root)
+        if found is None:
+            return None, 0
+        path, version = found
+        if version == 2:
+            usage = _read_int(path / 'memory.current')
+        else:
+            usage = _read_int(path / 'memory.usage_in_bytes')
+        amount = min(budget, int(usage * self.reclaim_ratio))
+        if amount < self.min_reclaim_bytes:
+            return None, 0
+        if version == 2:
+            return None, _reclaim_v2(path, amount)
+        return path, _reclaim_v1(path, amount, budget)
+
+    async def reclaim_idle(self, candidates: Iterable[IdleCandidate]) \
+            -> Dict[str, int]:
+        '''
+        Reclaim the memory of the idle kernels among the given ones and
+        return the reclaimed bytes per kernel.  It is no-op while the
+        previous run is still in progress.
+        '''
+        if not self.enabled or self._lock.locked():
+            return {}
+        async with self._lock:
+            now = time.monotonic()
+            live = set()
+            idle = []
+            active_io = 0.0
+            for c in candidates:
+                live.add(c.kernel_id)
+                usage = _estimate_rate(self._cpu_samples, c.kernel_id,
+                                       c.cpu_used, now)
+                io_rate = _estimate_rate(self._io_samples, c.kernel_id,
+                                         c.io_bytes, now)
+                last_active = max(c.last_used,
+                                  self._last_active.get(c.kernel_id, 0))
+                if (c.busy or now - last_active < self.idle_threshold or
+                        usage is None or usage / 1000 > self.idle_cpu_usage):
+                    active_io += io_rate or 0
+                    continue
+                last_reclaimed = self._last_reclaimed.get(c.kernel_id)
+                if last_reclaimed is not None and \
+                        now - last_reclaimed < self.cooldown:
+                    continue
+                idle.append(c)
+            self._cpu_samples = {k: v for k, v in self._cpu_samples.items()
+                                 if k in live}
+            self._io_samples = {k: v for k, v in self._io_samples.items()
+                                if k in live}
+            if active_io > self.max_active_io:
+                log.debug('postponed reclaiming the idle kernels\' memory '
+                          'as the active ones do {0:.0f} bytes/s of I/O',
+                          active_io)
+                return {}
+            budget = self.max_reclaim_bytes
+            reclaimed = {}
+            for c in idle:
+                if budget < self.min_reclaim_bytes:
+                    break
+                try:
+                    path, nbytes = await self.loop.run_in_executor(
+                        None, self._reclaim, c.container_id, budget)
+                except OSError as e:
+                    log.warning('cannot reclaim the memory of the kernel '
+                                '{0}: {1!r}', c.kernel_id, e)
+                    continue
+                self._last_reclaimed[c.kernel_id] = now
+                if path is not None:
+                    self._soft_limited[c.kernel_id] = path
+                    if self._last_active.get(c.kernel_id, 0) >= now:
+                        # It has started an execution in the meantime.
+                        self.activate(c.kernel_id)
+                budget = max(0, budget - nbytes)
+                if nbytes > 0:
+                    log.debug('reclaimed {0} bytes from the idle kernel {1}',
+                              nbytes, c.kernel_id)
+                    reclaimed[c.kernel_id] = nbytes
+                    self.kernel_reclaimed_bytes[c.kernel_id] = \
+                        self.kernel_reclaimed_bytes.get(c.kernel_id, 0) + nbytes
+                    self.reclaimed_bytes += nbytes
+            self._report_stats()
+            return reclaimed
@@ -0,0 +1,239 @@
+'''
+Batched and sequenced delivery of agent events to the manager.
+
+Sending one ZeroMQ message per event floods the manager during mass
+terminations.  :class:`EventOutbox` assigns a monotonically increasing
+sequence number to each event and coalesces the events queued during a flush
+interval into a single ``event_batch`` message::
+
+    (b'event_batch', instance_id, msgpack([stream_id, [
+        [seq, event_name, args, timestamp], ...
+    ]]))
+
+The stream ID is renewed whenever the agent restarts, so the manager can
+detect duplicates and gaps by the pairs of stream IDs and sequence numbers.
+
+When the manager does not keep up and the socket's write buffer grows beyond
+a threshold, the batches are appended to a bounded spill file instead and
+replayed in order once the socket drains.  The spill file survives restarts
+of the agent.  If it is full, the new events are dropped and counted.
+
+With a zero flush interval, each event is sent immediately in the legacy
+per-event wire format without sequence numbers.
+'''
+
+import asyncio
+import logging
+import os
+from pathlib import Path
+import secrets
+import struct
+import time
+from typing import List, Optional
+
+import msgpack
+import zmq
+
+from ai.backend.common.logging import BraceStyleAdapter
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.events'))
+
+default_flush_interval = 0.05         # 50 msec
+default_max_batch_size = 1000         # events
+default_spill_threshold = 1 * 2 ** 20  # 1 MiB in the socket write buffer
+default_max_spill_size = 64 * 2 ** 20  # 64 MiB
+default_drain_timeout = 5.0           # seconds
+
+_record_header = struct.Struct('!I')
+
+
+class EventOutbox:
+    '''
+    Queues the agent events and sends them to the manager in batches.
+
+    :param flush_interval: The interval in seconds to send the queued events.
+                           Zero disables batching.
+    :param spill_path: The path of the spill file.  Without it, the batches
+                       are always written to the socket.
+    '''
+
+    def __init__(self, instance_id: str, *,
+                 flush_interval: float = default_flush_interval,
+                 max_batch_size: int = default_max_batch_size,
+                 spill_path: Path = None,
+                 spill_threshold: int = default_spill_threshold,
+                 max_spill_size: int = default_max_spill_size,
+                 stats_monitor=None,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.instance_id = instance_id.encode('utf8')
+        self.stream_id = secrets.token_hex(8)
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.spill_path = spill_path
+        self.spill_threshold = spill_threshold
+        self.max_spill_size = max_spill_size
+        self.stats_monitor = stats_monitor
+        self.num_dropped = 0
+        self._sock = None
+        self._seq = 0
+        self._pending: List[list] = []
+        self._spill_size = 0    # the end offset of the spill file
+        self._spill_offset = 0  # the offset of the next record to replay
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def batched(self) -> bool:
+        return self.flush_interval > 0
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    @property
+    def spilled_bytes(self) -> int:
+        return self._spill_size - self._spill_offset
+
+    def start(self, sock):
+        '''
+        Start sending the events via the given aiozmq stream.
+        '''
+        self._sock = sock
+        if self.batched:
+            if self.spill_path is not None and self.spill_path.is_file():
+                self._spill_size = self.spill_path.stat().st_size
+                if self._spill_size > 0:
+                    log.info('replaying {0} bytes of spilled events',
+                             self._spill_size)
+            self._flush_task = self.loop.create_task(self._flush_loop())
+
+    async def close(self, timeout: float = default_drain_timeout):
+        '''
+        Send the remaining events and close the socket, waiting up to the
+        given timeout until the socket's write buffer is drained.
+        '''
+        if self._sock is None:
+            return
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+        deadline = time.monotonic() + timeout
+        while (self._sock.transport.get_write_buffer_size() > 0 and
+               time.monotonic() < deadline):
+            await asyncio.sleep(0.05)
+        remaining = max(0.0, deadline - time.monotonic())
+        self._sock.transport.setsockopt(zmq.LINGER, int(remaining * 1000))
+        self._sock.close()
+        self._sock = None
+
+    def put(self, event_name: str, *args) -> int:
+        '''
+        Queue an event and return its sequence number.
+        '''
+        self._seq += 1
+        if not self.batched:
+            if self._sock is not None:
+                self._sock.write((
+                    event_name.encode('ascii'),
+                    self.instance_id,
+                    msgpack.packb(args),
+                ))
+            return self._seq
+        self._pending.append([self._seq, event_name, args, time.time()])
+        return self._seq
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('unexpected error while flushing events')
+
+    def _congested(self) -> bool:
+        return self._sock.transport.get_write_buffer_size() > self.spill_threshold
+
+    def _report_stats(self, num_events: int):
+        if self.stats_monitor is None:
+            return
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.events.batch_size', num_events)
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.events.spilled_bytes', self.spilled_bytes)
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.events.dropped', self.num_dropped)
+
+    async def flush(self):
+        '''
+        Send the queued events, spilling them to the disk if the socket is
+        congested.
+        '''
+        if self._sock is None or not self.batched:
+            return
+        async with self._flush_lock:
+            num_events = len(self._pending)
+            if self.spilled_bytes > 0:
+                await self._replay_spill()
+            while self._pending:
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+                data = msgpack.packb([self.stream_id, batch])
+                if (self.spill_path is not None and
+                        (self.spilled_bytes > 0 or self._congested())):
+                    await self._spill(data, len(batch))
+                else:
+                    self._write_batch(data)
+            self._report_stats(num_events)
+
+    def _write_batch(self, data: bytes):
+        self._sock.write((b'event_batch', self.instance_id, data))
+
+    async def _spill(self, data: bytes, num_events: int):
+        if (self._spill_size + _record_header.size + len(data) >
+                self.max_spill_size):
+            if self.num_dropped == 0:
+                log.warning('the event spill is full; dropping events')
+            self.num_dropped += num_events
+            return
+        await self.loop.run_in_executor(None, self._append_record, data)
+        self._spill_size += _record_header.size + len(data)
+
+    def _append_record(self, data: bytes):
+        with open(self.spill_path, 'ab') as f:
+            f.write(_record_header.pack(len(data)))
+            f.write(data)
+
+    def _read_record(self, offset: int) -> bytes:
+        with open(self.spill_path, 'rb') as f:
+            f.seek(offset)
+            size, = _record_header.unpack(f.read(_record_header.size))
+            data = f.read(size)
+            if len(data) != size:
+                raise OSError('truncated record')
+            return data
+
+    async def _replay_spill(self):
+        while self.spilled_bytes > 0 and not self._congested():
+            try:
+                data = await self.loop.run_in_executor(
+                    None, self._read_record, self._spill_offset)
+            except (OSError, struct.error) as e:
+                log.warning('discarding the corrupted event spill: {0!r}', e)
+                data = None
+            if data is None:
+                self._spill_offset = self._spill_size
+                break
+            self._write_batch(data)
+            self._spill_offset += _record_header.size + len(data)
+        if self.spill_path is not None and self._spill_offset >= self._spill_size:
+            try:
+                os.unlink(self.spill_path)
+            except FileNotFoundError:
+                pass
+            self._spill_size = 0
+            self._spill_offset = 0
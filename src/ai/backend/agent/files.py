@@ -1,10 +1,9 @@
-import asyncio
 import logging
 import os
 from pathlib import Path
 
 from ai.backend.common.logging import BraceStyleAdapter
-import botocore, aiobotocore
+from .uploader import S3UploadEngine
 
 log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.files'))
 
@@ -14,6 +13,8 @@ s3_secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY', 'dummy-secret-key')
 s3_region = os.environ.get('AWS_REGION', 'ap-northeast-1')
 s3_bucket = os.environ.get('AWS_S3_BUCKET', 'codeonweb')
 s3_bucket_path = os.environ.get('AWS_S3_BUCKET_PATH', 'bucket')
+# set this to use S3-compatible storages other than AWS S3 (e.g., MinIO)
+s3_endpoint_url = os.environ.get('AWS_S3_ENDPOINT_URL', None)
 
 if s3_access_key == 'dummy-access-key':
     log.info('Automatic ~/.output file S3 uploads is disabled.')
@@ -26,9 +27,11 @@ def relpath(path, base):
 async def upload_output_files_to_s3(initial_file_stats,
                                     final_file_stats,
                                     base_dir, prefix):
-    loop = asyncio.get_event_loop()
-    output_files = []
     diff_files = diff_file_stats(initial_file_stats, final_file_stats)
+    return await upload_files_to_s3(diff_files, base_dir, prefix)
+
+
+async def upload_files_to_s3(diff_files, base_dir, prefix, *, engine=None):
     if s3_access_key == 'dummy-access-key':
         return [
             {
@@ -36,33 +39,29 @@ async def upload_output_files_to_s3(initial_file_stats,
                 'url': f'#dummy-upload',
             } for fname in diff_files
         ]
-    if diff_files:
-        session = aiobotocore.get_session(loop=loop)
-        client = session.create_client('s3', region_name=s3_region,
-                                       aws_secret_access_key=s3_secret_key,
-                                       aws_access_key_id=s3_access_key)
-        for fname in diff_files:
-            path = relpath(fname, base_dir)
-            key = f'{s3_bucket_path}/{prefix}/{path}'
-            try:
-                # TODO: put the file chunk-by-chunk.
-                with open(fname, 'rb') as f:
-                    content = f.read()
-                await client.put_object(Bucket=s3_bucket,
-                                        Key=key,
-                                        Body=content,
-                                        ACL='public-read')
-            except botocore.exceptions.ClientError as exc:
-                log.exception('S3 upload error {!r}', exc)
-            except IOError:
-                log.exception('Could not read output file')
-            else:
-                output_files.append({
-                    'name': str(path),
-                    'url': f'https://{s3_bucket}.s3.amazonaws.com/{key}',
-                })
-        client.close()
-    return output_files
+    if not diff_files:
+        return []
+    if engine is not None:
+        return await engine.upload_files(diff_files, base_dir, prefix)
+    engine = create_upload_engine()
+    try:
+        return await engine.upload_files(diff_files, base_dir, prefix)
+    finally:
+        engine.close()
+
+
+def create_upload_engine(**kwargs):
+    '''
+    Create a new S3 upload engine configured from the AWS environment variables.
+    '''
+    return S3UploadEngine(
+        bucket=s3_bucket,
+        bucket_path=s3_bucket_path,
+        region=s3_region,
+        access_key=s3_access_key,
+        secret_key=s3_secret_key,
+        endpoint_url=s3_endpoint_url,
+        **kwargs)
 
 
 def scandir(root: Path, allowed_max_size: int):
@@ -1,5 +1,93 @@
-from subprocess import CalledProcessError
+'''
+Mount helpers and in-memory (tmpfs) scratch filesystems.
+
+The filesystems are mounted and unmounted with the mount syscalls directly
+instead of forking ``mount``/``umount`` processes.
+'''
+
 import asyncio
+import ctypes
+import logging
+import os
+from pathlib import Path
+import secrets
+import sys
+from typing import Dict, Iterable, List, Tuple
+
+from ai.backend.common.logging import BraceStyleAdapter
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.fs'))
+
+MS_BIND    = 4096
+MS_MOVE    = 8192
+MS_PRIVATE = 1 << 18
+MNT_DETACH = 2
+
+page_size = 4096
+default_tmp_ratio = 0.25    # of the in-memory scratch budget for /tmp
+
+_libc = None
+if sys.platform == 'linux':
+    try:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    except OSError:
+        pass
+
+
+def _encode(value):
+    if value is None:
+        return None
+    return os.fsencode(str(value))
+
+
+def _mount(source, target, fstype, flags, data=None):
+    if _libc is None:
+        raise OSError('mount syscalls are not available in this platform')
+    ret = _libc.mount(_encode(source), _encode(target), _encode(fstype),
+                      ctypes.c_ulong(flags), _encode(data))
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), str(target))
+
+
+def mount_tmpfs(target: Path, size: int):
+    '''
+    Mount a new tmpfs instance limited to the given size in bytes.
+    '''
+    _mount('tmpfs', target, 'tmpfs', 0, f'size={size}')
+
+
+def move_mount(source: Path, target: Path):
+    _mount(source, target, None, MS_MOVE)
+
+
+def mount_device(device: Path, target: Path, fstype: str):
+    _mount(device, target, fstype, 0)
+
+
+def bind_mount(source: Path, target: Path):
+    _mount(source, target, None, MS_BIND)
+
+
+def umount(target: Path, *, lazy: bool = True):
+    if _libc is None:
+        raise OSError('mount syscalls are not available in this platform')
+    ret = _libc.umount2(_encode(target), MNT_DETACH if lazy else 0)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), str(target))
+
+
+def split_scratch_budget(size: int,
+                         tmp_ratio: float = default_tmp_ratio) -> Tuple[int, int]:
+    '''
+    Split the in-memory scratch budget of a kernel in bytes into the sizes of
+    its work and /tmp tmpfs instances, so that both together never exceed it.
+    Each gets at least a page, as the size 0 means no limit for tmpfs.
+    '''
+    tmp_size = max(page_size, int(size * tmp_ratio) // page_size * page_size)
+    work_size = max(page_size, (size - tmp_size) // page_size * page_size)
+    return work_size, tmp_size
 
 
 async def create_scratch_filesystem(scratch_dir, size):
@@ -11,18 +99,7 @@ async def create_scratch_filesystem(scratch_dir, size):
     :param size: The quota size of scratch directory.
                  Size parameter is must be MiB(mebibyte).
     '''
-
-    proc = await asyncio.create_subprocess_exec(*[
-        'mount',
-        '-t', 'tmpfs',
-        '-o', f'size={size}M',
-        'tmpfs', f'{scratch_dir}'
-    ])
-    exit_code = await proc.wait()
-
-    if exit_code < 0:
-        raise CalledProcessError(proc.returncode, proc.args,
-                                 output=proc.stdout, stderr=proc.stderr)
+    mount_tmpfs(scratch_dir, size * (2 ** 20))
 
 
 async def destroy_scratch_filesystem(scratch_dir):
@@ -31,12 +108,122 @@ async def destroy_scratch_filesystem(scratch_dir):
 
     :param scratch_dir: The path of scratch directory.
     '''
-    proc = await asyncio.create_subprocess_exec(*[
-        'umount',
-        f'{scratch_dir}'
-    ])
-    exit_code = await proc.wait()
+    umount(scratch_dir)
+
+
+class TmpfsPool:
+    '''
+    Keeps pools of pre-mounted tmpfs instances with the given sizes and
+    hands them out by moving them to the requested locations.  The requests
+    for the other sizes get new instances mounted on the locations directly.
+
+    The pool root is made a private bind mount of itself, because the kernel
+    does not allow moving mounts out of a parent mount with shared
+    propagation.  If it is not possible, new instances are mounted on the
+    requested locations directly.
+    '''
+
+    def __init__(self, pool_root: Path, *, sizes: Iterable[int],
+                 capacity: int = 4, loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.pool_root = pool_root
+        self.capacity = capacity
+        self._instances: Dict[int, List[Path]] = {size: [] for size in sizes}
+        self._root_mounted = False
+        self._refill_handle = None
+
+    def _reclaim_leftovers(self):
+        if not self.pool_root.is_dir():
+            return
+        for path in self.pool_root.iterdir():
+            try:
+                umount(path)
+            except OSError:
+                pass
+            try:
+                path.rmdir()
+            except OSError:
+                log.warning('cannot remove the leftover tmpfs pool entry {0}', path)
+        try:
+            umount(self.pool_root)
+        except OSError:
+            pass
+
+    async def start(self):
+        self._reclaim_leftovers()
+        self.pool_root.mkdir(parents=True, exist_ok=True)
+        try:
+            _mount(self.pool_root, self.pool_root, None, MS_BIND)
+            self._root_mounted = True
+            _mount('none', self.pool_root, None, MS_PRIVATE)
+        except OSError as e:
+            log.warning('cannot prepare the tmpfs pool at {0} ({1!r}); '
+                        'mounting tmpfs on demand', self.pool_root, e)
+            self.capacity = 0
+        self._refill()
+
+    async def stop(self):
+        if self._refill_handle is not None:
+            self._refill_handle.cancel()
+            self._refill_handle = None
+        for instances in self._instances.values():
+            while instances:
+                self._discard_instance(instances.pop())
+        if self._root_mounted:
+            try:
+                umount(self.pool_root)
+            except OSError as e:
+                log.warning('cannot unmount the tmpfs pool root: {0!r}', e)
+            self._root_mounted = False
+
+    def _discard_instance(self, path: Path):
+        try:
+            umount(path)
+            path.rmdir()
+        except OSError as e:
+            log.warning('cannot remove the pooled tmpfs {0}: {1!r}', path, e)
+
+    def _needs_refill(self) -> bool:
+        return any(len(instances) < self.capacity
+                   for instances in self._instances.values())
+
+    def _refill(self):
+        self._refill_handle = None
+        for size, instances in self._instances.items():
+            while len(instances) < self.capacity:
+                path = self.pool_root / secrets.token_hex(8)
+                path.mkdir()
+                try:
+                    mount_tmpfs(path, size)
+                except OSError as e:
+                    log.warning('cannot mount tmpfs for the pool: {0!r}', e)
+                    path.rmdir()
+                    self.capacity = len(instances)
+                    return
+                instances.append(path)
+
+    async def acquire(self, target: Path, size: int):
+        '''
+        Mount a tmpfs instance with the given size in bytes on the target
+        directory.
+        '''
+        instances = self._instances.get(size)
+        moved = False
+        if instances:
+            path = instances.pop()
+            try:
+                move_mount(path, target)
+                moved = True
+            except OSError as e:
+                log.warning('cannot move the pooled tmpfs to {0}: {1!r}', target, e)
+                self._discard_instance(path)
+                self.capacity = 0
+        if moved:
+            path.rmdir()
+        else:
+            mount_tmpfs(target, size)
+        if self._refill_handle is None and self._needs_refill():
+            self._refill_handle = self.loop.call_soon(self._refill)
 
-    if exit_code < 0:
-        raise CalledProcessError(proc.returncode, proc.args,
-                                 output=proc.stdout, stderr=proc.stderr)
+    async def release(self, target: Path):
+        umount(target)
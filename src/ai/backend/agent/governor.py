@@ -0,0 +1,137 @@
+'''
+Concurrency governor for Docker API calls.
+
+Bursts of kernel creations and destructions may issue hundreds of concurrent
+Docker API calls, which slow down dockerd for every caller.  The governor
+limits the number of concurrent calls per operation class ("lane") and in
+total.  When the total limit is reached, the waiting calls are served in the
+order of their lane priorities so that latency-sensitive operations such as
+killing containers go first.
+
+Usage::
+
+    async with self.docker_governor.lane('kill'):
+        await container.kill()
+'''
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import List, Mapping
+
+import aiotools
+
+from ai.backend.common.logging import BraceStyleAdapter
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.governor'))
+
+# lower values are served first
+lane_priorities = {
+    'kill': 0,
+    'inspect': 1,
+    'delete': 2,
+    'start': 3,
+    'create': 4,
+    'pull': 5,
+}
+
+default_lane_limits = {
+    'kill': 16,
+    'inspect': 16,
+    'delete': 8,
+    'start': 4,
+    'create': 4,
+    'pull': 2,
+}
+
+default_max_concurrency = 24
+
+
+class PriorityLimiter:
+    '''
+    A semaphore which wakes up the waiters with the lowest priority value
+    first (and in FIFO order among the same priority).
+    '''
+
+    def __init__(self, limit: int, *, loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.limit = limit
+        self.active = 0
+        self._waiters: List[list] = []
+        self._seq = itertools.count()
+
+    @property
+    def num_waiters(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    async def acquire(self, priority: int):
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        fut = self.loop.create_future()
+        heapq.heappush(self._waiters, [priority, next(self._seq), fut])
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed over to us but we are cancelled.
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self.active += 1
+            fut.set_result(None)
+            break
+
+
+class DockerGovernor:
+    '''
+    Limits concurrent Docker API calls per operation class and in total.
+
+    The queueing delay of each call is reported as the
+    ``ai.backend.agent.docker.<lane>.queue_delay`` timing metric.
+    '''
+
+    def __init__(self, *,
+                 lane_limits: Mapping[str, int] = None,
+                 max_concurrency: int = default_max_concurrency,
+                 stats_monitor=None,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        limits = {**default_lane_limits, **(lane_limits or {})}
+        self._lanes = {
+            name: asyncio.Semaphore(limit)
+            for name, limit in limits.items()
+        }
+        self._limiter = PriorityLimiter(max_concurrency, loop=self.loop)
+        self.stats_monitor = stats_monitor
+
+    @aiotools.actxmgr
+    async def lane(self, name: str):
+        '''
+        Wait for a slot of the given operation class.
+        '''
+        priority = lane_priorities[name]
+        queued_at = time.monotonic()
+        async with self._lanes[name]:
+            await self._limiter.acquire(priority)
+            try:
+                delay = time.monotonic() - queued_at
+                if self.stats_monitor is not None:
+                    self.stats_monitor.report_stats(
+                        'timing', f'ai.backend.agent.docker.{name}.queue_delay',
+                        delay * 1000)
+                if delay > 1.0:
+                    log.debug('docker {0} call waited {1:.3f} sec', name, delay)
+                yield
+            finally:
+                self._limiter.release()
@@ -0,0 +1,317 @@
+'''
+Pulling the kernel images ahead of time.
+
+The manager registers the kernel images available to the users in etcd as
+``images/{name}/tags/{tag}`` keys.  :class:`ImagePrefetcher` pulls the
+registered images missing in this agent in the background with bounded
+concurrency, so that the kernel creation requests do not have to wait for
+the pulls.
+
+All pulls are single-flight: the concurrent requests to pull the same image,
+either from the prefetcher or from the kernel creations, share one pull.
+
+:class:`ImageCache` keeps the Docker disk from filling up with kernel images.
+When the free space of the Docker root directory drops below the low
+watermark, it deletes the least recently used kernel images which are not
+used by any container until the free space recovers to the high watermark.
+'''
+
+import asyncio
+import logging
+import re
+import shutil
+import time
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+import aiodocker
+from aiodocker.exceptions import DockerError
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .governor import DockerGovernor
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.images'))
+
+default_prefetch_concurrency = 2
+default_low_watermark = 0.1    # ratio of the free disk space
+default_high_watermark = 0.2
+default_max_evictions = 4      # per run
+default_min_idle_time = 600.0  # seconds
+
+_rx_image_tag_key = re.compile(r'^images/(?P<name>[^/]+)/tags/(?P<tag>[^/]+)$')
+_rx_kernel_image = re.compile(r'^.+/kernel-.+$')
+
+
+def get_desired_images(registry: str,
+                       items: Iterable[Tuple[str, str]]) -> List[str]:
+    '''
+    Return the canonical references of the images registered in the given
+    etcd key-value pairs under the ``images`` prefix.  The tag aliases
+    (whose values start with a colon) are skipped as they refer to the other
+    registered tags.
+    '''
+    images = []
+    for key, value in items:
+        m = _rx_image_tag_key.match(key)
+        if m is None or m.group('name') == '_aliases':
+            continue
+        if value.startswith(':'):
+            continue
+        images.append(f"{registry}/kernel-{m.group('name')}:{m.group('tag')}")
+    return sorted(images)
+
+
+class ImagePrefetcher:
+    '''
+    Pulls the kernel images with single-flight semantics and prefetches the
+    desired images with bounded concurrency.
+    '''
+
+    def __init__(self, docker: aiodocker.Docker, *,
+                 governor: DockerGovernor,
+                 max_concurrency: int = default_prefetch_concurrency,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.docker = docker
+        self.governor = governor
+        self.max_concurrency = max_concurrency
+        self._pulls: Dict[str, asyncio.Task] = {}
+        self._prefetch_lock = asyncio.Lock()
+        self._queued: Set[str] = set()
+        self._num_done = 0
+        self._num_failed = 0
+
+    @property
+    def progress(self) -> Mapping[str, object]:
+        '''
+        The progress of the current prefetch round to report via heartbeats.
+        '''
+        return {
+            'queued': len(self._queued),
+            'pulling': sorted(self._pulls),
+            'done': self._num_done,
+            'failed': self._num_failed,
+        }
+
+    async def pull(self, image: str):
+        '''
+        Pull the given image.  If there is an ongoing pull of the same image,
+        wait for it instead.
+        '''
+        task = self._pulls.get(image)
+        if task is None:
+            task = self.loop.create_task(self._pull(image))
+            self._pulls[image] = task
+            task.add_done_callback(
+                lambda task: self._pull_done(image, task))
+        await asyncio.shield(task)
+
+    def _pull_done(self, image: str, task: asyncio.Task):
+        self._pulls.pop(image, None)
+        if not task.cancelled():
+            # Mark the exception retrieved even if all waiters are gone.
+            task.exception()
+
+    async def _pull(self, image: str):
+        log.info('pulling the image {0}', image)
+        async with self.governor.lane('pull'):
+            result = await self.docker.images.pull(image)
+        # The pull API responds with 200 OK even when it fails in the middle.
+        for item in (result or []):
+            if isinstance(item, dict) and 'error' in item:
+                raise DockerError(500, {'message': item['error']})
+        log.info('pulled the image {0}', image)
+
+    async def prefetch(self, images: Iterable[str]) -> List[str]:
+        '''
+        Pull the given images missing in the host and return the list of
+        the successfully pulled ones.  It is no-op while the previous
+        prefetch is still running.
+        '''
+        if self.max_concurrency <= 0 or self._prefetch_lock.locked():
+            return []
+        async with self._prefetch_lock:
+            missing = []
+            for image in images:
+                try:
+                    async with self.governor.lane('inspect'):
+                        await self.docker.images.get(image)
+                except DockerError as e:
+                    if e.status != 404:
+                        log.warning('cannot inspect the image {0}: {1!r}',
+                                    image, e)
+                        continue
+                    missing.append(image)
+            if not missing:
+                return []
+            log.info('prefetching {0} images', len(missing))
+            self._queued = set(missing)
+            self._num_done = 0
+            self._num_failed = 0
+            sema = asyncio.Semaphore(self.max_concurrency)
+            pulled = []
+
+            async def _prefetch(image):
+                async with sema:
+                    self._queued.discard(image)
+                    try:
+                        await self.pull(image)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        log.warning('failed to prefetch the image {0}: {1!r}',
+                                    image, e)
+                        self._num_failed += 1
+                    else:
+                        self._num_done += 1
+                        pulled.append(image)
+
+            try:
+                await asyncio.gather(*[_prefetch(image) for image in missing])
+            finally:
+                self._queued.clear()
+            return pulled
+
+
+class ImageCache:
+    '''
+    Evicts the least recently used kernel images under disk pressure.
+
+    The last-use times are tracked in memory by :meth:`touch`.  The images
+    not used since the agent has started are ordered by their creation
+    times.  Each run deletes at most ``max_evictions`` images, and the images
+    used within ``min_idle_time`` seconds are never deleted.
+
+    The free space ratio of the Docker root directory and the number of
+    evicted images are reported as the
+    ``ai.backend.agent.images.disk_free_ratio`` and
+    ``ai.backend.agent.images.evicted`` gauges.
+    '''
+
+    def __init__(self, docker: aiodocker.Docker, *,
+                 governor: DockerGovernor,
+                 low_watermark: float = default_low_watermark,
+                 high_watermark: float = default_high_watermark,
+                 max_evictions: int = default_max_evictions,
+                 min_idle_time: float = default_min_idle_time,
+                 stats_monitor=None,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.docker = docker
+        self.governor = governor
+        self.low_watermark = low_watermark
+        self.high_watermark = max(low_watermark, high_watermark)
+        self.max_evictions = max_evictions
+        self.min_idle_time = min_idle_time
+        self.stats_monitor = stats_monitor
+        self.num_evicted = 0
+        self._last_used: Dict[str, float] = {}
+        self._root_dir: Optional[str] = None
+        self._evict_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.low_watermark > 0
+
+    def touch(self, image_id: str):
+        '''
+        Record that the given image is used now.
+        '''
+        self._last_used[image_id] = time.time()
+
+    def _is_recently_used(self, image_id: str) -> bool:
+        last_used = self._last_used.get(image_id)
+        return (last_used is not None and
+                time.time() - last_used < self.min_idle_time)
+
+    async def get_free_ratio(self) -> Optional[float]:
+        '''
+        Return the ratio of the free space in the disk of the Docker root
+        directory, or None if it is not accessible from the agent.
+        '''
+        if self._root_dir is None:
+            async with self.governor.lane('inspect'):
+                info = await self.docker._query_json('info')
+            self._root_dir = info.get('DockerRootDir', '/var/lib/docker')
+        try:
+            usage = await self.loop.run_in_executor(
+                None, shutil.disk_usage, self._root_dir)
+        except OSError as e:
+            log.debug('cannot check the docker disk usage: {0!r}', e)
+            return None
+        return usage.free / usage.total
+
+    def _report_stats(self, free_ratio: float):
+        if self.stats_monitor is None:
+            return
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.images.disk_free_ratio', free_ratio)
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.images.evicted', self.num_evicted)
+
+    async def _get_candidates(self) -> List[Tuple[float, str, List[str]]]:
+        async with self.governor.lane('inspect'):
+            images = await self.docker.images.list()
+            containers = await self.docker.containers.list(all=True)
+        used_ids = {container['ImageID'] for container in containers}
+        now = time.time()
+        candidates = []
+        for image in images:
+            tags = [tag for tag in (image.get('RepoTags') or [])
+                    if _rx_kernel_image.match(tag)]
+            if not tags or image['Id'] in used_ids:
+                continue
+            last_used = self._last_used.get(image['Id'], image.get('Created', 0))
+            if now - last_used < self.min_idle_time:
+                continue
+            candidates.append((last_used, image['Id'], tags))
+        candidates.sort()
+        return candidates
+
+    async def evict(self) -> List[str]:
+        '''
+        Delete the least recently used kernel images if the free space is
+        below the low watermark, and return the IDs of the deleted images.
+        '''
+        if not self.enabled or self._evict_lock.locked():
+            return []
+        async with self._evict_lock:
+            free_ratio = await self.get_free_ratio()
+            if free_ratio is None:
+                return []
+            self._report_stats(free_ratio)
+            if free_ratio >= self.low_watermark:
+                return []
+            log.info('docker disk free space is low ({0:.1%}); '
+                     'evicting unused kernel images', free_ratio)
+            evicted = []
+            for _, image_id, tags in await self._get_candidates():
+                if len(evicted) >= self.max_evictions:
+                    break
+                skipped = False
+                try:
+                    # Deleting the last tag deletes the image.
+                    for tag in tags:
+                        # The candidates are listed once, so skip the images
+                        # touched by the kernels being created since then.
+                        if self._is_recently_used(image_id):
+                            skipped = True
+                            break
+                        async with self.governor.lane('delete'):
+                            await self.docker.images.delete(tag)
+                except DockerError as e:
+                    # The image may be used by a container created just now.
+                    log.warning('cannot evict the image {0}: {1!r}', tags, e)
+                    continue
+                if skipped:
+                    log.debug('skipped evicting the image {0} in use', tags)
+                    continue
+                log.info('evicted the image {0}', ', '.join(tags))
+                self._last_used.pop(image_id, None)
+                self.num_evicted += 1
+                evicted.append(image_id)
+                free_ratio = await self.get_free_ratio()
+                if free_ratio is None or free_ratio >= self.high_watermark:
+                    break
+            if free_ratio is not None:
+                self._report_stats(free_ratio)
+            return evicted
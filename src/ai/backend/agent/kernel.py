@@ -7,7 +7,6 @@ import json
 import logging
 import time
 from pathlib import Path
-import pkg_resources
 import secrets
 import subprocess
 
@@ -504,6 +503,7 @@ def build_krunner_env(distro, agent_version):
     '''
     if agent_version is None:
         agent_version = VERSION
+    import pkg_resources
     base_path = Path(pkg_resources.resource_filename('ai.backend.agent',
                                                      '../runner'))
     dockerfiles = [
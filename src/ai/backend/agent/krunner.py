@@ -0,0 +1,219 @@
+'''
+The shared kernel runner environment volumes.
+
+The kernel runner environment (``/opt/backend.ai``) is provided by the
+``lablup/backendai-krunner-env`` images.  Instead of creating a
+``kernel-env.*`` container per kernel just to share its volume, the agent
+populates a named volume per agent version and distro once and mounts it
+read-only to all kernel containers.
+
+Since the volume is read-only, the mount points of the runner files which
+are bind-mounted over it must already exist in the volume.  They are created
+as empty stubs when populating the volume.
+
+The host paths of those runner files are resolved once per distro by
+:class:`RunnerMounts` so that creating a kernel does not look them up again.
+'''
+
+import asyncio
+import io
+import logging
+from pathlib import Path
+import platform
+import tarfile
+from typing import Dict, List, Tuple
+
+import aiodocker
+from aiodocker.exceptions import DockerError
+
+from ai.backend.common.logging import BraceStyleAdapter
+from . import __version__ as VERSION
+from .governor import DockerGovernor
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.krunner'))
+
+krunner_path = '/opt/backend.ai'
+krunner_image_prefix = 'lablup/backendai-krunner-env'
+ready_marker = '.krunner-ready'
+
+# The mount points (relative to krunner_path) of the runner files and
+# directories bind-mounted over the volume.
+stub_files = [
+    'bin/entrypoint.sh',
+    'bin/su-exec',
+    'bin/jail',
+    'hook/libbaihook.so',
+]
+stub_dirs = [
+    'lib/python3.6/site-packages/ai/backend/kernel',
+    'lib/python3.6/site-packages/ai/backend/helpers',
+]
+
+# The ai.backend namespace package directory of this installation, which
+# contains the runner files and the kernel and helpers packages.
+backend_pkg_path = Path(__file__).resolve().parent.parent
+
+
+def get_krunner_image(distro: str) -> str:
+    return f'{krunner_image_prefix}:{VERSION}-{distro}'
+
+
+def get_krunner_volume_name(distro: str) -> str:
+    return f'backendai-krunner.{VERSION}.{distro}'
+
+
+def _build_stub_archive() -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for path in stub_dirs:
+            info = tarfile.TarInfo(path)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+        for path in [*stub_files, ready_marker]:
+            info = tarfile.TarInfo(path)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(b''))
+    return buf.getvalue()
+
+
+class KrunnerVolumes:
+    '''
+    Prepares the shared kernel runner environment volumes on demand, once
+    per distro.
+    '''
+
+    def __init__(self, docker: aiodocker.Docker, *,
+                 governor: DockerGovernor,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.docker = docker
+        self.governor = governor
+        self._volumes: Dict[str, asyncio.Task] = {}
+
+    async def prepare_all(self):
+        '''
+        Prepare the volumes for all krunner-env images of this agent version
+        available in the host.
+        '''
+        async with self.governor.lane('inspect'):
+            images = await self.docker.images.list()
+        distros = set()
+        prefix = f'{krunner_image_prefix}:{VERSION}-'
+        for image in images:
+            for tag in (image.get('RepoTags') or []):
+                if tag.startswith(prefix):
+                    distros.add(tag[len(prefix):])
+        for distro in sorted(distros):
+            try:
+                await self.get(distro)
+            except DockerError as e:
+                log.warning('cannot prepare the krunner volume for {0}: {1!r}',
+                            distro, e)
+
+    async def get(self, distro: str) -> str:
+        '''
+        Return the name of the volume for the given distro, preparing it if
+        it is not ready yet.
+        '''
+        task = self._volumes.get(distro)
+        if task is None or (task.done() and task.exception() is not None):
+            task = self.loop.create_task(self._prepare(distro))
+            self._volumes[distro] = task
+        return await asyncio.shield(task)
+
+    async def _prepare(self, distro: str) -> str:
+        name = get_krunner_volume_name(distro)
+        image = get_krunner_image(distro)
+        # Creating a container mounting an empty named volume over the
+        # image's volume path copies the image contents into the volume.
+        async with self.governor.lane('create'):
+            container = await self.docker.containers.create(config={
+                'Image': image,
+                'HostConfig': {
+                    'Binds': [f'{name}:{krunner_path}:rw'],
+                },
+            })
+        try:
+            try:
+                await container.get_archive(f'{krunner_path}/{ready_marker}')
+                log.debug('using the existing krunner volume {0}', name)
+                return name
+            except DockerError as e:
+                if e.status != 404:
+                    raise
+            log.info('populating the krunner volume {0} from {1}', name, image)
+            await container.put_archive(krunner_path, _build_stub_archive())
+            return name
+        finally:
+            async with self.governor.lane('delete'):
+                await container.delete(force=True)
+
+
+class RunnerMounts:
+    '''
+    The table of the runner files to bind-mount into the kernel containers,
+    resolved once per distro.
+    '''
+
+    def __init__(self, *,
+                 base_path: Path = backend_pkg_path,
+                 arch: str = None):
+        self.base_path = base_path
+        self.arch = arch if arch else platform.machine()
+        self._table: Dict[str, List[Tuple[Path, str]]] = {}
+
+    @property
+    def runner_path(self) -> Path:
+        return self.base_path / 'runner'
+
+    def known_distros(self) -> List[str]:
+        '''
+        Return the distros which have the runner binaries in this
+        installation.
+        '''
+        return sorted(p.name[len('su-exec.'):-len('.bin')]
+                      for p in self.runner_path.glob('su-exec.*.bin'))
+
+    def prepare(self):
+        '''
+        Resolve the mount table of all known distros, warning about the
+        missing runner files.
+        '''
+        for distro in self.known_distros():
+            self.get(distro)
+
+    def get(self, distro: str) -> List[Tuple[Path, str]]:
+        '''
+        Return the pairs of the host path and the container path of the
+        runner files for the given distro.  The missing files are excluded
+        as Docker would create empty directories in their places.
+        '''
+        mounts = self._table.get(distro)
+        if mounts is None:
+            mounts = []
+            for host_path, container_path in self._candidates(distro):
+                host_path = host_path.resolve()
+                if host_path.exists():
+                    mounts.append((host_path, container_path))
+                else:
+                    log.warning('missing runner file for {0}: {1}',
+                                distro, host_path)
+            self._table[distro] = mounts
+        return mounts
+
+    def _candidates(self, distro: str) -> List[Tuple[Path, str]]:
+        runner_path = self.runner_path
+        site_pkg_path = f'{krunner_path}/lib/python3.6/site-packages/ai/backend'
+        return [
+            (runner_path / 'entrypoint.sh',
+             f'{krunner_path}/bin/entrypoint.sh'),
+            (runner_path / f'su-exec.{distro}.bin',
+             f'{krunner_path}/bin/su-exec'),
+            (runner_path / f'jail.{distro}.bin',
+             f'{krunner_path}/bin/jail'),
+            (runner_path / f'libbaihook.{distro}.{self.arch}.so',
+             f'{krunner_path}/hook/libbaihook.so'),
+            (self.base_path / 'kernel', f'{site_pkg_path}/kernel'),
+            (self.base_path / 'helpers', f'{site_pkg_path}/helpers'),
+        ]
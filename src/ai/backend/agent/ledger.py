@@ -0,0 +1,160 @@
+'''
+A persistent journal of the resource allocations of kernels.
+
+The CPU cores, accelerator shares and host ports allocated to the kernels
+live in memory.  :class:`AllocationLedger` appends every change of them to a
+SQLite database in the WAL mode, so that the agent can restore them after a
+restart by reading the journal sequentially, and detect the allocations
+leaked by a crash by reconciling the journal against the running containers.
+
+Each record carries a CRC32 checksum of its content.  The corrupted records
+are skipped during the replay.  :meth:`AllocationLedger.compact` rewrites the
+journal with only the live allocations.
+'''
+
+import json
+import logging
+from pathlib import Path
+import sqlite3
+from typing import Dict, Iterable, List, Optional
+import zlib
+
+import attr
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .resources import KernelResourceSpec
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.ledger'))
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kernel_id TEXT NOT NULL,
+    op TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    checksum INTEGER NOT NULL
+)
+'''
+
+
+@attr.s(auto_attribs=True, slots=True)
+class Allocation:
+    kernel_id: str
+    resource_spec: KernelResourceSpec
+    host_ports: List[int]
+    container_id: Optional[str] = None
+
+
+def _checksum(kernel_id: str, op: str, payload: str) -> int:
+    return zlib.crc32(f'{kernel_id}\0{op}\0{payload}'.encode('utf8'))
+
+
+class AllocationLedger:
+    '''
+    An append-only journal of the kernel resource allocations.
+
+    The writes are synchronous but cheap, as the WAL mode with
+    ``synchronous=NORMAL`` does not sync the disk for each commit.  The
+    database stays consistent on crashes, losing at most the last few
+    records on power failures.
+    '''
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        self._conn = sqlite3.connect(str(self.path), isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(_schema)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _append(self, kernel_id: str, op: str, payload: str = ''):
+        if self._conn is None:
+            return
+        self._conn.execute(
+            'INSERT INTO journal (kernel_id, op, payload, checksum) '
+            'VALUES (?, ?, ?, ?)',
+            (kernel_id, op, payload, _checksum(kernel_id, op, payload)))
+
+    def record_alloc(self, kernel_id: str,
+                     resource_spec: KernelResourceSpec,
+                     host_ports: Iterable[int]):
+        '''
+        Record the resources allocated to the kernel, replacing the previous
+        allocation of the same kernel if any.
+        '''
+        payload = json.dumps({
+            'resource_spec': resource_spec.to_json(),
+            'host_ports': list(host_ports),
+        })
+        self._append(kernel_id, 'alloc', payload)
+
+    def record_container(self, kernel_id: str, container_id: str):
+        '''
+        Record the container which the kernel's allocation belongs to.
+        '''
+        self._append(kernel_id, 'container', container_id)
+
+    def record_free(self, kernel_id: str):
+        '''
+        Record that the resources of the kernel are released.
+        '''
+        self._append(kernel_id, 'free')
+
+    def load(self) -> Dict[str, Allocation]:
+        '''
+        Replay the journal and return the live allocations by kernel IDs.
+        '''
+        allocations: Dict[str, Allocation] = {}
+        if self._conn is None:
+            return allocations
+        num_corrupted = 0
+        cursor = self._conn.execute(
+            'SELECT kernel_id, op, payload, checksum FROM journal ORDER BY seq')
+        for kernel_id, op, payload, checksum in cursor:
+            if _checksum(kernel_id, op, payload) != checksum:
+                num_corrupted += 1
+                continue
+            try:
+                if op == 'alloc':
+                    o = json.loads(payload)
+                    allocations[kernel_id] = Allocation(
+                        kernel_id,
+                        KernelResourceSpec.from_json(o['resource_spec']),
+                        o['host_ports'])
+                elif op == 'container':
+                    if kernel_id in allocations:
+                        allocations[kernel_id].container_id = payload
+                elif op == 'free':
+                    allocations.pop(kernel_id, None)
+            except (ValueError, KeyError, TypeError):
+                num_corrupted += 1
+        if num_corrupted > 0:
+            log.warning('skipped {0} corrupted allocation records',
+                        num_corrupted)
+        return allocations
+
+    def compact(self, allocations: Iterable[Allocation]):
+        '''
+        Rewrite the journal with only the given allocations.
+        '''
+        if self._conn is None:
+            return
+        self._conn.execute('BEGIN')
+        try:
+            self._conn.execute('DELETE FROM journal')
+            for alloc in allocations:
+                self.record_alloc(alloc.kernel_id, alloc.resource_spec,
+                                  alloc.host_ports)
+                if alloc.container_id is not None:
+                    self.record_container(alloc.kernel_id, alloc.container_id)
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
@@ -0,0 +1,437 @@
+'''
+Enforced size quotas of kernel scratch directories on disk.
+
+Two backends are available:
+
+* :class:`ProjectQuotaBackend` assigns a project ID to the scratch and tmp
+  directories of each kernel and limits the project's disk usage using
+  XFS/ext4 project quotas.  The project IDs are recycled from a fixed range,
+  so an allocation costs only a few syscalls.
+
+* :class:`LoopbackQuotaBackend` mounts a per-kernel sparse ext4 image via
+  a loop device on the scratch directory and bind-mounts its sub-directory on
+  the tmp directory.  Formatting an image is slow, so a few images with the
+  default size are pre-created in the background.
+
+A quota is released only after the reaper has deleted the kernel's scratch
+directories, because their remaining files would be charged to the next
+kernel that reuses the same project ID.
+'''
+
+from abc import ABCMeta, abstractmethod
+import asyncio
+import ctypes
+import errno
+import fcntl
+import logging
+import os
+from pathlib import Path
+import secrets
+import shutil
+import struct
+import sys
+from typing import Iterator, List, MutableMapping, Optional, Tuple
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .fs import bind_mount, mount_device
+from .scratch import trash_dir_name
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.quota'))
+
+_libc = None
+if sys.platform == 'linux':
+    try:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    except OSError:
+        pass
+
+# quotactl(2)
+PRJQUOTA = 2
+Q_GETQUOTA = 0x800007
+Q_SETQUOTA = 0x800008
+QIF_BLIMITS = 1
+QIF_DQBLKSIZE = 1024
+
+# ioctl_xfs_fsgetxattr(2)
+FS_IOC_FSGETXATTR = 0x801c581f
+FS_IOC_FSSETXATTR = 0x401c5820
+FS_XFLAG_PROJINHERIT = 0x00000200
+_fsxattr = struct.Struct('IIII')  # the leading fields of struct fsxattr
+_fsxattr_size = 28
+
+# loop(4)
+LOOP_SET_FD = 0x4c00
+LOOP_SET_STATUS64 = 0x4c04
+LOOP_CTL_GET_FREE = 0x4c82
+LO_FLAGS_AUTOCLEAR = 4
+_loop_info64 = struct.Struct('QQQQQIIII64s64s32sQQ')
+
+default_project_id_range = (0x10000, 0x20000)
+
+
+class _IfDqblk(ctypes.Structure):
+    _fields_ = [
+        ('dqb_bhardlimit', ctypes.c_uint64),
+        ('dqb_bsoftlimit', ctypes.c_uint64),
+        ('dqb_curspace', ctypes.c_uint64),
+        ('dqb_ihardlimit', ctypes.c_uint64),
+        ('dqb_isoftlimit', ctypes.c_uint64),
+        ('dqb_curinodes', ctypes.c_uint64),
+        ('dqb_btime', ctypes.c_uint64),
+        ('dqb_itime', ctypes.c_uint64),
+        ('dqb_valid', ctypes.c_uint32),
+    ]
+
+
+def _qcmd(cmd: int, qtype: int) -> int:
+    return ctypes.c_int((cmd << 8) | (qtype & 0xff)).value
+
+
+def _quotactl(cmd: int, device: str, qid: int, dqblk: _IfDqblk):
+    if _libc is None:
+        raise OSError(errno.ENOSYS, 'quotactl is not available', device)
+    ret = _libc.quotactl(_qcmd(cmd, PRJQUOTA), os.fsencode(device),
+                         qid, ctypes.byref(dqblk))
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), device)
+
+
+def find_mount(path: Path) -> Optional[Tuple[str, str, Path]]:
+    '''
+    Return the device, the filesystem type, and the mount point of the mount
+    containing the given path.
+    '''
+    path = path.resolve()
+    found = None
+    with open('/proc/self/mountinfo', 'r') as f:
+        for line in f:
+            fields = line.split()
+            sep = fields.index('-')
+            mount_point = Path(fields[4].encode().decode('unicode_escape'))
+            fstype, device = fields[sep + 1], fields[sep + 2]
+            if path == mount_point or mount_point in path.parents:
+                if found is None or len(mount_point.parts) >= len(found[2].parts):
+                    found = (device, fstype, mount_point)
+    return found
+
+
+def get_project_id(path: Path) -> int:
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        buf = bytearray(_fsxattr_size)
+        fcntl.ioctl(fd, FS_IOC_FSGETXATTR, buf)
+        return _fsxattr.unpack_from(buf)[3]
+    finally:
+        os.close(fd)
+
+
+def set_project_id(path: Path, project_id: int):
+    '''
+    Set the project ID of the directory and make its new children inherit it.
+    '''
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        buf = bytearray(_fsxattr_size)
+        fcntl.ioctl(fd, FS_IOC_FSGETXATTR, buf)
+        xflags, extsize, nextents, _ = _fsxattr.unpack_from(buf)
+        _fsxattr.pack_into(buf, 0, xflags | FS_XFLAG_PROJINHERIT,
+                           extsize, nextents, project_id)
+        fcntl.ioctl(fd, FS_IOC_FSSETXATTR, buf)
+    finally:
+        os.close(fd)
+
+
+class AbstractQuotaBackend(metaclass=ABCMeta):
+
+    #: Whether the scratch directories are mount points to be unmounted
+    #: before deleting them.
+    needs_umount = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def acquire(self, kernel_id: str,
+                      scratch_dir: Path, tmp_dir: Path, size: int):
+        '''
+        Limit the total size of the given (empty) scratch and tmp directories
+        of a kernel to the given size in bytes.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    async def release(self, kernel_id: str):
+        '''
+        Release the quota after the scratch directories are deleted.
+        '''
+        raise NotImplementedError
+
+    async def release_leftover(self, path: Path):
+        '''
+        Release the quota held by a scratch directory left in the trash area
+        by the previous run, after the reaper has deleted it.
+        '''
+        pass
+
+
+class ProjectQuotaBackend(AbstractQuotaBackend):
+
+    def __init__(self, scratch_root: Path, device: str, *,
+                 project_id_range: Tuple[int, int] = default_project_id_range,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.scratch_root = scratch_root
+        self.device = device
+        self.project_id_range = project_id_range
+        self._free_ids: List[int] = []
+        self._allocated: MutableMapping[str, int] = {}
+        self._leftovers: MutableMapping[Path, int] = {}
+
+    @classmethod
+    def is_available(cls, scratch_root: Path) -> Optional[str]:
+        '''
+        Return the block device of the scratch root if project quotas are
+        enabled there.
+        '''
+        if _libc is None:
+            return None
+        try:
+            mount = find_mount(scratch_root)
+            if mount is None or mount[1] not in ('xfs', 'ext4'):
+                return None
+            _quotactl(Q_GETQUOTA, mount[0], 0, _IfDqblk())
+            get_project_id(scratch_root)
+        except OSError:
+            return None
+        return mount[0]
+
+    def _scan_project_ids(self, root: Path) -> Iterator[Tuple[str, int]]:
+        begin, end = self.project_id_range
+        for entry in os.scandir(root):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                project_id = get_project_id(Path(entry.path))
+            except OSError:
+                continue
+            if begin <= project_id < end:
+                yield entry.name, project_id
+
+    async def start(self):
+        begin, end = self.project_id_range
+        for name, project_id in self._scan_project_ids(self.scratch_root):
+            kernel_id = name[:-4] if name.endswith('_tmp') else name
+            self._allocated[kernel_id] = project_id
+        trash_root = self.scratch_root / trash_dir_name
+        if trash_root.is_dir():
+            # The trashed directories are still charged to their projects
+            # until the reaper deletes them.
+            for name, project_id in self._scan_project_ids(trash_root):
+                self._leftovers[trash_root / name] = project_id
+        in_use = {*self._allocated.values(), *self._leftovers.values()}
+        # Pop from the end so that lower IDs are used first.
+        self._free_ids = [pid for pid in reversed(range(begin, end))
+                          if pid not in in_use]
+
+    def _set_limit(self, project_id: int, size: int):
+        dqblk = _IfDqblk()
+        dqblk.dqb_bhardlimit = (size + QIF_DQBLKSIZE - 1) // QIF_DQBLKSIZE
+        dqblk.dqb_bsoftlimit = dqblk.dqb_bhardlimit
+        dqblk.dqb_valid = QIF_BLIMITS
+        _quotactl(Q_SETQUOTA, self.device, project_id, dqblk)
+
+    async def acquire(self, kernel_id, scratch_dir, tmp_dir, size):
+        if not self._free_ids:
+            raise RuntimeError('No more project IDs are available '
+                               'for scratch quotas.')
+        project_id = self._free_ids.pop()
+        try:
+            self._set_limit(project_id, size)
+            set_project_id(scratch_dir, project_id)
+            set_project_id(tmp_dir, project_id)
+        except OSError:
+            self._free_ids.append(project_id)
+            raise
+        self._allocated[kernel_id] = project_id
+
+    async def release(self, kernel_id):
+        project_id = self._allocated.pop(kernel_id, None)
+        if project_id is not None:
+            self._free_project_id(project_id)
+
+    async def release_leftover(self, path):
+        project_id = self._leftovers.pop(path, None)
+        if project_id is not None:
+            self._free_project_id(project_id)
+
+    def _free_project_id(self, project_id: int):
+        # The other directories of the same kernel may be still there.
+        if project_id in self._allocated.values() or \
+                project_id in self._leftovers.values():
+            return
+        try:
+            self._set_limit(project_id, 0)  # unlimited
+        except OSError as e:
+            log.warning('cannot reset the quota of project {0}: {1!r}',
+                        project_id, e)
+        self._free_ids.append(project_id)
+
+
+class LoopbackQuotaBackend(AbstractQuotaBackend):
+
+    needs_umount = True
+
+    def __init__(self, image_root: Path, *, size: int, capacity: int = 2,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.image_root = image_root
+        self.size = size
+        self.capacity = capacity
+        self._images: List[Path] = []
+        self._refill_task: asyncio.Task = None
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return (sys.platform == 'linux' and
+                os.path.exists('/dev/loop-control') and
+                shutil.which('mkfs.ext4') is not None)
+
+    def _image_path(self, kernel_id: str) -> Path:
+        return self.image_root / f'{kernel_id}.img'
+
+    async def start(self):
+        self.image_root.mkdir(parents=True, exist_ok=True)
+        # Pooled images may be partially formatted if the agent was killed.
+        for path in self.image_root.glob('pool-*.img'):
+            path.unlink()
+        self._schedule_refill()
+
+    async def stop(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+            self._refill_task = None
+
+    def _schedule_refill(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = self.loop.create_task(self._refill())
+
+    async def _create_image(self, path: Path, size: int):
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        proc = await asyncio.create_subprocess_exec(
+            'mkfs.ext4', '-q', '-F', '-m', '0', '-E', 'nodiscard', str(path),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE)
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            path.unlink()
+            raise RuntimeError(f'mkfs.ext4 failed: {stderr.decode().strip()}')
+
+    async def _refill(self):
+        while len(self._images) < self.capacity:
+            path = self.image_root / f'pool-{secrets.token_hex(8)}.img'
+            try:
+                await self._create_image(path, self.size)
+            except Exception:
+                log.exception('cannot pre-create a scratch image')
+                return
+            self._images.append(path)
+
+    def _attach(self, image: Path) -> Tuple[Path, int]:
+        '''
+        Attach the image to a free loop device and return the device path with
+        its open file descriptor.  The device is detached automatically when
+        the descriptor is closed while it is not mounted.
+        '''
+        ctl_fd = os.open('/dev/loop-control', os.O_RDWR)
+        try:
+            devno = fcntl.ioctl(ctl_fd, LOOP_CTL_GET_FREE)
+        finally:
+            os.close(ctl_fd)
+        device = Path(f'/dev/loop{devno}')
+        loop_fd = os.open(device, os.O_RDWR)
+        try:
+            image_fd = os.open(image, os.O_RDWR)
+            try:
+                fcntl.ioctl(loop_fd, LOOP_SET_FD, image_fd)
+            finally:
+                os.close(image_fd)
+            info = bytearray(_loop_info64.size)
+            _loop_info64.pack_into(info, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                                   LO_FLAGS_AUTOCLEAR,
+                                   os.fsencode(str(image))[:63], b'', b'', 0, 0)
+            fcntl.ioctl(loop_fd, LOOP_SET_STATUS64, info)
+        except BaseException:
+            os.close(loop_fd)
+            raise
+        return device, loop_fd
+
+    async def acquire(self, kernel_id, scratch_dir, tmp_dir, size):
+        image = self._image_path(kernel_id)
+        if size == self.size and self._images:
+            os.rename(self._images.pop(), image)
+        else:
+            log.debug('creating a scratch image of {0} bytes on demand', size)
+            await self._create_image(image, size)
+        self._schedule_refill()
+        try:
+            device, loop_fd = self._attach(image)
+            try:
+                mount_device(device, scratch_dir, 'ext4')
+            finally:
+                # From now on, the loop device is detached automatically
+                # with the last unmount.
+                os.close(loop_fd)
+            tmp_source = scratch_dir / '.tmp'
+            tmp_source.mkdir(mode=tmp_dir.stat().st_mode & 0o7777)
+            bind_mount(tmp_source, tmp_dir)
+        except BaseException:
+            await self.release(kernel_id)
+            raise
+
+    async def release(self, kernel_id):
+        # The image file is freed when the loop device is detached.
+        try:
+            self._image_path(kernel_id).unlink()
+        except FileNotFoundError:
+            pass
+
+
+async def create_quota_backend(backend_name: str, scratch_root: Path, *,
+                               default_size: int,
+                               loop=None) -> Optional[AbstractQuotaBackend]:
+    '''
+    Create a scratch quota backend.
+
+    :param backend_name: One of "none", "auto", "project", and "loopback".
+                         "auto" prefers project quotas when they are enabled
+                         on the filesystem of the scratch root.
+    '''
+    if backend_name == 'none':
+        return None
+    backend: AbstractQuotaBackend = None
+    if backend_name in ('auto', 'project'):
+        device = ProjectQuotaBackend.is_available(scratch_root)
+        if device is not None:
+            backend = ProjectQuotaBackend(scratch_root, device, loop=loop)
+        elif backend_name == 'project':
+            raise RuntimeError('Project quotas are not enabled on '
+                               f'the filesystem of {scratch_root}.')
+    if backend is None and backend_name in ('auto', 'loopback'):
+        if LoopbackQuotaBackend.is_available():
+            backend = LoopbackQuotaBackend(scratch_root / '.scratch-images',
+                                           size=default_size, loop=loop)
+        elif backend_name == 'loopback':
+            raise RuntimeError('Loop devices or mkfs.ext4 are not available.')
+    if backend is None:
+        log.warning('no scratch quota backend is available; '
+                    'the scratch directories are not limited')
+        return None
+    log.info('using {0} for scratch quotas', type(backend).__name__)
+    await backend.start()
+    return backend
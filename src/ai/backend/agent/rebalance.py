@@ -0,0 +1,271 @@
+'''
+Live rebalancing of the CPU sets of running kernels.
+
+The CPU cores of a kernel are chosen once when it is created.  As the other
+kernels come and go, some cores may end up shared by several busy kernels
+while the others sit idle.  :class:`CPURebalancer` periodically looks for
+such contention and moves a few kernels to less loaded cores by updating
+the cpusets of their containers in place.
+
+The load of each core is estimated from the live CPU usage of the kernels
+pinned to it.  A kernel whose usage is not known yet is regarded as keeping
+all of its cores busy.  The overload of a core is its load beyond one busy
+core, and a kernel is moved only if the move reduces the total overload by
+at least ``min_gain`` cores.  A moved kernel is not moved again within
+``cooldown`` seconds, and each run moves at most ``max_moves`` kernels.
+
+The kernels whose image has the ``ai.backend.cpu-rebalance=no`` label are
+never moved.
+'''
+
+import asyncio
+import logging
+import time
+from typing import (
+    Any, Awaitable, Callable, Dict, FrozenSet, Iterable, List, Mapping,
+    Optional, Sequence, Tuple,
+)
+
+import attr
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .cpualloc import TopologyAwareCPUAllocMap
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.rebalance'))
+
+default_max_moves = 2           # per run
+default_min_gain = 0.5          # cores
+default_cooldown = 600.0        # seconds
+
+
+@attr.s(auto_attribs=True, slots=True)
+class KernelPlacement:
+    kernel_id: str
+    cpu_set: FrozenSet[int]
+    numa_nodes: Sequence[int]
+    cpu_used: Optional[float] = None    # the cumulative CPU time in msec
+    cpu_usage: Optional[float] = None   # the number of busy cores
+    movable: bool = True
+
+
+@attr.s(auto_attribs=True, slots=True)
+class CPUMove:
+    kernel_id: str
+    old_cpu_set: FrozenSet[int]
+    old_numa_nodes: List[int]
+    cpu_set: FrozenSet[int]
+    numa_nodes: List[int]
+    gain: float
+
+
+def get_core_nodes(cpu_map) -> Dict[int, int]:
+    '''
+    Return the NUMA nodes of the cores managed by the given CPU allocation
+    map.
+    '''
+    if isinstance(cpu_map, TopologyAwareCPUAllocMap):
+        return {c: info.node for c, info in cpu_map.topology.cores.items()}
+    return {c: node
+            for node, cores in enumerate(cpu_map.core_topo)
+            for c in cores}
+
+
+def _overload(load: float) -> float:
+    return max(0.0, load - 1.0)
+
+
+def get_core_loads(placements: Iterable[KernelPlacement],
+                   core_nodes: Mapping[int, int]) \
+        -> Tuple[Dict[int, float], Dict[int, int]]:
+    '''
+    Return the estimated loads and the number of kernels of the cores.
+    '''
+    loads = {c: 0.0 for c in core_nodes}
+    tenants = {c: 0 for c in core_nodes}
+    for p in placements:
+        per_core = _per_core_usage(p)
+        for c in p.cpu_set:
+            if c in loads:
+                loads[c] += per_core
+                tenants[c] += 1
+    return loads, tenants
+
+
+def _per_core_usage(p: KernelPlacement) -> float:
+    if p.cpu_usage is None:
+        return 1.0
+    return min(p.cpu_usage, len(p.cpu_set)) / len(p.cpu_set)
+
+
+def plan_moves(placements: Sequence[KernelPlacement],
+               core_nodes: Mapping[int, int], *,
+               max_moves: int = default_max_moves,
+               min_gain: float = default_min_gain) -> List[CPUMove]:
+    '''
+    Find up to ``max_moves`` kernels to move and their new CPU sets, most
+    suffering kernels first.
+
+    A kernel is moved within its current NUMA nodes, or to another single
+    node which has enough cores, whichever reduces the overload more.
+    '''
+    loads, tenants = get_core_loads(placements, core_nodes)
+    cores_per_node: Dict[int, List[int]] = {}
+    for c, node in sorted(core_nodes.items()):
+        cores_per_node.setdefault(node, []).append(c)
+    candidates = [
+        p for p in placements
+        if p.movable and p.cpu_set and all(c in core_nodes for c in p.cpu_set)
+    ]
+    moves: List[CPUMove] = []
+    while len(moves) < max_moves:
+        candidates.sort(
+            key=lambda p: -sum(_overload(loads[c]) for c in p.cpu_set))
+        for p in candidates:
+            if sum(_overload(loads[c]) for c in p.cpu_set) < min_gain:
+                # The rest suffer less.
+                return moves
+            move = _find_move(p, loads, tenants, core_nodes, cores_per_node,
+                              min_gain)
+            if move is not None:
+                moves.append(move)
+                candidates.remove(p)
+                break
+        else:
+            break
+    return moves
+
+
+def _find_move(p: KernelPlacement,
+               loads: Dict[int, float],
+               tenants: Dict[int, int],
+               core_nodes: Mapping[int, int],
+               cores_per_node: Mapping[int, List[int]],
+               min_gain: float) -> Optional[CPUMove]:
+    num_cores = len(p.cpu_set)
+    usage = _per_core_usage(p)
+    # Take the kernel out of its cores.
+    for c in p.cpu_set:
+        loads[c] -= usage
+        tenants[c] -= 1
+    cost = sum(_overload(loads[c] + usage) for c in p.cpu_set)
+    node_groups = [sorted(p.numa_nodes)]
+    node_groups.extend([n] for n, cores in cores_per_node.items()
+                       if n not in p.numa_nodes and len(cores) >= num_cores)
+    best_cost, best_set = cost, frozenset(p.cpu_set)
+    for nodes in node_groups:
+        cores = [c for n in nodes for c in cores_per_node.get(n, [])]
+        if len(cores) < num_cores:
+            continue
+        # Prefer the current cores among the equally loaded ones.
+        cores.sort(key=lambda c: (loads[c], tenants[c], c not in p.cpu_set, c))
+        new_cores = cores[:num_cores]
+        new_cost = sum(_overload(loads[c] + usage) for c in new_cores)
+        if new_cost < best_cost:
+            best_cost, best_set = new_cost, frozenset(new_cores)
+    if cost - best_cost < min_gain:
+        best_set = frozenset(p.cpu_set)
+    for c in best_set:
+        loads[c] += usage
+        tenants[c] += 1
+    if best_set == p.cpu_set:
+        return None
+    return CPUMove(p.kernel_id, frozenset(p.cpu_set), list(p.numa_nodes),
+                   best_set, sorted({core_nodes[c] for c in best_set}),
+                   cost - best_cost)
+
+
+class CPURebalancer:
+    '''
+    Periodically moves the kernels on contended CPU cores to less loaded
+    ones.
+
+    The given ``repin_func`` applies a move to the kernel and its container,
+    and returns whether it has succeeded.
+
+    The total overload of the cores and the number of moved kernels are
+    reported as the ``ai.backend.agent.cpu.overload`` and
+    ``ai.backend.agent.cpu.rebalanced`` gauges.
+    '''
+
+    def __init__(self, repin_func: Callable[[CPUMove], Awaitable[bool]], *,
+                 cpu_map: Any,
+                 max_moves: int = default_max_moves,
+                 min_gain: float = default_min_gain,
+                 cooldown: float = default_cooldown,
+                 stats_monitor=None):
+        self.repin_func = repin_func
+        self.core_nodes = get_core_nodes(cpu_map)
+        self.max_moves = max_moves
+        self.min_gain = min_gain
+        self.cooldown = cooldown
+        self.stats_monitor = stats_monitor
+        self.num_moved = 0
+        self._last_moved: Dict[str, float] = {}
+        self._samples: Dict[str, Tuple[float, float]] = {}
+        self._lock = asyncio.Lock()
+
+    def _estimate_usage(self, p: KernelPlacement, now: float) -> KernelPlacement:
+        # The average usage since the last run, in the number of busy cores.
+        if p.cpu_used is None:
+            return p
+        prev = self._samples.get(p.kernel_id)
+        self._samples[p.kernel_id] = (now, p.cpu_used)
+        if prev is None or now <= prev[0] or p.cpu_used < prev[1]:
+            return p
+        usage = (p.cpu_used - prev[1]) / ((now - prev[0]) * 1000)
+        return attr.evolve(p, cpu_usage=usage)
+
+    def _report_stats(self, overload: float):
+        if self.stats_monitor is None:
+            return
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.cpu.overload', overload)
+        self.stats_monitor.report_stats(
+            'gauge', 'ai.backend.agent.cpu.rebalanced', self.num_moved)
+
+    async def rebalance(self, placements: Iterable[KernelPlacement]) \
+            -> List[CPUMove]:
+        '''
+        Move the kernels on the contended cores and return the applied
+        moves.  It is no-op while the previous run is still in progress.
+        '''
+        if self._lock.locked():
+            return []
+        async with self._lock:
+            now = time.monotonic()
+            placements = [self._estimate_usage(p, now) for p in placements]
+            live = {p.kernel_id for p in placements}
+            self._samples = {k: v for k, v in self._samples.items() if k in live}
+            self._last_moved = {
+                k: t for k, t in self._last_moved.items()
+                if k in live and now - t < self.cooldown
+            }
+            placements = [
+                attr.evolve(p, movable=False)
+                if p.kernel_id in self._last_moved else p
+                for p in placements
+            ]
+            loads, _ = get_core_loads(placements, self.core_nodes)
+            moves = plan_moves(placements, self.core_nodes,
+                               max_moves=self.max_moves,
+                               min_gain=self.min_gain)
+            applied = []
+            for move in moves:
+                try:
+                    done = await self.repin_func(move)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception('failed to move the kernel {0}',
+                                  move.kernel_id)
+                    done = False
+                # Do not retry the failed moves right away either.
+                self._last_moved[move.kernel_id] = time.monotonic()
+                if done:
+                    log.info('moved the kernel {0} to the cores {1} '
+                             '(overload -{2:.2f})', move.kernel_id,
+                             sorted(move.cpu_set), move.gain)
+                    self.num_moved += 1
+                    applied.append(move)
+            self._report_stats(sum(map(_overload, loads.values())))
+            return applied
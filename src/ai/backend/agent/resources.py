@@ -1,20 +1,19 @@
-from collections import defaultdict
-from decimal import Decimal, ROUND_DOWN
+from decimal import Decimal
 import enum
 import io
 import json
 import logging
 import operator
 from pathlib import Path
-import pkg_resources
 import sys
-from typing import Container, Collection, Mapping, Sequence
+from typing import Container, Dict, Mapping, Sequence
 
 import attr
 import psutil
 
 from ai.backend.common.utils import readable_size_to_bytes
-from .accelerator import AbstractAcceleratorInfo, ProcessorIdType, accelerator_types
+from .accelalloc import AcceleratorAllocMap  # noqa: F401
+from .accelerator import ProcessorIdType, accelerator_types
 from .vendor.linux import libnuma
 
 log = logging.getLogger('ai.backend.agent.resources')
@@ -54,6 +53,7 @@ class KernelResourceSpec:
     shares: Mapping[str, Container[Share]]
     memory_limit: int = None
     numa_node: int = None
+    numa_nodes: Sequence[int] = attr.Factory(list)
     cpu_set: Container[int] = attr.Factory(set)
     mounts: Sequence[str] = attr.Factory(list)
     scratch_disk_size: int = None
@@ -68,7 +68,9 @@ class KernelResourceSpec:
             f'{num_bytes // (2 ** 20)}M'
             if num_bytes > (2 ** 20) else f'{num_bytes}')
         cpu_set_str = ','.join(sorted(map(str, self.cpu_set)))
+        numa_nodes_str = ','.join(map(str, self.numa_nodes))
         file.write(f'NUMA_NODE={self.numa_node}\n')
+        file.write(f'NUMA_NODES={numa_nodes_str}\n')
         file.write(f'CPU_CORES={cpu_set_str}\n')
         file.write(f'MEMORY_LIMIT={mega(self.memory_limit)}\n')
         file.write(f'SCRATCH_SIZE={mega(self.scratch_disk_size)}\n')
@@ -110,8 +112,15 @@ class KernelResourceSpec:
                         share_details[dev_id] = dev_share
                 shares[share_type] = share_details
         mounts = [Mount.from_str(m) for m in kvpairs['MOUNTS'].split(',') if m]
+        numa_node = int(kvpairs['NUMA_NODE'])
+        if 'NUMA_NODES' in kvpairs:
+            numa_nodes = [int(n) for n in kvpairs['NUMA_NODES'].split(',') if n]
+        else:
+            # written by older versions
+            numa_nodes = [numa_node]
         return cls(
-            numa_node=int(kvpairs['NUMA_NODE']),
+            numa_node=numa_node,
+            numa_nodes=numa_nodes,
             cpu_set=set(map(int, kvpairs['CPU_CORES'].split(','))),
             memory_limit=readable_size_to_bytes(kvpairs['MEMORY_LIMIT']),
             scratch_disk_size=readable_size_to_bytes(kvpairs['SCRATCH_SIZE']),
@@ -133,6 +142,36 @@ class KernelResourceSpec:
         o['mounts'] = list(map(str, self.mounts))
         return json.dumps(o)
 
+    @classmethod
+    def from_json(cls, s: str):
+        '''
+        Read resource specification values from a JSON string produced by
+        :meth:`to_json`.
+        '''
+        o = json.loads(s)
+        shares = {}
+        for share_type, val in o['shares'].items():
+            if share_type in cls.reserved_share_types:
+                shares[share_type] = Decimal(val)
+                continue
+            share_details = {}
+            for dev_id, dev_share in val.items():
+                try:
+                    dev_id = int(dev_id)
+                except ValueError:
+                    pass
+                share_details[dev_id] = Decimal(dev_share)
+            shares[share_type] = share_details
+        return cls(
+            numa_node=o['numa_node'],
+            numa_nodes=o.get('numa_nodes', [o['numa_node']]),
+            cpu_set=set(o['cpu_set']),
+            memory_limit=o['memory_limit'],
+            scratch_disk_size=o['scratch_disk_size'],
+            shares=shares,
+            mounts=[Mount.from_str(m) for m in o['mounts']],
+        )
+
 
 class CPUAllocMap:
 
@@ -157,11 +196,30 @@ class CPUAllocMap:
         This method guarantees that all cores are alloacted within the same
         NUMA node.
         '''
-        node, current_alloc = min(
+        node, _ = min(
             ((n, alloc) for n, alloc in self.alloc_per_node.items()),
             key=operator.itemgetter(1))
-        self.alloc_per_node[node] = current_alloc + num_cores
+        return node, self.alloc_from(node, num_cores)
 
+    def alloc_multi_node(self, num_cores):
+        '''
+        Find a most free set of CPU cores like :meth:`alloc`, but span the
+        allocation evenly across the minimum number of NUMA nodes if the
+        requested cores do not fit in the node.  Return a tuple of the list
+        of NUMA node indices and the set of the found cores.
+        '''
+        node_sizes = {n: len(self.core_shares[n]) for n in self.alloc_per_node}
+        plan = plan_multi_node(num_cores, node_sizes, self.alloc_per_node)
+        cores = set()
+        for node, count in plan.items():
+            cores |= self.alloc_from(node, count)
+        return sorted(plan), cores
+
+    def alloc_from(self, node, num_cores):
+        '''
+        Find a most free set of CPU cores in the given NUMA node.
+        '''
+        self.alloc_per_node[node] += num_cores
         shares = self.core_shares[node].copy()
         allocated_cores = set()
         for _ in range(num_cores):
@@ -170,100 +228,63 @@ class CPUAllocMap:
             allocated_cores.add(core)
             shares[core] = sys.maxsize   # prune allocated one
             self.core_shares[node][core] += 1  # update the original share
-        return node, allocated_cores
+        return allocated_cores
 
     def update(self, core_set):
         '''
         Manually add a given core set as if it is allocated by us.
         '''
-        any_core = next(iter(core_set))
-        node = libnuma.node_of_cpu(any_core)
-        self.alloc_per_node[node] += len(core_set)
         for c in core_set:
+            node = libnuma.node_of_cpu(c)
+            self.alloc_per_node[node] += 1
             self.core_shares[node][c] += 1
 
     def free(self, core_set):
         '''
         Remove the given set of CPU cores from the allocated shares.
-        It assumes that all cores are in the same NUMA node.
         '''
-        any_core = next(iter(core_set))
-        node = libnuma.node_of_cpu(any_core)
-        self.alloc_per_node[node] -= len(core_set)
         for c in core_set:
+            node = libnuma.node_of_cpu(c)
+            self.alloc_per_node[node] -= 1
             self.core_shares[node][c] -= 1
 
 
-class AcceleratorAllocMap:
-
-    def __init__(self,
-                 devices: Collection[AbstractAcceleratorInfo],
-                 limit_mask: Container[ProcessorIdType] = None):
-        self._quantum = Decimal('.01')
-        self.limit_mask = limit_mask
-        self.devices = {dev.device_id: dev for dev in devices}
-        zero = Decimal('0')
-        self.device_shares = {
-            p.device_id: zero for p in devices
-            if limit_mask is None or p.device_id in limit_mask
-        }
-
-    def alloc(self, requested_share: Decimal, node: int = None):
-        requested_share = Decimal(requested_share) \
-                          .quantize(self._quantum, ROUND_DOWN)
-        if node is None:
-            # try finding a node, but this also may return "None"
-            node = self._find_most_free_node()
-        remaining_share = requested_share
-        zero = Decimal('0')
-        assert requested_share > zero, \
-               'You cannot allocate zero share of devices.'
-        allocated_shares = defaultdict(lambda: zero)
-        try:
-            # try filling up beginning from largest free shares
-            # TODO: apply advanced scheduling and make it replacible
-            while remaining_share > zero:
-                p, s = self._find_largest_free_share(node)
-                if s >= remaining_share:  # shortcut
-                    self.device_shares[p] += remaining_share
-                    allocated_shares[p] += remaining_share
-                    remaining_share = zero
-                elif s == 0:
-                    raise RuntimeError('Cannot allocate requested shares '
-                                       f'in NUMA node {node}')
-                else:  # s < remaining_share
-                    self.device_shares[p] += s
-                    allocated_shares[p] += s
-                    remaining_share -= s
-        except RuntimeError:
-            # revert back
-            for p, s in allocated_shares.items():
-                self.device_shares[p] -= s
-            raise
-        return node, allocated_shares
-
-    def free(self, allocated_shares: Mapping[ProcessorIdType, Decimal]):
-        for proc, share in allocated_shares.items():
-            self.device_shares[proc] -= share
-
-    def _find_most_free_node(self):
-        zero = Decimal('0')
-        per_node_allocs = defaultdict(lambda: zero)
-        for p, s in self.device_shares.items():
-            per_node_allocs[self.devices[p].numa_node] += s
-        node, _ = min(
-            ((n, alloc) for n, alloc in per_node_allocs.items()),
-            key=operator.itemgetter(1))
-        return node
+def plan_multi_node(num_cores: int,
+                    node_sizes: Mapping[int, int],
+                    node_loads: Mapping[int, int]) -> Dict[int, int]:
+    '''
+    Decide the number of cores to allocate from each NUMA node.
 
-    def _find_largest_free_share(self, node: int = None):
-        shares = [
-            (proc, self.devices[proc].max_share() - share)
-            for proc, share in self.device_shares.items()
-            if node is None or self.devices[proc].numa_node == node
-        ]
-        largest_proc_share = max(shares, key=operator.itemgetter(1))
-        return largest_proc_share
+    If the least loaded node has enough cores, all cores come from it.
+    Otherwise, the cores are balanced across the minimum number of nodes
+    which have enough cores in total, choosing the least loaded ones.
+    '''
+    node = min(node_loads, key=lambda n: (node_loads[n], n))
+    if num_cores <= node_sizes[node]:
+        return {node: num_cores}
+    largest = sorted(node_sizes.values(), reverse=True)
+    num_nodes = len(largest)
+    for idx in range(len(largest)):
+        if sum(largest[:idx + 1]) >= num_cores:
+            num_nodes = idx + 1
+            break
+    candidates = sorted(node_sizes, key=lambda n: (node_loads[n], n))
+    nodes = candidates[:num_nodes]
+    if sum(node_sizes[n] for n in nodes) < num_cores:
+        nodes = sorted(node_sizes,
+                       key=lambda n: (-node_sizes[n], node_loads[n], n))[:num_nodes]
+    # Fill the nodes evenly, smaller ones first so that their shortfall
+    # moves to the larger ones.  The request beyond the total size is not
+    # allocated.
+    plan = {}
+    remaining = num_cores
+    nodes.sort(key=lambda n: (node_sizes[n], n))
+    for idx, n in enumerate(nodes):
+        num_left = len(nodes) - idx
+        count = min(node_sizes[n], -(-remaining // num_left))
+        plan[n] = count
+        remaining -= count
+    return plan
 
 
 def bitmask2set(mask):
@@ -290,6 +311,7 @@ async def detect_slots(etcd, limit_cpus=None, limit_gpus=None):
         'mem': mem_bytes >> 20,  # MiB
         'cpu': num_cores,        # core count
     }
+    import pkg_resources  # imported lazily as it is slow to load
     entry_prefix = 'backendai_accelerator_v10'
     for entrypoint in pkg_resources.iter_entry_points(entry_prefix):
         log.info(f'loading accelerator plugin: {entrypoint.module_name}')
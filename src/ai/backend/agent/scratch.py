@@ -0,0 +1,231 @@
+'''
+Asynchronous teardown of kernel scratch directories.
+
+Deleting a large scratch directory may take seconds, which must not block
+the event loop.  :class:`ScratchReaper` atomically renames the directory into
+the trash area inside the scratch root and returns immediately.  A background
+worker deletes the trashed directories one by one in a dedicated thread with
+the lowest CPU priority, limiting the rate of unlink operations so that
+the disk I/O of running kernels is not disturbed.
+
+The trash area is on the same filesystem as the scratch directories, so
+leftovers from a previous run of the agent are reclaimed at startup.
+'''
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import os
+from pathlib import Path
+import secrets
+import sys
+import time
+from typing import Any, Awaitable, Callable, Deque, Tuple
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .fs import destroy_scratch_filesystem
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.scratch'))
+
+Callback = Callable[[], Awaitable[Any]]
+
+trash_dir_name = '.trash'
+default_max_unlink_rate = 2000  # entries per second
+_unlink_batch_size = 100
+
+
+def _lower_priority():
+    if sys.platform == 'linux':
+        # On Linux, this affects only the calling thread.
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, 19)
+        except OSError:
+            pass
+
+
+class ScratchReaper:
+    '''
+    Deletes the scratch directories of terminated kernels in the background.
+
+    :param max_unlink_rate: The maximum number of files and directories to
+                            delete per second.
+    '''
+
+    def __init__(self, scratch_root: Path, *,
+                 stats_monitor=None,
+                 max_unlink_rate: int = default_max_unlink_rate,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.scratch_root = scratch_root
+        self.trash_root = scratch_root / trash_dir_name
+        self.stats_monitor = stats_monitor
+        self.max_unlink_rate = max_unlink_rate
+        self._pending: Deque[Tuple[Path, Callback]] = deque()
+        self._wakeup = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._worker: asyncio.Task = None
+        self._stopping = False
+
+    @property
+    def backlog(self) -> int:
+        return len(self._pending)
+
+    def _report_backlog(self):
+        if self.stats_monitor is not None:
+            self.stats_monitor.report_stats(
+                'gauge', 'ai.backend.agent.scratch_trash.backlog',
+                len(self._pending))
+
+    def _enqueue(self, path: Path, callback: Callback = None):
+        self._pending.append((path, callback))
+        self._report_backlog()
+        self._wakeup.set()
+
+    def start(self, *,
+              leftover_callback: Callable[[Path], Awaitable[Any]] = None):
+        '''
+        Reclaim the leftovers in the trash area and start the worker.
+
+        :param leftover_callback: A coroutine function to call with the path
+                                  of each leftover after deleting it.
+        '''
+        self.trash_root.mkdir(parents=True, exist_ok=True)
+        leftovers = sorted(self.trash_root.iterdir())
+        if leftovers:
+            log.info('reclaiming {0} leftover scratch directories', len(leftovers))
+        for path in leftovers:
+            callback = None
+            if leftover_callback is not None:
+                callback = functools.partial(leftover_callback, path)
+            self._enqueue(path, callback)
+        self._worker = self.loop.create_task(self._work())
+
+    async def stop(self):
+        '''
+        Stop the worker.  The directories not deleted yet remain in the trash
+        area and will be reclaimed at the next startup.
+        '''
+        self._stopping = True
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        self._executor.shutdown(wait=True)
+
+    async def discard(self, path: Path, *, umount: bool = False,
+                      callback: Callback = None):
+        '''
+        Move the given directory to the trash area and schedule its deletion.
+
+        :param umount: Unmount the filesystem (e.g., tmpfs) mounted on the path
+                       before moving it.
+        :param callback: A coroutine function to call after the directory is
+                         deleted, or has failed to be deleted.
+        '''
+        if umount:
+            try:
+                await destroy_scratch_filesystem(path)
+            except OSError as e:
+                # not mounted (e.g., failed before mounting) or already gone
+                log.debug('umount {0}: {1!r}', path, e)
+        target = self.trash_root / f'{path.name}.{secrets.token_hex(4)}'
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            if callback is not None:
+                await callback()
+            return
+        except OSError as e:
+            # e.g., the path is still a mount point
+            log.warning('cannot move {0} to the trash ({1!r}); '
+                        'deleting it in place', path, e)
+            target = path
+        self._enqueue(target, callback)
+
+    async def join(self):
+        '''
+        Wait until all trashed directories are deleted.
+        '''
+        while self._pending:
+            await asyncio.sleep(0.05)
+
+    async def _work(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            path, callback = self._pending[0]
+            try:
+                await self.loop.run_in_executor(self._executor, self._delete, path)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('failed to delete the scratch directory {0}', path)
+            # Run the callback even if the deletion has failed, as it
+            # releases the resources (e.g., quotas) held for the directory.
+            # The leftovers in the trash area are reclaimed at the next
+            # startup.
+            if callback is not None:
+                try:
+                    await callback()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception('failed to run the callback after deleting '
+                                  'the scratch directory {0}', path)
+            self._pending.popleft()
+            self._report_backlog()
+
+    def _delete(self, path: Path):
+        '''
+        Delete the given directory tree at a limited rate.
+        (runs in the worker thread)
+        '''
+        _lower_priority()
+        count = 0
+        started = time.monotonic()
+
+        def _throttle():
+            nonlocal count, started
+            count += 1
+            if count >= _unlink_batch_size:
+                elapsed = time.monotonic() - started
+                delay = count / self.max_unlink_rate - elapsed
+                if delay > 0:
+                    time.sleep(delay)
+                count = 0
+                started = time.monotonic()
+
+        def _rmtree(dirpath: str):
+            try:
+                entries = list(os.scandir(dirpath))
+            except FileNotFoundError:
+                return
+            for entry in entries:
+                if self._stopping:
+                    return
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        _rmtree(entry.path)
+                        os.rmdir(entry.path)
+                    else:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+                _throttle()
+
+        if path.is_symlink() or not path.is_dir():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return
+        _rmtree(str(path))
+        if not self._stopping:
+            try:
+                os.rmdir(path)
+            except FileNotFoundError:
+                pass
@@ -7,15 +7,12 @@ import json
 import logging, logging.config
 import os, os.path
 from pathlib import Path
-import platform
 from pprint import pformat
-import pkg_resources
 import pwd
 import re
 import secrets
 import shlex
 import signal
-import shutil
 import subprocess
 import time
 import sys
@@ -47,7 +44,7 @@ from ai.backend.common.monitor import DummyStatsMonitor, DummyErrorMonitor
 from ai.backend.common.plugin import install_plugins, add_plugin_args
 from ai.backend.common.types import ImageRef
 from . import __version__ as VERSION
-from .files import scandir, upload_output_files_to_s3
+from .files import upload_files_to_s3, create_upload_engine
 from .accelerator import accelerator_types, AbstractAccelerator
 from .stats import (
     get_preferred_stat_type, collect_agent_live_stats,
@@ -58,11 +55,28 @@ from .resources import (
     Mount, MountPermission,
     bitmask2set, detect_slots,
     CPUAllocMap,
-    AcceleratorAllocMap,
 )
+from .accelalloc import AcceleratorAllocMap, alloc_strategies
+from .cpualloc import CPUTopology, TopologyAwareCPUAllocMap, alloc_policies
 from .kernel import KernelRunner, KernelFeatures
-from .utils import update_nested_dict
-from .fs import create_scratch_filesystem, destroy_scratch_filesystem
+from .dedup import ContentIndex
+from .upload import UploadSessionManager
+from .uploader import OutputUploadQueue
+from .watcher import OutputChangeTracker
+from .utils import RecentKeys, update_nested_dict
+from .cleanup import ContainerDeleter, KernelCleanupQueue
+from .events import EventOutbox
+from .images import ImageCache, ImagePrefetcher, get_desired_images
+from .ledger import Allocation, AllocationLedger
+from .rebalance import CPURebalancer, KernelPlacement
+from .density import (
+    CPUDeflator, IdleCandidate, MemoryReclaimer, cpu_period, get_cpu_quota,
+)
+from .fs import TmpfsPool, split_scratch_budget
+from .governor import DockerGovernor
+from .krunner import KrunnerVolumes, RunnerMounts, krunner_path
+from .quota import create_quota_backend
+from .scratch import ScratchReaper
 from .vendor.linux import libnuma
 
 log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.server'))
@@ -83,6 +97,7 @@ class RestartTracker:
     request_lock: asyncio.Lock
     destroy_event: asyncio.Event
     done_event: asyncio.Event
+    in_place: bool = False
 
 
 @attr.s(auto_attribs=True, slots=True)
@@ -102,6 +117,9 @@ deeplearning_sample_volume = VolumeInfo(
     'deeplearning-samples', '/home/work/samples', 'ro',
 )
 
+kernel_id_label = 'ai.backend.kernel-id'
+monitored_docker_actions = ['die']
+
 
 async def get_extra_volumes(docker, lang):
     avail_volumes = (await docker.volumes.list())['Volumes']
@@ -155,6 +173,21 @@ async def get_kernel_id_from_container(val):
         return None
 
 
+def get_docker_event_filters(match_label: bool = True) -> str:
+    '''
+    Return the Docker event filters to receive only the events of kernel
+    containers that we handle.  The kernel containers created by older
+    versions of the agent do not have the kernel ID label.
+    '''
+    filters = {
+        'type': ['container'],
+        'event': monitored_docker_actions,
+    }
+    if match_label:
+        filters['label'] = [kernel_id_label]
+    return json.dumps(filters)
+
+
 def get_label(labels: Mapping[str, str], name, default):
     sentinel = object()
     v = labels.get(f'ai.backend.{name}', sentinel)
@@ -207,11 +240,19 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         'docker', 'container_registry', 'container_cpu_map',
         'redis_stat_pool',
         'etcd', 'config', 'slots', 'images',
-        'rpc_server', 'event_sock',
+        'rpc_server', 'event_sock', 'event_outbox',
         'monitor_fetch_task', 'monitor_handle_task', 'stat_collector_task',
         'hb_timer', 'clean_timer',
         'stats_monitor', 'error_monitor',
-        'restarting_kernels', 'blocking_cleans',
+        'restarting_kernels', 'creating_kernels', 'blocking_cleans',
+        'upload_sessions', 'upload_engine', 'output_uploads',
+        'scratch_reaper', 'tmpfs_pool', 'scratch_quota',
+        'docker_governor', 'unlabeled_kernels',
+        'container_deleter', 'cleanup_queue', 'krunner_volumes',
+        'runner_mounts', 'image_prefetcher', 'image_prefetch_timer',
+        'image_cache', 'image_evict_timer', 'ledger',
+        'cpu_rebalancer', 'cpu_rebalance_timer',
+        'cpu_deflator', 'memory_reclaimer', 'density_timer',
     )
 
     def __init__(self, config, loop=None):
@@ -225,15 +266,30 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         self.redis_stat_pool = None
 
         self.restarting_kernels = {}
+        self.creating_kernels = set()
         self.blocking_cleans = {}
+        self.unlabeled_kernels = set()
+        self.upload_sessions = UploadSessionManager(config.scratch_root)
+        self.upload_engine = create_upload_engine(content_index=ContentIndex(),
+                                                  loop=self.loop)
 
-        self.container_cpu_map = CPUAllocMap(config.limit_cpus)
+        if config.cpu_alloc_policy == 'legacy':
+            self.container_cpu_map = CPUAllocMap(config.limit_cpus)
+        else:
+            self.container_cpu_map = TopologyAwareCPUAllocMap(
+                CPUTopology.read(config.limit_cpus),
+                policy=config.cpu_alloc_policy)
         self.accelerators = {}
         self.images = set()
 
         self.rpc_server = None
         self.event_sock = None
+        self.event_outbox = None
         self.scan_images_timer = None
+        self.image_prefetch_timer = None
+        self.image_evict_timer = None
+        self.cpu_rebalance_timer = None
+        self.density_timer = None
         self.monitor_fetch_task = None
         self.monitor_handle_task = None
         self.hb_timer = None
@@ -256,6 +312,59 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         ]
         install_plugins(plugins, self, 'attr', self.config)
 
+        self.output_uploads = OutputUploadQueue(
+            functools.partial(upload_files_to_s3, engine=self.upload_engine),
+            notify_func=functools.partial(self.send_event,
+                                          'kernel_output_files_ready'),
+            stats_monitor=self.stats_monitor,
+            loop=self.loop)
+        self.scratch_reaper = ScratchReaper(config.scratch_root,
+                                            stats_monitor=self.stats_monitor,
+                                            loop=self.loop)
+        self.tmpfs_pool = None
+        if sys.platform == 'linux' and self.config.scratch_in_memory:
+            # Pre-mount the work and /tmp directories of the kernels
+            # whose memory limits do not cap the budget.
+            self.tmpfs_pool = TmpfsPool(
+                config.scratch_root / '.tmpfs-pool',
+                sizes=split_scratch_budget(config.scratch_size),
+                loop=self.loop)
+        self.scratch_quota = None
+        self.docker_governor = DockerGovernor(stats_monitor=self.stats_monitor,
+                                              loop=self.loop)
+        self.container_deleter = ContainerDeleter(self.docker,
+                                                  governor=self.docker_governor)
+        self.krunner_volumes = KrunnerVolumes(self.docker,
+                                              governor=self.docker_governor,
+                                              loop=self.loop)
+        self.runner_mounts = RunnerMounts()
+        self.ledger = AllocationLedger(config.scratch_root / '.allocations.db')
+        self.image_prefetcher = ImagePrefetcher(
+            self.docker, governor=self.docker_governor,
+            max_concurrency=config.image_prefetch_concurrency,
+            loop=self.loop)
+        self.image_cache = ImageCache(
+            self.docker, governor=self.docker_governor,
+            low_watermark=config.image_cache_low_watermark / 100,
+            high_watermark=config.image_cache_high_watermark / 100,
+            stats_monitor=self.stats_monitor,
+            loop=self.loop)
+        self.cleanup_queue = KernelCleanupQueue(self.clean_kernel,
+                                                stats_monitor=self.stats_monitor,
+                                                loop=self.loop)
+        self.cpu_rebalancer = CPURebalancer(self._repin_kernel,
+                                            cpu_map=self.container_cpu_map,
+                                            stats_monitor=self.stats_monitor)
+        self.cpu_deflator = CPUDeflator(
+            self.docker, governor=self.docker_governor,
+            idle_threshold=config.density_idle_threshold,
+            stats_monitor=self.stats_monitor,
+            loop=self.loop)
+        self.memory_reclaimer = MemoryReclaimer(
+            idle_threshold=config.memory_reclaim_idle_threshold,
+            stats_monitor=self.stats_monitor,
+            loop=self.loop)
+
     async def detect_manager(self):
         log.info('detecting the manager...')
         manager_id = await self.etcd.get('nodes/manager')
@@ -316,23 +425,30 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
 
     async def scan_running_containers(self):
         env_containers = {}
+        allocations = self.ledger.load()
+        live_allocations = []
 
+        # The list already has the names and states of the containers, so
+        # only the running kernel containers are inspected for the details.
+        kernel_containers = []
         for container in (await self.docker.containers.list()):
-            kernel_id, env_container_id = await get_env_cid(container)
-            if env_container_id is not None:
-                env_containers[kernel_id] = env_container_id
-
-        for container in (await self.docker.containers.list()):
-            kernel_id = await get_kernel_id_from_container(container)
-            if kernel_id is None:
+            name = container['Names'][0].lstrip('/')
+            if name.startswith('kernel-env.'):
+                env_containers[name[11:]] = container._id
                 continue
-            # NOTE: get_kernel_id_from_containers already performs .show() on
-            #       the returned container objects.
-            status = container['State']['Status']
+            kernel_id = await get_kernel_id_from_container(name)
+            if kernel_id is not None:
+                kernel_containers.append((kernel_id, container))
+
+        for kernel_id, container in kernel_containers:
+            status = container['State']
             if status in {'running', 'restarting', 'paused'}:
                 log.info('detected running kernel: {0}', kernel_id)
+                await container.show()
                 image = container['Config']['Image']
                 labels = container['Config']['Labels']
+                if kernel_id_label not in labels:
+                    self.unlabeled_kernels.add(kernel_id)
                 ports = container['NetworkSettings']['Ports']
                 port_map = {}
                 for private_port, host_ports in ports.items():
@@ -343,17 +459,27 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                         public_port = int(host_ports[0]['HostPort'])
                         self.port_pool.discard(public_port)
                     port_map[private_port] = public_port
-                cpu_set = set(
-                    map(int, (container['HostConfig']['CpusetCpus']).split(',')))
-                self.container_cpu_map.update(cpu_set)
+                alloc = allocations.pop(kernel_id, None)
+                if alloc is None:
+                    # The kernels created before the ledger is introduced.
+                    config_dir = (self.config.scratch_root /
+                                  kernel_id / 'config').resolve()
+                    with open(config_dir / 'resource.txt', 'r') as f:
+                        resource_spec = KernelResourceSpec.read_from_file(f)
+                    alloc = Allocation(kernel_id, resource_spec,
+                                       [*port_map.values()], container._id)
+                resource_spec = alloc.resource_spec
+                live_allocations.append(alloc)
+                self.container_cpu_map.update(resource_spec.cpu_set)
+                for dev_type, dev_shares in resource_spec.shares.items():
+                    if dev_type in KernelResourceSpec.reserved_share_types:
+                        continue
+                    if dev_type in self.accelerators:
+                        self.accelerators[dev_type].alloc_map.update(dev_shares)
                 if self.config.kernel_host_override:
                     kernel_host = self.config.kernel_host_override
                 else:
                     kernel_host = '127.0.0.1'
-                config_dir = (self.config.scratch_root /
-                              kernel_id / 'config').resolve()
-                with open(config_dir / 'resource.txt', 'r') as f:
-                    resource_spec = KernelResourceSpec.read_from_file(f)
                 service_ports = []
                 for item in get_label(labels, 'service-ports', '').split(','):
                     if not item:
@@ -378,12 +504,26 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                     'host_ports': [*port_map.values()],
                     'resource_spec': resource_spec,
                     'service_ports': service_ports,
+                    'cpu_rebalance':
+                        get_label(labels, 'cpu-rebalance', 'yes') != 'no',
                 }
+                cpu_quota = get_cpu_quota(resource_spec.shares['_cpu'])
+                current_quota = container['HostConfig'].get('CpuQuota') or 0
+                if 0 < current_quota < cpu_quota:
+                    self.cpu_deflator.adopt(kernel_id, container._id,
+                                            cpu_quota, current_quota)
             elif status in {'exited', 'dead', 'removing'}:
                 log.info('detected terminated kernel: {0}', kernel_id)
                 await self.send_event('kernel_terminated', kernel_id,
                                       'self-terminated', None)
 
+        # The allocations of the kernels without running containers are
+        # leaked by a crash of the agent; they are not restored.
+        for kernel_id in allocations:
+            log.warning('reclaimed the leaked allocation of {0}', kernel_id)
+            self.ledger.record_free(kernel_id)
+        self.ledger.compact(live_allocations)
+
     async def scan_images(self, interval):
         all_images = await self.docker.images.list()
         self.images.clear()
@@ -403,23 +543,160 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         await self.etcd.delete_prefix(f'nodes/agents/{self.config.instance_id}')
 
     async def send_event(self, event_name, *args):
-        if self.event_sock is None:
+        if self.event_outbox is None:
             return
-        log.debug('send_event({0})', event_name)
-        self.event_sock.write((
-            event_name.encode('ascii'),
-            self.config.instance_id.encode('utf8'),
-            msgpack.packb(args),
-        ))
+        seq = self.event_outbox.put(event_name, *args)
+        log.debug('send_event({0}, seq={1})', event_name, seq)
 
-    async def check_images(self):
-        # Read desired image versions from etcd.
-        for key, value in (await self.etcd.get_prefix('images')):
-            # TODO: implement
-            pass
+    async def check_images(self, interval):
+        '''
+        Pull the images registered in etcd but missing in this agent.
+        '''
+        try:
+            registry = await self.etcd.get('nodes/docker_registry')
+            if registry is None:
+                log.debug('skipping image prefetch: no docker registry configured')
+                return
+            desired_images = get_desired_images(
+                registry, await self.etcd.get_prefix('images'))
+            pulled = await self.image_prefetcher.prefetch(desired_images)
+            if pulled:
+                await self.scan_images(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('unexpected error while prefetching images')
+            self.error_monitor.capture_exception()
 
-        # If there are newer images, pull them.
-        # TODO: implement
+    async def evict_images(self, interval):
+        '''
+        Delete the least recently used kernel images under disk pressure.
+        '''
+        try:
+            evicted = await self.image_cache.evict()
+            if evicted:
+                await self.scan_images(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('unexpected error while evicting images')
+            self.error_monitor.capture_exception()
+
+    async def rebalance_cpus(self, interval):
+        '''
+        Move the kernels on contended CPU cores to less loaded ones.
+        '''
+        placements = []
+        for kernel_id, info in self.container_registry.items():
+            resource_spec = info.get('resource_spec')
+            if resource_spec is None or not resource_spec.cpu_set:
+                continue
+            cpu_used = None
+            stat = self.stats.get(info['container_id'])
+            if stat is not None and stat.last_stat is not None:
+                cpu_used = float(stat.last_stat['cpu_used'])
+            placements.append(KernelPlacement(
+                kernel_id,
+                frozenset(resource_spec.cpu_set),
+                resource_spec.numa_nodes or [resource_spec.numa_node],
+                cpu_used=cpu_used,
+                movable=(info.get('cpu_rebalance', True) and
+                         kernel_id not in self.restarting_kernels)))
+        try:
+            await self.cpu_rebalancer.rebalance(placements)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('unexpected error while rebalancing CPUs')
+            self.error_monitor.capture_exception()
+
+    async def check_idle_kernels(self, interval):
+        '''
+        Shrink the CPU quota and reclaim the memory of the idle kernels.
+        '''
+        candidates = []
+        for kernel_id, info in self.container_registry.items():
+            resource_spec = info.get('resource_spec')
+            if resource_spec is None:
+                continue
+            cpu_used = io_bytes = None
+            stat = self.stats.get(info['container_id'])
+            if stat is not None and stat.last_stat is not None:
+                cpu_used = float(stat.last_stat['cpu_used'])
+                io_bytes = float(stat.last_stat['io_read_bytes']) + \
+                    float(stat.last_stat['io_write_bytes'])
+            candidates.append(IdleCandidate(
+                kernel_id, info['container_id'],
+                get_cpu_quota(resource_spec.shares['_cpu']),
+                info['last_used'],
+                cpu_used=cpu_used,
+                io_bytes=io_bytes,
+                busy=bool(info['runner_tasks'] or
+                          kernel_id in self.restarting_kernels)))
+        try:
+            await self.cpu_deflator.deflate_idle(candidates)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('unexpected error while deflating idle kernels')
+            self.error_monitor.capture_exception()
+        try:
+            await self.memory_reclaimer.reclaim_idle(candidates)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('unexpected error while reclaiming the memory '
+                          'of idle kernels')
+            self.error_monitor.capture_exception()
+
+    def _switch_cpu_set(self, kernel_id, cpu_set, numa_nodes):
+        kernel_info = self.container_registry[kernel_id]
+        resource_spec = kernel_info['resource_spec']
+        self.container_cpu_map.update(cpu_set)
+        self.container_cpu_map.free(resource_spec.cpu_set)
+        resource_spec.cpu_set = set(cpu_set)
+        resource_spec.numa_node = numa_nodes[0]
+        resource_spec.numa_nodes = list(numa_nodes)
+        # Keep the spec read by the kernel restarts up to date.
+        config_dir = self.config.scratch_root / kernel_id / 'config'
+        try:
+            with open(config_dir / 'resource.txt', 'w') as f:
+                resource_spec.write_to_file(f)
+        except OSError as e:
+            log.warning('cannot update the resource spec of {0}: {1!r}',
+                        kernel_id, e)
+        self.ledger.record_alloc(kernel_id, resource_spec,
+                                 kernel_info['host_ports'])
+        self.ledger.record_container(kernel_id, kernel_info['container_id'])
+
+    async def _repin_kernel(self, move):
+        kernel_info = self.container_registry.get(move.kernel_id)
+        if kernel_info is None or move.kernel_id in self.restarting_kernels:
+            return False
+        if set(kernel_info['resource_spec'].cpu_set) != move.old_cpu_set:
+            return False
+        # Switch the allocation first, so that the kernel terminated in the
+        # meantime releases the new cores.
+        self._switch_cpu_set(move.kernel_id, move.cpu_set, move.numa_nodes)
+        container_id = kernel_info['container_id']
+        try:
+            # It is a cheap cgroup update like inspections.
+            async with self.docker_governor.lane('inspect'):
+                await self.docker._query_json(
+                    f'containers/{container_id}/update', method='POST',
+                    data={
+                        'CpusetCpus': ','.join(map(str, sorted(move.cpu_set))),
+                        'CpusetMems': ','.join(map(str, move.numa_nodes)),
+                    })
+        except (DockerError, asyncio.CancelledError) as e:
+            if move.kernel_id in self.container_registry:
+                self._switch_cpu_set(move.kernel_id, move.old_cpu_set,
+                                     move.old_numa_nodes)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            log.warning('cannot move the kernel {0}: {1!r}', move.kernel_id, e)
+            return False
+        return True
 
     async def clean_runner(self, kernel_id):
         if kernel_id not in self.container_registry:
@@ -453,6 +730,10 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                     container = self.docker.containers.container(cid)
                     kernel_id = await get_kernel_id_from_container(container)
                     self.stats[cid] = StatCollectorState(kernel_id)
+                collector_pid = self.stats[cid].collector_pid
+                if collector_pid is not None and msg[0].get('pid') != collector_pid:
+                    # a late message from the collector before a fast restart
+                    continue
                 self.stats[cid].last_stat = msg[0]['data']
                 kernel_id = self.stats[cid].kernel_id
                 pipe = self.redis_stat_pool.pipeline()
@@ -482,8 +763,10 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             self.config.limit_gpus)
         for name, klass in accelerator_types.items():
             devices = klass.list_devices()
-            alloc_map = AcceleratorAllocMap(devices,
-                                            limit_mask=self.config.limit_gpus)
+            alloc_map = AcceleratorAllocMap(
+                devices,
+                limit_mask=self.config.limit_gpus,
+                strategy=self.config.accelerator_alloc_strategy)
             self.accelerators[name] = AcceleratorSet(klass, devices, alloc_map)
         if not skip_detect_manager:
             await self.detect_manager()
@@ -493,8 +776,22 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         # so call it here although we spawn a scheduler
         # for this task below.
         await self.scan_images(None)
+        if self.tmpfs_pool is not None:
+            await self.tmpfs_pool.start()
+        else:
+            self.scratch_quota = await create_quota_backend(
+                self.config.scratch_quota, self.config.scratch_root,
+                default_size=self.config.scratch_size, loop=self.loop)
+        # Reclaim the leftover scratch directories before cleaning up
+        # the containers terminated while the agent was down.  Their quotas
+        # are kept until they are deleted.
+        self.scratch_reaper.start(leftover_callback=(
+            self.scratch_quota.release_leftover
+            if self.scratch_quota is not None else None))
+        self.runner_mounts.prepare()
+        await self.krunner_volumes.prepare_all()
+        self.ledger.open()
         await self.scan_running_containers()
-        await self.check_images()
 
         self.redis_stat_pool = await aioredis.create_redis_pool(
             self.config.redis_addr.as_sockaddr(),
@@ -505,10 +802,30 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         self.event_sock = await aiozmq.create_zmq_stream(
             zmq.PUSH, connect=f'tcp://{self.config.event_addr}')
         self.event_sock.transport.setsockopt(zmq.LINGER, 50)
+        self.event_outbox = EventOutbox(
+            self.config.instance_id,
+            flush_interval=self.config.event_batch_interval,
+            spill_path=self.config.scratch_root / '.event-spill',
+            max_spill_size=self.config.event_spill_size,
+            stats_monitor=self.stats_monitor,
+            loop=self.loop)
+        self.event_outbox.start(self.event_sock)
+
+        # Spawn output file upload workers.
+        self.output_uploads.start()
 
         # Spawn image scanner task.
         self.scan_images_timer = aiotools.create_timer(self.scan_images, 60.0)
 
+        # Spawn image prefetcher task.
+        self.image_prefetch_timer = aiotools.create_timer(self.check_images,
+                                                          300.0)
+
+        # Spawn image eviction task.
+        if self.image_cache.enabled:
+            self.image_evict_timer = aiotools.create_timer(self.evict_images,
+                                                           60.0)
+
         # Spawn stat collector task.
         self.stats = dict()
         self.stat_collector_task = self.loop.create_task(self.collect_stats())
@@ -522,7 +839,18 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             async with spawn_stat_collector(stat_addr, stat_type, cid):
                 pass
 
+        # Spawn idle kernel deflation and memory reclaim task.
+        if self.cpu_deflator.enabled or self.memory_reclaimer.enabled:
+            self.density_timer = aiotools.create_timer(
+                self.check_idle_kernels, 60.0)
+
+        # Spawn CPU rebalancer task.
+        if self.config.cpu_rebalance_interval > 0:
+            self.cpu_rebalance_timer = aiotools.create_timer(
+                self.rebalance_cpus, self.config.cpu_rebalance_interval)
+
         # Spawn docker monitoring tasks.
+        self.cleanup_queue.start()
         self.monitor_fetch_task  = self.loop.create_task(self.fetch_docker_events())
         self.monitor_handle_task = self.loop.create_task(self.monitor())
 
@@ -565,6 +893,18 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         if self.scan_images_timer is not None:
             self.scan_images_timer.cancel()
             await self.scan_images_timer
+        if self.image_prefetch_timer is not None:
+            self.image_prefetch_timer.cancel()
+            await self.image_prefetch_timer
+        if self.image_evict_timer is not None:
+            self.image_evict_timer.cancel()
+            await self.image_evict_timer
+        if self.cpu_rebalance_timer is not None:
+            self.cpu_rebalance_timer.cancel()
+            await self.cpu_rebalance_timer
+        if self.density_timer is not None:
+            self.density_timer.cancel()
+            await self.density_timer
         if self.hb_timer is not None:
             self.hb_timer.cancel()
             await self.hb_timer
@@ -582,7 +922,9 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             await self.docker.events.stop()
         except Exception:
             pass
+        await self.cleanup_queue.stop()
         await self.docker.close()
+        self.ledger.close()
 
         # Stop stat collector task.
         if self.stat_collector_task is not None:
@@ -593,10 +935,18 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             self.redis_stat_pool.close()
             await self.redis_stat_pool.wait_closed()
 
+        await self.output_uploads.stop()
+        self.upload_engine.close()
+        await self.scratch_reaper.stop()
+        if self.tmpfs_pool is not None:
+            await self.tmpfs_pool.stop()
+        if self.scratch_quota is not None:
+            await self.scratch_quota.stop()
+
         # Notify the gateway.
-        if self.event_sock is not None:
+        if self.event_outbox is not None:
             await self.send_event('instance_terminated', 'shutdown')
-            self.event_sock.close()
+            await self.event_outbox.close()
 
     @aiotools.actxmgr
     async def handle_rpc_exception(self):
@@ -633,6 +983,36 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         async with self.handle_rpc_exception():
             return await self._destroy_kernel(kernel_id, 'user-requested')
 
+    @aiozmq.rpc.method
+    async def create_kernels(self, kernel_configs: list) -> list:
+        '''
+        Create multiple kernels at once from a list of ``(kernel_id, config)``
+        pairs and return the results in the same order.
+        '''
+        log.debug('rpc::create_kernels({0})', len(kernel_configs))
+        async with self.handle_rpc_exception():
+            return await self._create_kernels(kernel_configs)
+
+    @aiozmq.rpc.method
+    async def destroy_kernels(self, kernel_ids: list) -> list:
+        log.debug('rpc::destroy_kernels({0})', len(kernel_ids))
+        async with self.handle_rpc_exception():
+            return await self._destroy_kernels(kernel_ids, 'user-requested')
+
+    @aiozmq.rpc.method
+    async def touch_kernels(self, kernel_ids: list) -> list:
+        log.debug('rpc::touch_kernels({0})', len(kernel_ids))
+        now = time.monotonic()
+        results = []
+        for kernel_id in kernel_ids:
+            kernel_info = self.container_registry.get(kernel_id)
+            if kernel_info is None:
+                results.append({'id': kernel_id, 'status': 'missing'})
+            else:
+                kernel_info['last_used'] = now
+                results.append({'id': kernel_id, 'status': 'ok'})
+        return results
+
     @aiozmq.rpc.method
     @update_last_used
     async def interrupt_kernel(self, kernel_id: str):
@@ -658,6 +1038,12 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
     @aiozmq.rpc.method
     @update_last_used
     async def restart_kernel(self, kernel_id: str, new_config: dict):
+        '''
+        Restart the kernel with a new container reusing its scratch directory.
+
+        If ``new_config['fast']`` is set, the existing container is restarted
+        in place instead, keeping its ports, mounts and resource allocations.
+        '''
         log.debug('rpc::restart_kernel({0})', kernel_id)
         async with self.handle_rpc_exception():
             tracker = self.restarting_kernels.get(kernel_id)
@@ -667,6 +1053,9 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                     destroy_event=asyncio.Event(),
                     done_event=asyncio.Event())
             async with tracker.request_lock:
+                if new_config.get('fast', False):
+                    await self._restart_kernel_fast(kernel_id, tracker)
+                    return self._get_restart_result(kernel_id)
                 self.restarting_kernels[kernel_id] = tracker
                 await self._destroy_kernel(kernel_id, 'restarting')
                 # clean_kernel() will set tracker.destroy_event
@@ -677,7 +1066,7 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                     log.warning('timeout detected while restarting kernel {0}!',
                                 kernel_id)
                     self.restarting_kernels.pop(kernel_id, None)
-                    asyncio.ensure_future(self._clean_kernel(kernel_id))
+                    await self.cleanup_queue.submit(kernel_id)
                     raise
                 else:
                     tracker.destroy_event.clear()
@@ -686,15 +1075,18 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                         restarting=True)
                     self.restarting_kernels.pop(kernel_id, None)
             tracker.done_event.set()
-            kernel_info = self.container_registry[kernel_id]
-            return {
-                'container_id': kernel_info['container_id'],
-                'repl_in_port': kernel_info['repl_in_port'],
-                'repl_out_port': kernel_info['repl_out_port'],
-                'stdin_port': kernel_info['stdin_port'],
-                'stdout_port': kernel_info['stdout_port'],
-                'service_ports': kernel_info['service_ports'],
-            }
+            return self._get_restart_result(kernel_id)
+
+    def _get_restart_result(self, kernel_id):
+        kernel_info = self.container_registry[kernel_id]
+        return {
+            'container_id': kernel_info['container_id'],
+            'repl_in_port': kernel_info['repl_in_port'],
+            'repl_out_port': kernel_info['repl_out_port'],
+            'stdin_port': kernel_info['stdin_port'],
+            'stdout_port': kernel_info['stdout_port'],
+            'service_ports': kernel_info['service_ports'],
+        }
 
     @aiozmq.rpc.method
     async def execute(self, api_version: int,
@@ -725,6 +1117,29 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         async with self.handle_rpc_exception():
             await self._accept_file(kernel_id, filename, filedata)
 
+    @aiozmq.rpc.method
+    @update_last_used
+    async def begin_upload(self, kernel_id: str, filename: str, size: int):
+        log.debug('rpc::begin_upload({0}, {1}, {2})', kernel_id, filename, size)
+        async with self.handle_rpc_exception():
+            return await self.upload_sessions.begin(kernel_id, filename, size)
+
+    @aiozmq.rpc.method
+    @update_last_used
+    async def upload_chunk(self, kernel_id: str, upload_id: str,
+                           offset: int, data: bytes, checksum: int):
+        log.debug('rpc::upload_chunk({0}, {1}, {2})', kernel_id, upload_id, offset)
+        async with self.handle_rpc_exception():
+            return await self.upload_sessions.write_chunk(
+                kernel_id, upload_id, offset, data, checksum)
+
+    @aiozmq.rpc.method
+    @update_last_used
+    async def commit_upload(self, kernel_id: str, upload_id: str):
+        log.debug('rpc::commit_upload({0}, {1})', kernel_id, upload_id)
+        async with self.handle_rpc_exception():
+            return await self.upload_sessions.commit(kernel_id, upload_id)
+
     @aiozmq.rpc.method
     @update_last_used
     async def download_file(self, kernel_id: str, filepath: str):
@@ -756,26 +1171,208 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                     log.exception('reset: destroying {0}', kernel_id)
             await asyncio.gather(*tasks)
 
-    async def _create_kernel(self, kernel_id, kernel_config, restarting=False):
+    async def _inspect_image(self, image_ref, image_cache=None):
+        '''
+        Return the image properties and the extra volumes to mount for the
+        given image, pulling the image if it does not exist.
 
-        await self.send_event('kernel_creating', kernel_id)
+        The kernels of the same batch share the lookups via ``image_cache``.
+        '''
+        if image_cache is None:
+            return await asyncio.gather(
+                self._get_image_props(image_ref),
+                self._get_extra_volumes(image_ref))
+        props_key = ('image', image_ref.canonical)
+        volumes_key = ('volumes', image_ref.short)
+        if props_key not in image_cache:
+            image_cache[props_key] = self.loop.create_task(
+                self._get_image_props(image_ref))
+        if volumes_key not in image_cache:
+            image_cache[volumes_key] = self.loop.create_task(
+                self._get_extra_volumes(image_ref))
+        return await asyncio.gather(
+            asyncio.shield(image_cache[props_key]),
+            asyncio.shield(image_cache[volumes_key]))
+
+    async def _get_image_props(self, image_ref):
+        try:
+            async with self.docker_governor.lane('inspect'):
+                return await self.docker.images.get(image_ref.canonical)
+        except DockerError as e:
+            if e.status != 404:
+                raise
+        await self.image_prefetcher.pull(image_ref.canonical)
+        async with self.docker_governor.lane('inspect'):
+            return await self.docker.images.get(image_ref.canonical)
 
-        # Read image-specific labels and settings
-        image_ref = ImageRef(kernel_config['lang'])
-        assert not image_ref.resolve_required(), \
-               'The manager should have resolved the image reference!'
+    async def _get_extra_volumes(self, image_ref):
+        async with self.docker_governor.lane('inspect'):
+            return await get_extra_volumes(self.docker, image_ref.short)
 
-        environ: dict = kernel_config.get('environ', {})
-        extra_mount_list = await get_extra_volumes(self.docker, image_ref.short)
+    def _get_exposed_ports(self, image_ref, image_labels):
+        exposed_ports = [2000, 2001]
+        service_ports = {}
+        for item in get_label(image_labels, 'service-ports', '').split(','):
+            if not item:
+                continue
+            service_port = parse_service_port(item)
+            container_port = service_port['container_port']
+            service_ports[container_port] = service_port
+            exposed_ports.append(container_port)
+        if 'git' in image_ref.name:  # legacy (TODO: remove it!)
+            exposed_ports.append(2002)
+            exposed_ports.append(2003)
+        return exposed_ports, service_ports
+
+    def _devise_resource_spec(self, kernel_config):
+        limits = kernel_config['limits']
+        assert 'cpu_slot' in limits
+        assert 'mem_slot' in limits
+        limits['cpu_slot'] = Decimal(limits['cpu_slot'])
+        limits['mem_slot'] = Decimal(limits['mem_slot'])
+        limits['gpu_slot'] = Decimal(limits.get('gpu_slot', 0))
+        limits['tpu_slot'] = Decimal(limits.get('tpu_slot', 0))
+        resource_spec = KernelResourceSpec(
+            shares={
+                '_cpu': limits['cpu_slot'],
+                '_mem': limits['mem_slot'],
+                '_gpu': limits['gpu_slot'],
+                '_tpu': limits['tpu_slot'],
+            },
+            mounts=[],
+            scratch_disk_size=0,  # unlimited
+        )
+
+        # Realize memory share. (the creation-config unit is 1 GiB)
+        resource_spec.memory_limit = int(limits['mem_slot'] * (2 ** 30))
+        if self.tmpfs_pool is not None:
+            # The tmpfs pages are charged to the kernel's memory cgroup,
+            # so in-memory scratch cannot be larger than the memory limit.
+            # It is the budget shared by the work and /tmp directories.
+            resource_spec.scratch_disk_size = min(
+                self.config.scratch_size, resource_spec.memory_limit)
+        elif self.scratch_quota is not None:
+            resource_spec.scratch_disk_size = self.config.scratch_size
+
+        # Realize vfolder mounts.
+        for folder_name, folder_host, folder_id in kernel_config['mounts']:
+            host_path = (self.config.vfolder_mount / folder_host /
+                         self.config.vfolder_fsprefix / folder_id)
+            kernel_path = Path(f'/home/work/{folder_name}')
+            # TODO: apply READ_ONLY for read-only shared vfolders
+            mount = Mount(host_path, kernel_path, MountPermission.READ_WRITE)
+            resource_spec.mounts.append(mount)
+        return resource_spec
+
+    def _reserve_ports(self, num_ports):
+        if num_ports > len(self.port_pool):
+            raise RuntimeError('Container ports are not sufficiently available.')
+        return [self.port_pool.pop() for _ in range(num_ports)]
+
+    def _reserve_resources(self, kernel_config, resource_spec, num_ports):
+        '''
+        Allocate the CPU cores, accelerator shares and host ports for a new
+        kernel, updating the given resource spec.  All or nothing is
+        allocated.
 
+        It does not yield to the event loop, so the reservations of multiple
+        kernels made back-to-back are atomic as a whole.
+        '''
+        host_ports = self._reserve_ports(num_ports)
         try:
-            image_props = await self.docker.images.get(image_ref.canonical)
-        except DockerError as e:
-            if e.status == 404:
-                await self.docker.images.pull(image_ref.canonical)
+            # Realize CPU share.
+            cpu_set = kernel_config.get('cpu_set')
+            if cpu_set is None:
+                requested_cores = int(resource_spec.shares['_cpu'])
+                num_cores = min(self.container_cpu_map.num_cores, requested_cores)
+                numa_nodes, cpu_set = \
+                    self.container_cpu_map.alloc_multi_node(num_cores)
             else:
-                raise
-        image_labels = image_props['ContainerConfig']['Labels']
+                numa_nodes = sorted({libnuma.node_of_cpu(c) for c in cpu_set})
+            resource_spec.numa_node = numa_nodes[0]
+            resource_spec.numa_nodes = numa_nodes
+            resource_spec.cpu_set = cpu_set
+
+            # Realize accelerator shares.
+            # TODO: generalize gpu_slot
+            for dev_type, slot_key in (('cuda', '_gpu'), ('tpu', '_tpu')):
+                if resource_spec.shares[slot_key] > 0:
+                    accl = self.accelerators[dev_type]
+                    _, allocated_shares = accl.alloc_map.alloc(
+                        resource_spec.shares[slot_key],
+                        cpu_nodes=resource_spec.numa_nodes)
+                    resource_spec.shares[dev_type] = allocated_shares
+        except Exception:
+            self._release_resources(resource_spec, host_ports)
+            raise
+        return host_ports
+
+    def _release_resources(self, resource_spec, host_ports):
+        self.port_pool.update(host_ports)
+        if resource_spec.cpu_set:
+            self.container_cpu_map.free(resource_spec.cpu_set)
+        for dev_type, dev_shares in resource_spec.shares.items():
+            if dev_type in KernelResourceSpec.reserved_share_types:
+                continue
+            self.accelerators[dev_type].alloc_map.free(dev_shares)
+
+    def _check_new_kernel_id(self, kernel_id):
+        if (kernel_id in self.container_registry or
+                kernel_id in self.restarting_kernels or
+                kernel_id in self.creating_kernels or
+                (self.config.scratch_root / kernel_id).exists() or
+                (self.config.scratch_root / f'{kernel_id}_tmp').exists()):
+            raise AssertionError(f'The kernel {kernel_id} already exists.')
+
+    async def _create_kernel(self, kernel_id, kernel_config, restarting=False, *,
+                             image_cache=None, reservation=None):
+        if restarting:
+            return await self._spawn_kernel(kernel_id, kernel_config, True)
+        try:
+            # A retried or duplicate request must not touch the existing
+            # kernel's ledger entry and scratch directories.
+            self._check_new_kernel_id(kernel_id)
+        except AssertionError:
+            if reservation is not None:
+                # The batch creation has reserved the resources in advance.
+                self._release_resources(*reservation)
+            raise
+        self.creating_kernels.add(kernel_id)
+        try:
+            return await self._spawn_kernel(kernel_id, kernel_config, False,
+                                            image_cache=image_cache,
+                                            reservation=reservation)
+        finally:
+            self.creating_kernels.discard(kernel_id)
+
+    async def _spawn_kernel(self, kernel_id, kernel_config, restarting, *,
+                            image_cache=None, reservation=None):
+
+        try:
+            await self.send_event('kernel_creating', kernel_id)
+
+            # Read image-specific labels and settings
+            image_ref = ImageRef(kernel_config['lang'])
+            assert not image_ref.resolve_required(), \
+                   'The manager should have resolved the image reference!'
+
+            environ: dict = kernel_config.get('environ', {})
+            image_props, extra_mount_list = await self._inspect_image(
+                image_ref, image_cache)
+            # Keep the eviction from picking the image while preparing the
+            # kernel runner volume below.
+            self.image_cache.touch(image_props['Id'])
+            image_labels = image_props['ContainerConfig']['Labels']
+
+            # Prepare the kernel runner volume before reserving resources,
+            # as it may take a while or fail (e.g., a missing krunner image).
+            distro = get_label(image_labels, 'base-distro', 'ubuntu16.04')
+            krunner_volume = await self.krunner_volumes.get(distro)
+        except Exception:
+            if reservation is not None:
+                # The batch creation has reserved the resources in advance.
+                self._release_resources(*reservation)
+            raise
 
         version        = int(get_label(image_labels, 'version', '1'))
         exec_timeout   = int(get_label(image_labels, 'timeout', '10'))
@@ -788,318 +1385,226 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         config_dir = scratch_dir / 'config'
         work_dir = scratch_dir / 'work'
 
+        exposed_ports, service_ports = self._get_exposed_ports(image_ref,
+                                                               image_labels)
+        log.debug('exposed ports: {!r}', exposed_ports)
+
         # PHASE 1: Read existing resource spec or devise a new resource spec.
+        #          (the batch creation reserves the resources in advance)
 
         if restarting:
             with open(config_dir / 'resource.txt', 'r') as f:
                 resource_spec = KernelResourceSpec.read_from_file(f)
+            host_ports = self._reserve_ports(len(exposed_ports))
+        elif reservation is not None:
+            resource_spec, host_ports = reservation
         else:
-            limits = kernel_config['limits']
-            vfolders = kernel_config['mounts']
-            assert 'cpu_slot' in limits
-            assert 'mem_slot' in limits
-            limits['cpu_slot'] = Decimal(limits['cpu_slot'])
-            limits['mem_slot'] = Decimal(limits['mem_slot'])
-            limits['gpu_slot'] = Decimal(limits.get('gpu_slot', 0))
-            limits['tpu_slot'] = Decimal(limits.get('tpu_slot', 0))
-            resource_spec = KernelResourceSpec(
-                shares={
-                    '_cpu': limits['cpu_slot'],
-                    '_mem': limits['mem_slot'],
-                    '_gpu': limits['gpu_slot'],
-                    '_tpu': limits['tpu_slot'],
-                },
-                mounts=[],
-                scratch_disk_size=0,  # TODO: implement (#70)
-            )
-
-        # PHASE 2: Apply the resource spec.
-
-        # Inject Backend.AI-intrinsic env-variables for gosu
-        if KernelFeatures.UID_MATCH in kernel_features:
-            uid = self.config.kernel_uid
-            environ['LOCAL_USER_ID'] = str(uid)
-
-        # Inject Backend.AI-intrinsic mount points and extra mounts
-        binds = [
-            f'{config_dir}:/home/config:ro',
-            f'{work_dir}:/home/work/:rw',
-            f'{tmp_dir}:/tmp:rw',
-        ]
-        binds.extend(f'{v.name}:{v.container_path}:{v.mode}'
-                     for v in extra_mount_list)
-
-        if restarting:
-            # Reuse previous CPU share.
-            pass
-
-            # Reuse previous memory share.
-            pass
+            resource_spec = self._devise_resource_spec(kernel_config)
+            host_ports = self._reserve_resources(kernel_config, resource_spec,
+                                                 len(exposed_ports))
+        self.ledger.record_alloc(kernel_id, resource_spec, host_ports)
+
+        # The scratch directories of the restarting kernel are its own.
+        # Otherwise, discard only the ones created here upon failures.
+        created_scratch = created_tmp = restarting
+        try:
+            # PHASE 2: Apply the resource spec.
 
-            # Reuse previous accelerator share.
-            pass
+            # Inject Backend.AI-intrinsic env-variables for gosu
+            if KernelFeatures.UID_MATCH in kernel_features:
+                uid = self.config.kernel_uid
+                environ['LOCAL_USER_ID'] = str(uid)
+
+            # Inject Backend.AI-intrinsic mount points and extra mounts
+            binds = [
+                f'{config_dir}:/home/config:ro',
+                f'{work_dir}:/home/work/:rw',
+                f'{tmp_dir}:/tmp:rw',
+            ]
+            binds.extend(f'{v.name}:{v.container_path}:{v.mode}'
+                         for v in extra_mount_list)
 
-            # Reuse previous mounts.
+            # The CPU, memory and accelerator shares are already realized.
             for mount in resource_spec.mounts:
                 binds.append(str(mount))
-        else:
-            # Realize CPU share.
-            cpu_set = kernel_config.get('cpu_set')
-            if cpu_set is None:
-                requested_cores = int(limits['cpu_slot'])
-                num_cores = min(self.container_cpu_map.num_cores, requested_cores)
-                numa_node, cpu_set = self.container_cpu_map.alloc(num_cores)
-            else:
-                num_cores = len(cpu_set)
-                numa_node = libnuma.node_of_cpu(next(iter(cpu_set)))
-            resource_spec.numa_node = numa_node
-            resource_spec.cpu_set = cpu_set
-
-            # Realize memory share. (the creation-config unit is 1 GiB)
-            resource_spec.memory_limit = int(limits['mem_slot'] * (2 ** 30))
 
-            # Realize accelerator shares.
-            if limits['gpu_slot'] > 0:
-                # TODO: generalize gpu_slot
-                accl = self.accelerators['cuda']
-                _, cuda_allocated_shares = \
-                    accl.alloc_map.alloc(limits['gpu_slot'])
-                resource_spec.shares['cuda'] = cuda_allocated_shares
-            if limits['tpu_slot'] > 0:
-                accl = self.accelerators['tpu']
-                _, tpu_allocated_shares = \
-                    accl.alloc_map.alloc(limits['tpu_slot'])
-                resource_spec.shares['tpu'] = tpu_allocated_shares
-
-            # Realize vfolder mounts.
-            for folder_name, folder_host, folder_id in vfolders:
-                host_path = (self.config.vfolder_mount / folder_host /
-                             self.config.vfolder_fsprefix / folder_id)
-                kernel_path = Path(f'/home/work/{folder_name}')
-                # TODO: apply READ_ONLY for read-only shared vfolders
-                mount = Mount(host_path, kernel_path, MountPermission.READ_WRITE)
-                resource_spec.mounts.append(mount)
-                binds.append(str(mount))
-
-            # should no longer be used!
-            del limits
-            del vfolders
-
-        # Inject Backend.AI-intrinsic env-variables for libbaihook and gosu
-        environ.update({
-            k: str(len(resource_spec.cpu_set))
-            for k in envs_corecount})
-
-        def _mount(host_path, container_path, perm='ro'):
-            nonlocal binds
-            binds.append(f'{host_path}:{container_path}:{perm}')
-
-        # Inject Backend.AI kernel runner dependencies.
-        distro = get_label(image_labels, 'base-distro', 'ubuntu16.04')
-        arch = platform.machine()
-        entrypoint_sh_path = Path(pkg_resources.resource_filename(
-            'ai.backend.agent', '../runner/entrypoint.sh'))
-        suexec_path = Path(pkg_resources.resource_filename(
-            'ai.backend.agent', f'../runner/su-exec.{distro}.bin'))
-        jail_path = Path(pkg_resources.resource_filename(
-            'ai.backend.agent', f'../runner/jail.{distro}.bin'))
-        hook_path = Path(pkg_resources.resource_filename(
-            'ai.backend.agent', f'../runner/libbaihook.{distro}.{arch}.so'))
-        kernel_pkg_path = Path(pkg_resources.resource_filename(
-            'ai.backend.agent', '../kernel'))
-        helpers_pkg_path = Path(pkg_resources.resource_filename(
-            'ai.backend.agent', '../helpers'))
-        _mount(entrypoint_sh_path.resolve(),
-               '/opt/backend.ai/bin/entrypoint.sh')
-        _mount(suexec_path.resolve(),
-               '/opt/backend.ai/bin/su-exec')
-        _mount(jail_path.resolve(),
-               '/opt/backend.ai/bin/jail')
-        _mount(hook_path.resolve(),
-               '/opt/backend.ai/hook/libbaihook.so')
-        _mount(kernel_pkg_path.resolve(),
-               '/opt/backend.ai/lib/python3.6/site-packages/ai/backend/kernel')
-        _mount(helpers_pkg_path.resolve(),
-               '/opt/backend.ai/lib/python3.6/site-packages/ai/backend/helpers')
-        environ['LD_PRELOAD'] = '/opt/backend.ai/hook/libbaihook.so'
-
-        # Inject accelerator-specific env-varibles and hooks
-        accel_docker_args = {}
-        for dev_type, dev_share in resource_spec.shares.items():
-            if dev_type in KernelResourceSpec.reserved_share_types:
-                continue
-            accl = self.accelerators[dev_type]
-            accel_docker_args = await accl.klass.generate_docker_args(
-                self.docker, dev_share)
-            hook_paths = accl.klass.get_hooks(distro, arch)
-            log.debug('accelerator {} provides hooks: {}',
-                      accl.klass.__name__,
-                      ', '.join(map(str, hook_paths)))
-            for hook_path in hook_paths:
-                container_hook_path = '/opt/backend.ai/hook/lib{}{}.so'.format(
-                    accl.klass.slot_key, secrets.token_hex(6),
-                )
-                _mount(hook_path, container_hook_path)
-                environ['LD_PRELOAD'] += ':' + container_hook_path
-
-        # PHASE 3: Store the resource spec.
-
-        if restarting:
-            pass
-        else:
-            os.makedirs(scratch_dir)
-            os.makedirs(tmp_dir)
-            if sys.platform == 'linux' and self.config.scratch_in_memory:
-                await create_scratch_filesystem(scratch_dir, 64)
-                await create_scratch_filesystem(tmp_dir, 64)
-            os.makedirs(work_dir)
-            if KernelFeatures.UID_MATCH in kernel_features:
-                uid = int(environ['LOCAL_USER_ID'])
-                if os.getuid() == 0:  # only possible when I am root.
-                    os.chown(work_dir, uid, uid)
-            os.makedirs(config_dir)
-            # Store custom environment variables for kernel runner.
-            with open(config_dir / 'environ.txt', 'w') as f:
-                for k, v in environ.items():
-                    f.write(f'{k}={v}\n')
-                accel_envs = accel_docker_args.get('Env', [])
-                for env in accel_envs:
-                    f.write(f'{env}\n')
-            with open(config_dir / 'resource.txt', 'w') as f:
-                resource_spec.write_to_file(f)
-
-                # Store accelerator-specific resource-share preparation
-                for dev_type, dev_shares in resource_spec.shares.items():
-                    if dev_type in KernelResourceSpec.reserved_share_types:
-                        continue
-                    mem_limits = []
-                    proc_limits = []
-                    accl = self.accelerators[dev_type]
-                    for dev_id, dev_share in dev_shares.items():
-                        device = accl.devices[dev_id]
-                        mem, proc = device.share_to_spec(dev_share)
-                        mem_limits.append((dev_id, mem))
-                        proc_limits.append((dev_id, proc))
-                    mlim_str = ','.join(
-                        f'{dev_id}:{mem}' for dev_id, mem in
-                        mem_limits
-                    )
-                    plim_str = ','.join(
-                        f'{dev_id}:{proc}' for dev_id, proc in
-                        proc_limits
+            # Inject Backend.AI-intrinsic env-variables for libbaihook and gosu
+            environ.update({
+                k: str(len(resource_spec.cpu_set))
+                for k in envs_corecount})
+
+            def _mount(host_path, container_path, perm='ro'):
+                nonlocal binds
+                binds.append(f'{host_path}:{container_path}:{perm}')
+
+            # Inject Backend.AI kernel runner dependencies.
+            arch = self.runner_mounts.arch
+            _mount(krunner_volume, krunner_path)
+            for host_path, container_path in self.runner_mounts.get(distro):
+                _mount(host_path, container_path)
+            environ['LD_PRELOAD'] = '/opt/backend.ai/hook/libbaihook.so'
+
+            # Inject accelerator-specific env-varibles and hooks
+            accel_docker_args = {}
+            for dev_type, dev_share in resource_spec.shares.items():
+                if dev_type in KernelResourceSpec.reserved_share_types:
+                    continue
+                accl = self.accelerators[dev_type]
+                accel_docker_args = await accl.klass.generate_docker_args(
+                    self.docker, dev_share)
+                hook_paths = accl.klass.get_hooks(distro, arch)
+                log.debug('accelerator {} provides hooks: {}',
+                          accl.klass.__name__,
+                          ', '.join(map(str, hook_paths)))
+                for hook_path in hook_paths:
+                    # The shared krunner volume is read-only, so mount the hooks
+                    # outside of it.
+                    container_hook_path = '/opt/backend.ai-hooks/lib{}{}.so'.format(
+                        accl.klass.slot_key, secrets.token_hex(6),
                     )
-                    f.write(f'{dev_type.upper()}_MEMORY_LIMITS={mlim_str}\n')
-                    f.write(f'{dev_type.upper()}_PROCESSOR_LIMITS={plim_str}\n')
+                    _mount(hook_path, container_hook_path)
+                    environ['LD_PRELOAD'] += ':' + container_hook_path
 
-        # PHASE 4: Run!
-        log.info('kernel {0} starting with resource spec: \n',
-                 pformat(attr.asdict(resource_spec)))
-
-        # TODO: Refactor out as separate "Docker execution driver plugin" (#68)
-        #   - Refactor volumes/binds lists to a plugin "mount" API
-        #   - Refactor "/home/work" and "/opt/backend.ai" prefixes to be specified
-        #     by the plugin implementation.
-
-        exposed_ports = [2000, 2001]
-        service_ports = {}
-        for item in get_label(image_labels, 'service-ports', '').split(','):
-            if not item:
-                continue
-            service_port = parse_service_port(item)
-            container_port = service_port['container_port']
-            service_ports[container_port] = service_port
-            exposed_ports.append(container_port)
-        if 'git' in image_ref.name:  # legacy (TODO: remove it!)
-            exposed_ports.append(2002)
-            exposed_ports.append(2003)
-        log.debug('exposed ports: {!r}', exposed_ports)
+            # PHASE 3: Store the resource spec.
 
-        if len(exposed_ports) > len(self.port_pool):
-            raise RuntimeError('Container ports are not sufficiently available.')
-        host_ports = []
-        for eport in exposed_ports:
-            hport = self.port_pool.pop()
-            host_ports.append(hport)
-
-        runtime_type = get_label(image_labels, 'runtime-type', 'python')
-        runtime_path = get_label(image_labels, 'runtime-path', None)
-        cmdargs = []
-        if not self.config.skip_jail:
+            if restarting:
+                pass
+            else:
+                os.makedirs(scratch_dir)
+                created_scratch = True
+                os.makedirs(tmp_dir)
+                created_tmp = True
+                if self.tmpfs_pool is not None:
+                    work_size, tmp_size = split_scratch_budget(
+                        resource_spec.scratch_disk_size)
+                    await self.tmpfs_pool.acquire(scratch_dir, work_size)
+                    await self.tmpfs_pool.acquire(tmp_dir, tmp_size)
+                elif self.scratch_quota is not None:
+                    await self.scratch_quota.acquire(kernel_id, scratch_dir, tmp_dir,
+                                                     resource_spec.scratch_disk_size)
+                os.makedirs(work_dir)
+                if KernelFeatures.UID_MATCH in kernel_features:
+                    uid = int(environ['LOCAL_USER_ID'])
+                    if os.getuid() == 0:  # only possible when I am root.
+                        os.chown(work_dir, uid, uid)
+                os.makedirs(config_dir)
+                # Store custom environment variables for kernel runner.
+                with open(config_dir / 'environ.txt', 'w') as f:
+                    for k, v in environ.items():
+                        f.write(f'{k}={v}\n')
+                    accel_envs = accel_docker_args.get('Env', [])
+                    for env in accel_envs:
+                        f.write(f'{env}\n')
+                with open(config_dir / 'resource.txt', 'w') as f:
+                    resource_spec.write_to_file(f)
+
+                    # Store accelerator-specific resource-share preparation
+                    for dev_type, dev_shares in resource_spec.shares.items():
+                        if dev_type in KernelResourceSpec.reserved_share_types:
+                            continue
+                        mem_limits = []
+                        proc_limits = []
+                        accl = self.accelerators[dev_type]
+                        for dev_id, dev_share in dev_shares.items():
+                            device = accl.devices[dev_id]
+                            mem, proc = device.share_to_spec(dev_share)
+                            mem_limits.append((dev_id, mem))
+                            proc_limits.append((dev_id, proc))
+                        mlim_str = ','.join(
+                            f'{dev_id}:{mem}' for dev_id, mem in
+                            mem_limits
+                        )
+                        plim_str = ','.join(
+                            f'{dev_id}:{proc}' for dev_id, proc in
+                            proc_limits
+                        )
+                        f.write(f'{dev_type.upper()}_MEMORY_LIMITS={mlim_str}\n')
+                        f.write(f'{dev_type.upper()}_PROCESSOR_LIMITS={plim_str}\n')
+
+            # PHASE 4: Run!
+            log.info('kernel {0} starting with resource spec: \n',
+                     pformat(attr.asdict(resource_spec)))
+
+            # TODO: Refactor out as separate "Docker execution driver plugin" (#68)
+            #   - Refactor volumes/binds lists to a plugin "mount" API
+            #   - Refactor "/home/work" and "/opt/backend.ai" prefixes to be
+            #     specified by the plugin implementation.
+
+            runtime_type = get_label(image_labels, 'runtime-type', 'python')
+            runtime_path = get_label(image_labels, 'runtime-path', None)
+            cmdargs = []
+            if not self.config.skip_jail:
+                cmdargs += [
+                    "/opt/backend.ai/bin/jail",
+                    "-policy", "/etc/backend.ai/jail/policy.yml",
+                ]
+                if self.config.jail_arg:
+                    cmdargs += map(lambda s: s.strip(), self.config.jail_arg)
             cmdargs += [
-                "/opt/backend.ai/bin/jail",
-                "-policy", "/etc/backend.ai/jail/policy.yml",
+                "/opt/backend.ai/bin/python",
+                "-m", "ai.backend.kernel", runtime_type,
             ]
-            if self.config.jail_arg:
-                cmdargs += map(lambda s: s.strip(), self.config.jail_arg)
-        cmdargs += [
-            "/opt/backend.ai/bin/python",
-            "-m", "ai.backend.kernel", runtime_type,
-        ]
-        if runtime_path is not None:
-            cmdargs.append(runtime_path)
-        container_config = {
-            'Image': image_ref.canonical,
-            'Tty': True,
-            'OpenStdin': True,
-            'Privileged': False,
-            'StopSignal': 'SIGINT',
-            'ExposedPorts': {
-                f'{port}/tcp': {} for port in exposed_ports
-            },
-            'EntryPoint': ["/opt/backend.ai/bin/entrypoint.sh"],
-            'Cmd': cmdargs,
-            'Env': [f'{k}={v}' for k, v in environ.items()],
-            'WorkingDir': '/home/work',
-            'HostConfig': {
-                'Init': True,
-                'VolumesFrom': [f'kernel-env.{kernel_id}'],
-                'MemorySwap': 0,
-                'Memory': resource_spec.memory_limit,
-                'CpuPeriod': 100_000,  # docker default
-                'CpuQuota': int(100_000 * resource_spec.shares['_cpu']),
-                'CpusetCpus': ','.join(map(str, sorted(resource_spec.cpu_set))),
-                'CpusetMems': f'{resource_spec.numa_node}',
-                'Binds': binds,
-                'PortBindings': {
-                    f'{eport}/tcp': [{'HostPort': str(hport)}]
-                    for eport, hport in zip(exposed_ports, host_ports)
+            if runtime_path is not None:
+                cmdargs.append(runtime_path)
+            container_config = {
+                'Image': image_ref.canonical,
+                'Tty': True,
+                'OpenStdin': True,
+                'Privileged': False,
+                'StopSignal': 'SIGINT',
+                'ExposedPorts': {
+                    f'{port}/tcp': {} for port in exposed_ports
                 },
-                'PublishAllPorts': False,  # we manage port mapping manually!
-            },
-        }
-        if not self.config.skip_jail:
-            container_config['HostConfig']['SecurityOpt'] = ['seccomp=unconfined']
-        update_nested_dict(container_config, accel_docker_args)
-        kernel_name = f'kernel.{image_ref.name}.{kernel_id}'
-        log.debug('container config: {!r}', container_config)
-
-        # We are all set! Create and start the container.
-        try:
-            env_container = await self.docker.containers.create(config={
-                'Image': f'lablup/backendai-krunner-env:{VERSION}-{distro}',
-            }, name=f'kernel-env.{kernel_id}')
-            container = await self.docker.containers.create(
-                config=container_config, name=kernel_name)
+                'EntryPoint': ["/opt/backend.ai/bin/entrypoint.sh"],
+                'Cmd': cmdargs,
+                'Env': [f'{k}={v}' for k, v in environ.items()],
+                'WorkingDir': '/home/work',
+                'Labels': {
+                    kernel_id_label: kernel_id,
+                },
+                'HostConfig': {
+                    'Init': True,
+                    'MemorySwap': 0,
+                    'Memory': resource_spec.memory_limit,
+                    'CpuPeriod': cpu_period,
+                    'CpuQuota': get_cpu_quota(resource_spec.shares['_cpu']),
+                    'CpusetCpus': ','.join(map(str, sorted(resource_spec.cpu_set))),
+                    'CpusetMems': ','.join(map(str, resource_spec.numa_nodes)),
+                    'Binds': binds,
+                    'PortBindings': {
+                        f'{eport}/tcp': [{'HostPort': str(hport)}]
+                        for eport, hport in zip(exposed_ports, host_ports)
+                    },
+                    'PublishAllPorts': False,  # we manage port mapping manually!
+                },
+            }
+            if not self.config.skip_jail:
+                container_config['HostConfig']['SecurityOpt'] = \
+                    ['seccomp=unconfined']
+            update_nested_dict(container_config, accel_docker_args)
+            kernel_name = f'kernel.{image_ref.name}.{kernel_id}'
+            log.debug('container config: {!r}', container_config)
+
+            # We are all set! Create and start the container.
+            async with self.docker_governor.lane('create'):
+                container = await self.docker.containers.create(
+                    config=container_config, name=kernel_name)
             cid = container._id
+            self.ledger.record_container(kernel_id, cid)
 
             stat_addr = f'tcp://{self.config.agent_host}:{self.config.stat_port}'
             stat_type = get_preferred_stat_type()
             self.stats[cid] = StatCollectorState(kernel_id)
+            started_at = time.time()
             async with spawn_stat_collector(stat_addr, stat_type, cid):
-                await container.start()
+                async with self.docker_governor.lane('start'):
+                    await container.start()
         except Exception:
             # Oops, we have to restore the allocated resources!
-            if sys.platform == 'linux' and self.config.scratch_in_memory:
-                await destroy_scratch_filesystem(scratch_dir)
-                await destroy_scratch_filesystem(tmp_dir)
-            shutil.rmtree(scratch_dir)
-            shutil.rmtree(tmp_dir)
-            self.port_pool.update(host_ports)
-            self.container_cpu_map.free(resource_spec.cpu_set)
-            for dev_type, dev_shares in resource_spec.shares.items():
-                if dev_type in KernelResourceSpec.reserved_share_types:
-                    continue
-                self.accelerators[dev_type].alloc_map.free(dev_shares)
+            await self.discard_scratch(kernel_id, scratch=created_scratch,
+                                       tmp=created_tmp)
+            self._release_resources(resource_spec, host_ports)
+            self.ledger.record_free(kernel_id)
             raise
 
         stdin_port = 0
@@ -1122,11 +1627,13 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         else:
             kernel_host = self.config.agent_host
 
+        self.cpu_deflator.forget(kernel_id)
+        self.memory_reclaimer.forget(kernel_id)
         self.container_registry[kernel_id] = {
             'lang': image_ref,
             'version': version,
             'container_id': container._id,
-            'env_container_id': env_container._id,
+            'env_container_id': None,  # only for kernels of older agents
             'kernel_host': kernel_host,
             'repl_in_port': repl_in_port,
             'repl_out_port': repl_out_port,
@@ -1136,8 +1643,11 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             'host_ports': host_ports,
             'exec_timeout': exec_timeout,
             'last_used': time.monotonic(),
+            'started_at': started_at,
             'runner_tasks': set(),
             'resource_spec': resource_spec,
+            'cpu_rebalance':
+                get_label(image_labels, 'cpu-rebalance', 'yes') != 'no',
         }
         log.debug('kernel repl-in address: {0}:{1}', kernel_host, repl_in_port)
         log.debug('kernel repl-out address: {0}:{1}', kernel_host, repl_out_port)
@@ -1155,6 +1665,156 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             'resource_spec': resource_spec.to_json(),
         }
 
+    def _batch_result(self, kernel_id, result):
+        if isinstance(result, Exception):
+            if isinstance(result, AssertionError):
+                log.error('kernel {0}: assertion failure: {1!r}', kernel_id, result)
+            else:
+                log.error('kernel {0}: unexpected error', kernel_id,
+                          exc_info=result)
+                self.error_monitor.capture_exception(
+                    (type(result), result, result.__traceback__))
+            return {'id': kernel_id, 'status': 'error', 'error': repr(result)}
+        return {'status': 'ok', **result, 'id': kernel_id}
+
+    async def _create_kernels(self, kernel_configs):
+        kernel_ids = [kernel_id for kernel_id, _ in kernel_configs]
+        assert len(set(kernel_ids)) == len(kernel_ids), \
+               'Duplicate kernel IDs in the batch!'
+        results = {}
+
+        # Look up the images and volumes once per batch.
+        image_cache = {}
+        image_refs = {}
+        for kernel_id, config in kernel_configs:
+            image_ref = ImageRef(config['lang'])
+            assert not image_ref.resolve_required(), \
+                   'The manager should have resolved the image reference!'
+            image_refs[kernel_id] = image_ref
+        image_infos = await asyncio.gather(*[
+            self._inspect_image(image_refs[kernel_id], image_cache)
+            for kernel_id in kernel_ids
+        ], return_exceptions=True)
+
+        # Prepare the kernel runner volumes before reserving the resources,
+        # as it may take a while or fail.
+        distros = {}
+        for idx, image_info in enumerate(image_infos):
+            if not isinstance(image_info, Exception):
+                image_props, _ = image_info
+                self.image_cache.touch(image_props['Id'])
+                distros[idx] = get_label(image_props['ContainerConfig']['Labels'],
+                                         'base-distro', 'ubuntu16.04')
+        distro_list = sorted(set(distros.values()))
+        volumes = dict(zip(distro_list, await asyncio.gather(*[
+            self.krunner_volumes.get(distro) for distro in distro_list
+        ], return_exceptions=True)))
+        for idx, distro in distros.items():
+            if isinstance(volumes[distro], Exception):
+                image_infos[idx] = volumes[distro]
+
+        # Reserve the resources for the whole batch without yielding to the
+        # event loop so that either all kernels or none get them.
+        reservations = {}
+        try:
+            for (kernel_id, config), image_info in zip(kernel_configs, image_infos):
+                if isinstance(image_info, Exception):
+                    results[kernel_id] = image_info
+                    continue
+                try:
+                    self._check_new_kernel_id(kernel_id)
+                except AssertionError as e:
+                    results[kernel_id] = e
+                    continue
+                image_props, _ = image_info
+                exposed_ports, _ = self._get_exposed_ports(
+                    image_refs[kernel_id], image_props['ContainerConfig']['Labels'])
+                resource_spec = self._devise_resource_spec(config)
+                host_ports = self._reserve_resources(config, resource_spec,
+                                                     len(exposed_ports))
+                reservations[kernel_id] = (resource_spec, host_ports)
+        except Exception as e:
+            for resource_spec, host_ports in reservations.values():
+                self._release_resources(resource_spec, host_ports)
+            reservations.clear()
+            for kernel_id in kernel_ids:
+                results.setdefault(kernel_id, e)
+
+        # Create and start the containers in parallel.
+        created = await asyncio.gather(*[
+            self._create_kernel(kernel_id, config,
+                                image_cache=image_cache,
+                                reservation=reservations[kernel_id])
+            for kernel_id, config in kernel_configs
+            if kernel_id in reservations
+        ], return_exceptions=True)
+        results.update(zip(reservations.keys(), created))
+        return [self._batch_result(kernel_id, results[kernel_id])
+                for kernel_id in kernel_ids]
+
+    async def _destroy_kernels(self, kernel_ids, reason):
+        last_stats = await asyncio.gather(*[
+            self._destroy_kernel(kernel_id, reason)
+            for kernel_id in kernel_ids
+        ], return_exceptions=True)
+        return [
+            self._batch_result(kernel_id, last_stat)
+            if isinstance(last_stat, Exception)
+            else {'id': kernel_id, 'status': 'ok', 'last_stat': last_stat}
+            for kernel_id, last_stat in zip(kernel_ids, last_stats)
+        ]
+
+    async def _restart_kernel_fast(self, kernel_id, tracker):
+        '''
+        Restart the container of the kernel in place.  Only the processes
+        inside the container are restarted, so the ports, mounts, cgroups and
+        resource allocations are kept as they are.
+        '''
+        kernel_info = self.container_registry[kernel_id]
+        cid = kernel_info['container_id']
+        container = self.docker.containers.container(cid)
+        # monitor() ignores the die events of the kernel until it restarts,
+        # and the late ones by 'started_at'.
+        tracker.in_place = True
+        self.restarting_kernels[kernel_id] = tracker
+        try:
+            await self.clean_runner(kernel_id)
+            try:
+                async with self.docker_governor.lane('kill'):
+                    await container.kill()
+            except DockerError as e:
+                if not (e.status == 409 and 'is not running' in e.message):
+                    raise
+            try:
+                await container.wait()
+                kernel_info['started_at'] = time.time()
+                # The stat collector terminates with the container's cgroup,
+                # so spawn a new one for the restarted container.
+                stat_addr = (f'tcp://{self.config.agent_host}:'
+                             f'{self.config.stat_port}')
+                stat_type = get_preferred_stat_type()
+                async with spawn_stat_collector(stat_addr, stat_type,
+                                                cid) as proc:
+                    self.stats[cid] = StatCollectorState(
+                        kernel_id, collector_pid=proc.pid)
+                    async with self.docker_governor.lane('start'):
+                        await container.start()
+            except Exception:
+                # The container has been killed but its die event was
+                # ignored, so clean up the kernel here.
+                self.restarting_kernels.pop(kernel_id, None)
+                await self.send_event('kernel_terminated',
+                                      kernel_id, 'self-terminated',
+                                      None)
+                await self.cleanup_queue.submit(kernel_id)
+                raise
+        finally:
+            tracker.in_place = False
+            self.restarting_kernels.pop(kernel_id, None)
+            tracker.done_event.set()
+        kernel_info['last_used'] = time.monotonic()
+        log.info('kernel {0} restarted in place', kernel_id)
+
     async def _destroy_kernel(self, kernel_id, reason):
         try:
             cid = self.container_registry[kernel_id]['container_id']
@@ -1169,7 +1829,8 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         container = self.docker.containers.container(cid)
         await self.clean_runner(kernel_id)
         try:
-            await container.kill()
+            async with self.docker_governor.lane('kill'):
+                await container.kill()
             # Collect the last-moment statistics.
             last_stat = None
             if cid in self.stats:
@@ -1193,7 +1854,7 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                         continue
                     self.accelerators[dev_type].alloc_map.free(dev_shares)
                 self.container_registry.pop(kernel_id, None)
-                pass
+                self.ledger.record_free(kernel_id)
             else:
                 log.exception('_destroy_kernel({0}) kill error', kernel_id)
                 self.error_monitor.capture_exception()
@@ -1245,6 +1906,8 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
                                '(might be terminated--try it again)') from None
 
         kernel_info['last_used'] = time.monotonic()
+        self.memory_reclaimer.activate(kernel_id)
+        await self.cpu_deflator.inflate(kernel_id)
         runner = await self._ensure_runner(kernel_id, api_version=api_version)
 
         try:
@@ -1254,8 +1917,11 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             await runner.attach_output_queue(run_id)
 
             if mode == 'batch' or mode == 'query':
-                kernel_info['initial_file_stats'] \
-                    = scandir(output_dir, max_upload_size)
+                output_tracker = kernel_info.get('output_tracker')
+                if output_tracker is None:
+                    output_tracker = OutputChangeTracker(output_dir, max_upload_size)
+                    kernel_info['output_tracker'] = output_tracker
+                output_tracker.begin_run()
             if mode == 'batch':
                 await runner.feed_batch(opts)
             elif mode == 'query':
@@ -1278,21 +1944,23 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
             if runner_tasks is not None:
                 runner_tasks.remove(myself)
 
-        output_files = []
+        # Deliver the files uploaded in the background since the last call.
+        output_files = self.output_uploads.pop_results(kernel_id)
+        pending_files = []
 
         if result['status'] in ('finished', 'exec-timeout'):
 
             log.debug('_execute({0}) {1}', kernel_id, result['status'])
 
-            final_file_stats = scandir(output_dir, max_upload_size)
-            if utils.nmget(result, 'options.upload_output_files', True):
-                # TODO: separate as a new task
-                initial_file_stats = \
-                    kernel_info['initial_file_stats']
-                output_files = await upload_output_files_to_s3(
-                    initial_file_stats, final_file_stats, output_dir, kernel_id)
-
-            kernel_info.pop('initial_file_stats', None)
+            output_tracker = kernel_info.get('output_tracker')
+            if output_tracker is not None:
+                diff_files = output_tracker.end_run()
+            else:
+                diff_files = set()
+            if diff_files and utils.nmget(result, 'options.upload_output_files',
+                                          True):
+                pending_files = self.output_uploads.submit(
+                    kernel_id, run_id, diff_files, output_dir)
 
         if (result['status'] == 'exec-timeout' and
                 kernel_id in self.container_registry):
@@ -1303,6 +1971,7 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
         return {
             **result,
             'files': output_files,
+            'pendingFiles': pending_files,
         }
 
     async def _get_completions(self, kernel_id, text, opts):
@@ -1312,8 +1981,9 @@ class AgentRPCServer(aiozmq.rpc.AttrHandler):
 
     async def _get_logs(self, kernel_id):
         container_id = self.container_registry[kernel_id]['container_id']
-        container = await self.docker.containers.get(container_id)
-        logs = await container.log(stdout=True, stderr=True)
+        async with self.docker_governor.lane('inspect'):
+            container = await self.docker.containers.get(container_id)
+            logs = await container.log(stdout=True, stderr=True)
         return {'logs': ''.join(logs)}
 
     async def _interrupt_kernel(self, kernel_id):
@@ -1439,6 +2109,8 @@ print(json.dumps(files))''' % {'path': path}
             'cuda_slots': self.slots.get('cuda', 0),
             'tpu_slots': self.slots.get('tpu', 0),
             'images': snappy.compress(msgpack.packb(list(self.images))),
+            'image_prefetch': self.image_prefetcher.progress,
+            'cpu_overcommit_slots': round(self.cpu_deflator.reclaimed_cpu, 2),
         }
         try:
             await self.send_event('instance_heartbeat', agent_info)
@@ -1451,7 +2123,11 @@ print(json.dumps(files))''' % {'path': path}
     async def fetch_docker_events(self):
         while True:
             try:
-                await self.docker.events.run()
+                # Receive all die events until the kernels created by older
+                # versions of the agent are gone.
+                filters = get_docker_event_filters(
+                    match_label=not self.unlabeled_kernels)
+                await self.docker.events.run(filters=filters)
             except asyncio.TimeoutError:
                 # The API HTTP connection may terminate after some timeout
                 # (e.g., 5 minutes)
@@ -1469,7 +2145,7 @@ print(json.dumps(files))''' % {'path': path}
 
     async def monitor(self):
         subscriber = self.docker.events.subscribe()
-        last_footprint = None
+        recent_footprints = RecentKeys(capacity=256)
         while True:
             try:
                 evdata = await subscriber.get()
@@ -1479,23 +2155,35 @@ print(json.dumps(files))''' % {'path': path}
                 # fetch_docker_events() will automatically reconnect.
                 continue
 
-            # FIXME: Sometimes(?) duplicate event data is received.
-            # Just ignore the duplicate ones.
-            new_footprint = (
-                evdata['Type'],
-                evdata['Action'],
+            # The same event may be delivered again when the event stream
+            # is reconnected, so ignore the ones we have seen recently.
+            footprint = (
                 evdata['Actor']['ID'],
+                evdata['Action'],
+                evdata.get('timeNano', evdata.get('time')),
             )
-            if new_footprint == last_footprint:
+            if recent_footprints.add(footprint):
                 continue
-            last_footprint = new_footprint
 
             if evdata['Action'] == 'die':
                 # When containers die, we immediately clean up them.
                 container_id = evdata['Actor']['ID']
-                container_name = evdata['Actor']['Attributes']['name']
-                kernel_id = await get_kernel_id_from_container(container_name)
+                attributes = evdata['Actor']['Attributes']
+                kernel_id = attributes.get(kernel_id_label)
                 if kernel_id is None:
+                    kernel_id = await get_kernel_id_from_container(
+                        attributes['name'])
+                if kernel_id is None:
+                    continue
+                tracker = self.restarting_kernels.get(kernel_id)
+                if tracker is not None and tracker.in_place:
+                    # the container is being restarted in place
+                    continue
+                kernel_info = self.container_registry.get(kernel_id)
+                if (kernel_info is not None and 'timeNano' in evdata and
+                        evdata['timeNano'] / 1e9 <
+                        kernel_info.get('started_at', 0)):
+                    # the container has been restarted in place since then
                     continue
                 try:
                     exit_code = evdata['Actor']['Attributes']['exitCode']
@@ -1507,16 +2195,47 @@ print(json.dumps(files))''' % {'path': path}
                 await self.send_event('kernel_terminated',
                                       kernel_id, 'self-terminated',
                                       None)
-                asyncio.ensure_future(self.clean_kernel(kernel_id))
+                await self.cleanup_queue.submit(kernel_id)
+
+    async def discard_scratch(self, kernel_id, *, scratch=True, tmp=True):
+        umount = self.tmpfs_pool is not None
+        callback = None
+        if self.scratch_quota is not None:
+            umount = self.scratch_quota.needs_umount
+            callback = functools.partial(self.scratch_quota.release, kernel_id)
+        scratch_dir = self.config.scratch_root / kernel_id
+        tmp_dir = self.config.scratch_root / f'{kernel_id}_tmp'
+        if scratch:
+            try:
+                await self.scratch_reaper.discard(scratch_dir, umount=umount)
+            except Exception:
+                log.exception('failed to discard the scratch directory {0}',
+                              scratch_dir)
+        if tmp:
+            try:
+                # The reaper deletes the directories in order, so the quota is
+                # released after both are deleted.
+                await self.scratch_reaper.discard(tmp_dir, umount=umount,
+                                                  callback=callback)
+            except Exception:
+                log.exception('failed to discard the scratch directory {0}',
+                              tmp_dir)
 
     async def clean_kernel(self, kernel_id):
+        self.upload_sessions.discard_kernel(kernel_id)
+        self.output_uploads.discard_kernel(kernel_id)
+        self.upload_engine.content_index.discard_kernel(kernel_id)
+        self.unlabeled_kernels.discard(kernel_id)
+        self.cpu_deflator.forget(kernel_id)
+        self.memory_reclaimer.forget(kernel_id)
         try:
             kernel_info = self.container_registry[kernel_id]
 
+            output_tracker = kernel_info.pop('output_tracker', None)
+            if output_tracker is not None:
+                output_tracker.close()
             container_id = kernel_info['container_id']
             env_container_id = kernel_info['env_container_id']
-            container = self.docker.containers.container(container_id)
-            env_container = self.docker.containers.container(env_container_id)
             try:
                 await self.clean_runner(kernel_id)
             finally:
@@ -1524,15 +2243,8 @@ print(json.dumps(files))''' % {'path': path}
                 # containers' host ports may not belong to the new port range.
                 try:
                     if not self.config.debug_skip_container_deletion:
-                        await container.delete()
-                        await env_container.delete()
-                except DockerError as e:
-                    if e.status == 409 and 'already in progress' in e.message:
-                        pass
-                    elif e.status == 404:
-                        pass
-                    else:
-                        log.warning('container deletion: {0!r}', e)
+                        await self.container_deleter.delete(
+                            [container_id, env_container_id])
                 finally:
                     port_range = self.config.container_port_range
                     restored_ports = [*filter(
@@ -1544,16 +2256,7 @@ print(json.dumps(files))''' % {'path': path}
         if kernel_id in self.restarting_kernels:
             self.restarting_kernels[kernel_id].destroy_event.set()
         else:
-            scratch_dir = self.config.scratch_root / kernel_id
-            tmp_dir = self.config.scratch_root / f'{kernel_id}_tmp'
-            try:
-                if sys.platform == 'linux' and self.config.scratch_in_memory:
-                    await destroy_scratch_filesystem(scratch_dir)
-                    await destroy_scratch_filesystem(tmp_dir)
-                shutil.rmtree(scratch_dir)
-                shutil.rmtree(tmp_dir)
-            except FileNotFoundError:
-                pass
+            await self.discard_scratch(kernel_id)
             try:
                 resource_spec = self.container_registry[kernel_id]['resource_spec']
                 self.container_cpu_map.free(resource_spec.cpu_set)
@@ -1562,6 +2265,7 @@ print(json.dumps(files))''' % {'path': path}
                         continue
                     self.accelerators[dev_type].alloc_map.free(dev_shares)
                 self.container_registry.pop(kernel_id, None)
+                self.ledger.record_free(kernel_id)
             except KeyError:
                 pass
             if kernel_id in self.blocking_cleans:
@@ -1674,6 +2378,68 @@ def main():
     parser.add('--scratch-in-memory', action='store_true', default=False,
                help='Keep the scratch and tmp directory in memory '
                     '(only available at Linux)')
+    parser.add('--scratch-size', type=utils.readable_size_to_bytes, default='64M',
+               help='The size limit of the scratch and tmp directories of each '
+                    'kernel in total.  With --scratch-in-memory, it is capped '
+                    'by the memory limit and a quarter of it goes to the tmp '
+                    'directory.  Otherwise, it applies when --scratch-quota '
+                    'is set.')
+    parser.add('--scratch-quota', type=str, default='none',
+               choices=['none', 'auto', 'project', 'loopback'],
+               help='The backend to enforce --scratch-size on disk: XFS/ext4 '
+                    'project quotas ("project"), per-kernel loopback images '
+                    '("loopback"), or the first available one ("auto").')
+    parser.add('--event-batch-interval', type=float, default=0,
+               env_var='BACKEND_EVENT_BATCH_INTERVAL',
+               help='The interval in seconds to send the events to the manager '
+                    'in batches with sequence numbers.  Zero sends each event '
+                    'immediately in the legacy format, which is required for '
+                    'managers not supporting event batches.')
+    parser.add('--event-spill-size', type=utils.readable_size_to_bytes,
+               default='64M',
+               help='The maximum size of the on-disk spill of the event batches '
+                    'which are not sent yet because the manager is slow.')
+    parser.add('--cpu-alloc-policy', type=str, default='legacy',
+               choices=['legacy', *alloc_policies],
+               help='The placement policy of CPU cores: pack the SMT siblings '
+                    'and L3 domains ("pack"), spread across L3 domains '
+                    '("spread"), avoid the siblings of busy cores ("isolate"), '
+                    'or the least shared cores regardless of the topology '
+                    '("legacy").')
+    parser.add('--cpu-rebalance-interval', type=float, default=0,
+               help='The interval in seconds to move the running kernels on '
+                    'contended CPU cores to less loaded ones.  The kernels '
+                    'whose image has the "ai.backend.cpu-rebalance=no" label '
+                    'are not moved.  0 disables it.')
+    parser.add('--density-idle-threshold', type=float, default=0,
+               help='The idle time in seconds after which the CPU quota of the '
+                    'kernels not using CPU is shrunk until their next '
+                    'execution, advertising the reclaimed cores as '
+                    'overcommittable slots.  0 disables it.')
+    parser.add('--memory-reclaim-idle-threshold', type=float, default=0,
+               help='The idle time in seconds after which the page cache and '
+                    'anonymous memory of the kernels not using CPU are '
+                    'gradually reclaimed, backing off while the active '
+                    'kernels are busy with I/O.  0 disables it.')
+    parser.add('--accelerator-alloc-strategy', type=str, default='worst-fit',
+               choices=[*alloc_strategies],
+               help='The placement strategy of accelerator shares: the most free '
+                    'devices first ("worst-fit"), the tightest fitting devices '
+                    '("best-fit"), the NUMA nodes of the allocated CPU cores '
+                    'first ("numa-affine"), or the idle devices for the whole '
+                    'part of the request ("whole-device-first").')
+    parser.add('--image-prefetch-concurrency', type=non_negative_int, default=2,
+               help='The maximum number of concurrent pulls of the kernel images '
+                    'registered in etcd but missing in this agent.  Zero '
+                    'disables the prefetching.')
+    parser.add('--image-cache-low-watermark', type=float, default=10,
+               help='The percentage of the free space of the Docker root disk '
+                    'below which the least recently used kernel images not '
+                    'used by any container are deleted.  Zero disables the '
+                    'eviction.')
+    parser.add('--image-cache-high-watermark', type=float, default=20,
+               help='The percentage of the free space of the Docker root disk '
+                    'at which the image eviction stops.')
     parser.add('--debug-kernel', type=Path, default=None,
                env_var='DEBUG_KERNEL',
                help='Deprecated.')
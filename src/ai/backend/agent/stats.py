@@ -103,6 +103,7 @@ class StatCollectorState:
     kernel_id: str
     last_stat: ContainerStat = None
     terminated: asyncio.Event = field(default_factory=lambda: asyncio.Event())
+    collector_pid: int = None  # if set, ignore the other collectors' stats
 
 
 async def collect_agent_live_stats(agent):
@@ -349,6 +350,7 @@ def join_cgroup_and_namespace(cid, initial_stat, send_stat, signal_sock):
               file=sys.stderr)
         send_stat({
             'cid': args.cid,
+            'pid': os.getpid(),
             'status': 'terminated',
             'data': asdict(initial_stat),
         })
@@ -371,6 +373,7 @@ def join_cgroup_and_namespace(cid, initial_stat, send_stat, signal_sock):
         print('The container has already terminated.', file=sys.stderr)
         send_stat({
             'cid': args.cid,
+            'pid': os.getpid(),
             'status': 'terminated',
             'data': asdict(initial_stat),
         })
@@ -428,6 +431,7 @@ def main(args):
                     stat.update(new_stat)
                     msg = {
                         'cid': args.cid,
+                        'pid': os.getpid(),
                         'data': asdict(stat),
                     }
                     if is_cgroup_running(args.cid) and new_stat is not None:
@@ -452,6 +456,7 @@ def main(args):
                     stat.update(new_stat)
                     msg = {
                         'cid': args.cid,
+                        'pid': os.getpid(),
                         'data': asdict(stat),
                     }
                     if new_stat is not None:
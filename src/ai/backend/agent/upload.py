@@ -0,0 +1,254 @@
+'''
+Chunked, resumable file uploads into kernel working directories.
+
+Instead of receiving a whole file as a single RPC argument, clients open an
+upload session, send the file content as a series of bounded chunks, and
+commit the session when all chunks are received.  Each chunk carries its own
+CRC32 checksum and is written directly at its offset in a partial file, so
+the memory used per upload is bounded by the chunk size.
+'''
+
+import asyncio
+import logging
+import os
+from pathlib import Path
+import secrets
+import time
+from typing import List, MutableMapping, Tuple
+import zlib
+
+import attr
+
+from ai.backend.common.logging import BraceStyleAdapter
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.upload'))
+
+default_chunk_size = 4 * 1024 * 1024  # 4 MiB
+session_idle_timeout = 600.0  # 10 minutes
+
+
+@attr.s(auto_attribs=True, slots=True)
+class UploadSession:
+    upload_id: str
+    kernel_id: str
+    dest_path: Path
+    part_path: Path
+    size: int
+    fd: int
+    last_active: float
+    received: List[Tuple[int, int]] = attr.Factory(list)
+    # The number of executor jobs using the fd.  A closed session keeps its
+    # fd open until they finish, so that the fd number is not reused by
+    # another file under the pending writes.
+    num_writers: int = 0
+    closing: bool = False
+    remove_part: bool = False
+
+    @property
+    def offset(self) -> int:
+        '''
+        The length of the contiguously received prefix of the file.
+        Clients resume an interrupted upload from this offset.
+        '''
+        if self.received and self.received[0][0] == 0:
+            return self.received[0][1]
+        return 0
+
+    @property
+    def is_complete(self) -> bool:
+        return self.offset == self.size
+
+    def mark_received(self, begin: int, end: int):
+        '''
+        Merge the given byte range into the sorted list of received ranges.
+        '''
+        merged = []
+        for rbegin, rend in sorted(self.received + [(begin, end)]):
+            if merged and rbegin <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], rend))
+            else:
+                merged.append((rbegin, rend))
+        self.received = merged
+
+
+class UploadSessionManager:
+    '''
+    Keeps track of the ongoing chunked uploads of an agent.
+    '''
+
+    def __init__(self, scratch_root: Path, *,
+                 chunk_size: int = default_chunk_size,
+                 idle_timeout: float = session_idle_timeout):
+        self.scratch_root = scratch_root
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+        self.sessions: MutableMapping[str, UploadSession] = {}
+
+    def _resolve_dest(self, kernel_id: str, filename: str) -> Path:
+        work_dir = (self.scratch_root / kernel_id / 'work').resolve()
+        if not work_dir.is_dir():
+            raise RuntimeError(f'The working directory of kernel {kernel_id} '
+                               'does not exist.')
+        dest_path = (work_dir / filename).resolve(strict=False)
+        try:
+            dest_path.relative_to(work_dir)
+        except ValueError:
+            raise AssertionError('malformed upload filename and path.')
+        if dest_path == work_dir:
+            raise AssertionError('malformed upload filename and path.')
+        return dest_path
+
+    def _get_session(self, kernel_id: str, upload_id: str) -> UploadSession:
+        session = self.sessions.get(upload_id)
+        if session is None or session.kernel_id != kernel_id:
+            raise AssertionError(f'unknown upload session: {upload_id}')
+        return session
+
+    def _close_session(self, session: UploadSession, *, remove_part: bool):
+        self.sessions.pop(session.upload_id, None)
+        session.closing = True
+        session.remove_part = session.remove_part or remove_part
+        self._release_session(session)
+
+    def _release_session(self, session: UploadSession):
+        if session.num_writers > 0 or session.fd < 0:
+            return
+        try:
+            os.close(session.fd)
+        except OSError:
+            pass
+        session.fd = -1
+        if session.remove_part:
+            try:
+                session.part_path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def expire_idle_sessions(self):
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if now - session.last_active > self.idle_timeout:
+                log.info('expiring idle upload session {0} ({1})',
+                         session.upload_id, session.kernel_id)
+                self._close_session(session, remove_part=True)
+
+    async def begin(self, kernel_id: str, filename: str, size: int) -> dict:
+        '''
+        Open a new upload session, or resume the existing one for the same
+        destination file and size.
+        '''
+        assert size >= 0, 'upload size must not be negative.'
+        loop = asyncio.get_event_loop()
+        self.expire_idle_sessions()
+        dest_path = self._resolve_dest(kernel_id, filename)
+        for session in self.sessions.values():
+            if (session.kernel_id == kernel_id and
+                    session.dest_path == dest_path and
+                    session.size == size):
+                log.debug('resuming upload session {0} at offset {1}',
+                          session.upload_id, session.offset)
+                session.last_active = time.monotonic()
+                break
+        else:
+            upload_id = secrets.token_hex(16)
+            part_dir = self.scratch_root / kernel_id / '.uploads'
+            part_path = part_dir / f'{upload_id}.part'
+
+            def _open_part():
+                part_dir.mkdir(parents=True, exist_ok=True)
+                fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0o644)
+                # Reserve the file length without allocating blocks.
+                os.ftruncate(fd, size)
+                return fd
+
+            fd = await loop.run_in_executor(None, _open_part)
+            session = UploadSession(
+                upload_id=upload_id,
+                kernel_id=kernel_id,
+                dest_path=dest_path,
+                part_path=part_path,
+                size=size,
+                fd=fd,
+                last_active=time.monotonic(),
+            )
+            self.sessions[upload_id] = session
+        return {
+            'upload_id': session.upload_id,
+            'chunk_size': self.chunk_size,
+            'offset': session.offset,
+        }
+
+    async def write_chunk(self, kernel_id: str, upload_id: str,
+                          offset: int, data: bytes, checksum: int) -> dict:
+        '''
+        Write a chunk at the given offset after verifying its CRC32 checksum.
+        Chunks may arrive out of order and may be re-sent after disconnects.
+        '''
+        loop = asyncio.get_event_loop()
+        session = self._get_session(kernel_id, upload_id)
+        assert not session.closing, f'upload session closed: {upload_id}'
+        assert len(data) <= self.chunk_size, 'too large upload chunk.'
+        assert 0 <= offset and offset + len(data) <= session.size, \
+               'upload chunk out of range.'
+        session.last_active = time.monotonic()
+
+        def _write_chunk():
+            if zlib.crc32(data) != checksum:
+                return False
+            view = memoryview(data)
+            written = 0
+            while written < len(view):
+                written += os.pwrite(session.fd, view[written:], offset + written)
+            return True
+
+        session.num_writers += 1
+        try:
+            if not await loop.run_in_executor(None, _write_chunk):
+                raise AssertionError('upload chunk checksum mismatch.')
+        finally:
+            session.num_writers -= 1
+            if session.closing:
+                self._release_session(session)
+        if session.closing:
+            raise AssertionError(f'upload session closed: {upload_id}')
+        session.mark_received(offset, offset + len(data))
+        return {
+            'offset': session.offset,
+        }
+
+    async def commit(self, kernel_id: str, upload_id: str) -> dict:
+        '''
+        Move the completely received file to its destination.
+        '''
+        loop = asyncio.get_event_loop()
+        session = self._get_session(kernel_id, upload_id)
+        if not session.is_complete:
+            raise AssertionError(
+                f'upload incomplete: received {session.offset} of '
+                f'{session.size} bytes.')
+
+        def _finalize():
+            os.fsync(session.fd)
+            session.dest_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(session.part_path, session.dest_path)
+
+        self.sessions.pop(upload_id, None)
+        session.closing = True
+        session.num_writers += 1
+        try:
+            await loop.run_in_executor(None, _finalize)
+        finally:
+            session.num_writers -= 1
+            self._close_session(session, remove_part=True)
+        return {
+            'size': session.size,
+        }
+
+    def discard_kernel(self, kernel_id: str):
+        '''
+        Drop all ongoing uploads of the given kernel (e.g., when it is destroyed).
+        '''
+        for session in list(self.sessions.values()):
+            if session.kernel_id == kernel_id:
+                self._close_session(session, remove_part=True)
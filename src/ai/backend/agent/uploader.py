@@ -0,0 +1,422 @@
+'''
+A concurrent, streaming uploader for kernel output files.
+
+The engine keeps a long-lived S3 client (with its connection pool) for the
+lifetime of the agent and uploads multiple files concurrently up to a fixed
+limit.  Large files are sent as multipart uploads read part-by-part from the
+disk, so that the memory usage is bounded by the part size times the number
+of concurrent uploads, and each part is retried individually upon transient
+errors.
+
+:class:`OutputUploadQueue` runs the uploads in background worker tasks so
+that the code execution results are returned without waiting for them.
+'''
+
+import asyncio
+import logging
+import os
+from pathlib import Path
+import time
+from typing import (
+    Any, Awaitable, Callable, Collection, Dict, List, Mapping, MutableMapping,
+    Optional, Sequence,
+)
+
+import aiohttp
+import attr
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .dedup import ContentDigest, ContentHasher, ContentIndex, digest_of
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.uploader'))
+
+default_max_concurrency = 8
+default_multipart_threshold = 8 * 1024 * 1024  # 8 MiB
+default_part_size = 8 * 1024 * 1024            # 8 MiB (S3 requires >= 5 MiB)
+default_max_retries = 3
+default_num_upload_workers = 4
+default_max_results_per_kernel = 256
+
+
+_retriable_error_codes = frozenset([
+    'InternalError', 'RequestTimeout', 'ServiceUnavailable',
+    'SlowDown', 'Throttling',
+])
+
+
+def _is_retriable(exc: Exception) -> bool:
+    import botocore.exceptions
+    if isinstance(exc, botocore.exceptions.ClientError):
+        error = exc.response.get('Error', {})
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return error.get('Code') in _retriable_error_codes or status >= 500
+    return isinstance(exc, (
+        botocore.exceptions.BotoCoreError,
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+    ))
+
+
+class S3UploadEngine:
+    '''
+    Uploads files to an S3-compatible storage.
+
+    :param endpoint_url: The URL of an S3-compatible storage to use instead
+                         of AWS S3 (e.g., a local MinIO instance for testing).
+    :param client_factory: A callable returning a new S3 client.  If not given,
+                           an aiobotocore client is created with the given
+                           credentials.
+    :param content_index: If given, files are stored under the keys derived
+                          from their contents, and the files whose contents
+                          are the same as previously uploaded objects are not
+                          uploaded again but refer to the existing objects.
+    '''
+
+    def __init__(self, *,
+                 bucket: str,
+                 bucket_path: str,
+                 region: str = None,
+                 access_key: str = None,
+                 secret_key: str = None,
+                 endpoint_url: str = None,
+                 max_concurrency: int = default_max_concurrency,
+                 multipart_threshold: int = default_multipart_threshold,
+                 part_size: int = default_part_size,
+                 max_retries: int = default_max_retries,
+                 retry_delay: float = 0.5,
+                 client_factory: Callable[[], Any] = None,
+                 content_index: ContentIndex = None,
+                 loop=None):
+        assert part_size >= 5 * 1024 * 1024 or client_factory is not None, \
+               'S3 multipart uploads require parts of at least 5 MiB.'
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.bucket = bucket
+        self.bucket_path = bucket_path
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.endpoint_url = endpoint_url
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._client_factory = client_factory
+        self.content_index = content_index
+        self._client = None
+        self._sema = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def client(self):
+        if self._client is None:
+            if self._client_factory is not None:
+                self._client = self._client_factory()
+            else:
+                import aiobotocore  # imported lazily as it is slow to load
+                session = aiobotocore.get_session(loop=self.loop)
+                self._client = session.create_client(
+                    's3', region_name=self.region,
+                    endpoint_url=self.endpoint_url,
+                    aws_secret_access_key=self.secret_key,
+                    aws_access_key_id=self.access_key)
+        return self._client
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def get_key(self, prefix: str, relpath: Path) -> str:
+        return f'{self.bucket_path}/{prefix}/{relpath}'
+
+    def get_content_key(self, digest: ContentDigest) -> str:
+        return f'{self.bucket_path}/sha256/{digest.sha256}'
+
+    def get_url(self, key: str) -> str:
+        if self.endpoint_url:
+            return f'{self.endpoint_url.rstrip("/")}/{self.bucket}/{key}'
+        return f'https://{self.bucket}.s3.amazonaws.com/{key}'
+
+    async def _retry(self, coro_func: Callable, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return await coro_func(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries or not _is_retriable(e):
+                    raise
+                log.debug('retrying S3 request ({0}/{1}) after {2!r}',
+                          attempt, self.max_retries, e)
+                await asyncio.sleep(self.retry_delay * (2 ** (attempt - 1)))
+
+    async def _read_part(self, fd: int, offset: int, size: int,
+                         hasher: ContentHasher) -> bytes:
+        def _read():
+            data = os.pread(fd, size, offset)
+            hasher.update(data)
+            return data
+        return await self.loop.run_in_executor(None, _read)
+
+    async def _put_object(self, key: str, content: bytes):
+        await self._retry(self.client.put_object,
+                          Bucket=self.bucket, Key=key,
+                          Body=content, ACL='public-read')
+
+    async def _put_multipart(self, path: Path, key: str, size: int, *,
+                             expected: ContentDigest = None):
+        hasher = ContentHasher()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            resp = await self._retry(self.client.create_multipart_upload,
+                                     Bucket=self.bucket, Key=key,
+                                     ACL='public-read')
+        except BaseException:
+            os.close(fd)
+            raise
+        upload_id = resp['UploadId']
+        parts = []
+        try:
+            for part_number, offset in enumerate(range(0, size, self.part_size),
+                                                 start=1):
+                body = await self._read_part(fd, offset, self.part_size, hasher)
+                resp = await self._retry(self.client.upload_part,
+                                         Bucket=self.bucket, Key=key,
+                                         UploadId=upload_id,
+                                         PartNumber=part_number,
+                                         Body=body)
+                parts.append({'ETag': resp['ETag'], 'PartNumber': part_number})
+                del body
+            if expected is not None and hasher.digest() != expected:
+                # Never store other contents under a content-derived key.
+                raise IOError(f'{path} has changed during the upload')
+            await self._retry(self.client.complete_multipart_upload,
+                              Bucket=self.bucket, Key=key, UploadId=upload_id,
+                              MultipartUpload={'Parts': parts})
+        except BaseException:
+            try:
+                await self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id)
+            except Exception:
+                log.warning('could not abort the multipart upload of {0}', key)
+            raise
+        finally:
+            os.close(fd)
+
+    async def upload_file(self, path: Path, key: str) -> str:
+        '''
+        Upload a single file and return its public URL.
+        '''
+        async with self._sema:
+            size = (await self.loop.run_in_executor(None, path.stat)).st_size
+            if size < self.multipart_threshold:
+                content = await self.loop.run_in_executor(None, path.read_bytes)
+                await self._put_object(key, content)
+            else:
+                await self._put_multipart(path, key, size)
+        return self.get_url(key)
+
+    async def _upload_deduplicated(self, path: Path, prefix: str,
+                                   name: str) -> str:
+        # The small files are hashed from the bytes read for the upload,
+        # while the large ones are read twice: to hash them for their keys,
+        # and then to upload them part by part.
+        def _read():
+            data = path.read_bytes()
+            hasher = ContentHasher()
+            hasher.update(data)
+            return data, hasher.digest()
+
+        async with self._sema:
+            size = (await self.loop.run_in_executor(None, path.stat)).st_size
+            content: Optional[bytes] = None
+            if size < self.multipart_threshold:
+                content, digest = await self.loop.run_in_executor(None, _read)
+            else:
+                digest = await self.loop.run_in_executor(None, digest_of, path)
+            url = self.content_index.lookup(prefix, name, digest)
+            if url is not None:
+                log.debug('skipping upload of {0} (same as {1})', name, url)
+                return url
+            key = self.get_content_key(digest)
+            if content is not None:
+                await self._put_object(key, content)
+            else:
+                await self._put_multipart(path, key, digest.size,
+                                          expected=digest)
+        url = self.get_url(key)
+        self.content_index.add(prefix, name, digest, url)
+        return url
+
+    async def upload_files(self, paths: Collection[Path], base_dir: Path,
+                           prefix: str) -> Sequence[Mapping[str, str]]:
+        '''
+        Upload the given files concurrently and return the list of successfully
+        uploaded files with their names relative to ``base_dir`` and URLs.
+        '''
+        import botocore.exceptions
+        base_dir = Path(base_dir).resolve()
+        paths = [Path(p) for p in paths]
+        relpaths = [p.resolve().relative_to(base_dir) for p in paths]
+
+        async def _upload(path, relpath):
+            try:
+                if self.content_index is not None:
+                    url = await self._upload_deduplicated(path, prefix,
+                                                          str(relpath))
+                else:
+                    url = await self.upload_file(path,
+                                                 self.get_key(prefix, relpath))
+            except (botocore.exceptions.BotoCoreError,
+                    botocore.exceptions.ClientError) as exc:
+                log.exception('S3 upload error {!r}', exc)
+            except IOError:
+                log.exception('Could not read output file')
+            else:
+                return {
+                    'name': str(relpath),
+                    'url': url,
+                }
+            return None
+
+        results = await asyncio.gather(*[
+            _upload(path, relpath) for path, relpath in zip(paths, relpaths)
+        ])
+        return [r for r in results if r is not None]
+
+
+@attr.s(auto_attribs=True, slots=True)
+class OutputUploadJob:
+    kernel_id: str
+    run_id: str
+    paths: Collection[Path]
+    base_dir: Path
+    queued_at: float = attr.Factory(time.monotonic)
+    cancelled: bool = False
+
+
+class OutputUploadQueue:
+    '''
+    Uploads the output files of finished runs in background worker tasks.
+
+    :meth:`submit` returns immediately with the list of pending files.
+    When a job finishes, ``notify_func(kernel_id, run_id, files)`` is called
+    and the uploaded files are kept until they are taken by
+    :meth:`pop_results` (i.e., in the next ``execute()`` call of the kernel).
+    Jobs of the same kernel are processed one by one in the order of
+    submission so that a later run always overwrites earlier objects.
+
+    :param upload_func: A coroutine function with the signature of
+                        ``upload_files_to_s3(paths, base_dir, prefix)``.
+    '''
+
+    def __init__(self, upload_func: Callable[..., Awaitable[Sequence[Mapping]]],
+                 *,
+                 notify_func: Callable[..., Awaitable[None]] = None,
+                 stats_monitor=None,
+                 num_workers: int = default_num_upload_workers,
+                 max_results_per_kernel: int = default_max_results_per_kernel,
+                 loop=None):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.upload_func = upload_func
+        self.notify_func = notify_func
+        self.stats_monitor = stats_monitor
+        self.num_workers = num_workers
+        self.max_results_per_kernel = max_results_per_kernel
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self._jobs: MutableMapping[str, List[OutputUploadJob]] = {}
+        self._kernel_locks: Dict[str, asyncio.Lock] = {}
+        self._results: MutableMapping[str, List[Mapping[str, Any]]] = {}
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        for _ in range(self.num_workers - len(self._workers)):
+            self._workers.append(self.loop.create_task(self._work()))
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def join(self):
+        await self._queue.join()
+
+    def _report(self, report_type: str, metric: str, value):
+        if self.stats_monitor is not None:
+            self.stats_monitor.report_stats(
+                report_type, f'ai.backend.agent.output_uploads.{metric}', value)
+
+    def submit(self, kernel_id: str, run_id: str,
+               paths: Collection[Path], base_dir: Path) -> Sequence[Mapping]:
+        '''
+        Enqueue an upload job and return the names of the pending files.
+        '''
+        base_dir = Path(base_dir).resolve()
+        job = OutputUploadJob(kernel_id, run_id, list(paths), base_dir)
+        self._jobs.setdefault(kernel_id, []).append(job)
+        self._queue.put_nowait(job)
+        self._report('gauge', 'queue_depth', self._queue.qsize())
+        return [
+            {'name': str(Path(p).resolve().relative_to(base_dir)), 'url': None}
+            for p in job.paths
+        ]
+
+    def pop_results(self, kernel_id: str) -> Sequence[Mapping[str, Any]]:
+        '''
+        Take the files uploaded since the last call for the given kernel.
+        '''
+        return self._results.pop(kernel_id, [])
+
+    def discard_kernel(self, kernel_id: str):
+        for job in self._jobs.pop(kernel_id, []):
+            job.cancelled = True
+        self._results.pop(kernel_id, None)
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                self._report('gauge', 'queue_depth', self._queue.qsize())
+                if job.cancelled:
+                    continue
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('output upload error (k:{0}, run:{1})',
+                              job.kernel_id, job.run_id)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job: OutputUploadJob):
+        lock = self._kernel_locks.setdefault(job.kernel_id, asyncio.Lock())
+        try:
+            async with lock:
+                if job.cancelled:
+                    return
+                self._report('timing', 'queue_delay',
+                             (time.monotonic() - job.queued_at) * 1000)
+                files = await self.upload_func(job.paths, job.base_dir,
+                                               job.kernel_id)
+        finally:
+            jobs = self._jobs.get(job.kernel_id)
+            if jobs is not None:
+                jobs.remove(job)
+                if not jobs:
+                    del self._jobs[job.kernel_id]
+            if job.kernel_id not in self._jobs:
+                self._kernel_locks.pop(job.kernel_id, None)
+        if job.cancelled:
+            return
+        self._report('timing', 'latency',
+                     (time.monotonic() - job.queued_at) * 1000)
+        files = [{**f, 'runId': job.run_id} for f in files]
+        results = self._results.setdefault(job.kernel_id, [])
+        results.extend(files)
+        del results[:-self.max_results_per_kernel]
+        if self.notify_func is not None:
+            await self.notify_func(job.kernel_id, job.run_id, files)
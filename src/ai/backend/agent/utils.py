@@ -1,4 +1,5 @@
-from typing import MutableMapping, Sequence
+from collections import OrderedDict
+from typing import Hashable, MutableMapping, Sequence
 
 
 def update_nested_dict(dest, additions):
@@ -14,3 +15,34 @@ def update_nested_dict(dest, additions):
                 dest[k].extend(v)
             else:
                 dest[k] = v
+
+
+class RecentKeys:
+    '''
+    Remembers the most recently added keys up to the given capacity,
+    forgetting the least recently added ones first.
+    '''
+
+    __slots__ = ('capacity', '_keys')
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self._keys: MutableMapping[Hashable, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._keys
+
+    def add(self, key: Hashable) -> bool:
+        '''
+        Add the key and return whether it has been already seen.
+        '''
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return True
+        self._keys[key] = None
+        if len(self._keys) > self.capacity:
+            self._keys.popitem(last=False)
+        return False
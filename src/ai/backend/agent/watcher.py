@@ -0,0 +1,241 @@
+'''
+Tracks changes of kernel output files using Linux inotify.
+
+Scanning the whole output directory before and after each run costs time
+proportional to the number of files in it.  Instead, the tracker keeps an
+inotify watch on every (non-hidden) directory of the output tree and
+accumulates the paths created or modified while a run is in progress.
+
+When inotify is not available, the watch limit is exceeded, or the event
+queue overflows, the tracker falls back to directory scans transparently.
+'''
+
+import asyncio
+import ctypes
+import errno
+import logging
+import os
+from pathlib import Path
+import struct
+import sys
+import time
+from typing import MutableMapping, Set
+
+from ai.backend.common.logging import BraceStyleAdapter
+from .files import scandir, diff_file_stats
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.agent.watcher'))
+
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = 0o2000000
+
+_watch_mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE |
+               IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+_event_header = struct.Struct('iIII')
+
+_libc = None
+if sys.platform == 'linux':
+    try:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    except OSError:
+        pass
+
+
+def inotify_available() -> bool:
+    return _libc is not None and hasattr(_libc, 'inotify_init1')
+
+
+class WatchLimitExceeded(Exception):
+    pass
+
+
+class OutputChangeTracker:
+    '''
+    Collects the set of new or modified files in a directory tree during
+    a code execution run.
+
+    Call :meth:`begin_run` before feeding the code to the kernel and
+    :meth:`end_run` when the run has finished.
+    '''
+
+    def __init__(self, root: Path, allowed_max_size: int, *,
+                 max_watches: int = 4096, loop=None):
+        self.root = root
+        self.allowed_max_size = allowed_max_size
+        self.max_watches = max_watches
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self._fd = -1
+        self._watches: MutableMapping[int, Path] = {}
+        self._changed: Set[Path] = set()
+        self._overflowed = False
+        self._run_started: float = None
+        self._initial_file_stats = None
+
+    @property
+    def is_armed(self) -> bool:
+        return self._fd >= 0
+
+    def _add_watch(self, path: Path):
+        if len(self._watches) >= self.max_watches:
+            raise WatchLimitExceeded
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(str(path)), _watch_mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchLimitExceeded
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # removed before we could watch it
+                return
+            raise OSError(err, os.strerror(err), str(path))
+        self._watches[wd] = path
+
+    def _add_watch_tree(self, path: Path, *, collect_files: bool = False):
+        self._add_watch(path)
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                self._add_watch_tree(Path(entry.path), collect_files=collect_files)
+            elif collect_files:
+                # Files created before the watch was installed on a new
+                # directory would be missed otherwise.
+                self._changed.add(Path(entry.path))
+
+    def _arm(self) -> bool:
+        if not inotify_available() or not self.root.is_dir():
+            return False
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            log.warning('inotify_init1() failed: {0}', os.strerror(err))
+            return False
+        self._fd = fd
+        try:
+            self._add_watch_tree(self.root)
+        except WatchLimitExceeded:
+            log.warning('too many directories to watch in {0}; '
+                        'falling back to directory scans', self.root)
+            self.close()
+            return False
+        except OSError as e:
+            log.warning('cannot watch {0}: {1!r}', self.root, e)
+            self.close()
+            return False
+        self.loop.add_reader(self._fd, self._read_events)
+        return True
+
+    def _read_events(self):
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                self._overflowed = True
+                return
+            if not buf:
+                return
+            self._process_events(buf)
+
+    def _process_events(self, buf: bytes):
+        offset = 0
+        while offset + _event_header.size <= len(buf):
+            wd, mask, _, name_len = _event_header.unpack_from(buf, offset)
+            offset += _event_header.size
+            name = buf[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                self._overflowed = True
+                continue
+            parent = self._watches.get(wd)
+            if parent is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                if parent == self.root:
+                    self._overflowed = True
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if parent == self.root:
+                    self._overflowed = True
+                continue
+            if not name:
+                continue
+            name = os.fsdecode(name)
+            if name.startswith('.'):
+                continue
+            path = parent / name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._add_watch_tree(path, collect_files=True)
+                    except (WatchLimitExceeded, OSError):
+                        self._overflowed = True
+            else:
+                self._changed.add(path)
+
+    def begin_run(self):
+        self._run_started = time.time()
+        self._initial_file_stats = None
+        if self.is_armed and self._overflowed:
+            self.close()
+        if not self.is_armed:
+            self._overflowed = False
+            if not self._arm():
+                self._initial_file_stats = scandir(self.root,
+                                                   self.allowed_max_size)
+                return
+        self._read_events()
+        self._changed.clear()
+
+    def end_run(self) -> Set[Path]:
+        '''
+        Return the set of files created or modified since :meth:`begin_run`.
+        '''
+        if self._initial_file_stats is not None:
+            final_file_stats = scandir(self.root, self.allowed_max_size)
+            return diff_file_stats(self._initial_file_stats, final_file_stats)
+        if self._run_started is None:
+            return set()
+        self._read_events()
+        if self._overflowed:
+            log.debug('inotify event overflow in {0}; '
+                      'falling back to directory scans', self.root)
+            return {
+                path for path, mtime
+                in scandir(self.root, self.allowed_max_size).items()
+                if mtime >= self._run_started
+            }
+        changed = set()
+        for path in self._changed:
+            try:
+                stat = path.stat()
+            except (FileNotFoundError, PermissionError):
+                continue
+            if not path.is_file() or stat.st_size > self.allowed_max_size:
+                continue
+            changed.add(path)
+        self._changed.clear()
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            self.loop.remove_reader(self._fd)
+            os.close(self._fd)
+        self._fd = -1
+        self._watches.clear()
+        self._changed.clear()
@@ -0,0 +1,153 @@
+from decimal import Decimal
+import random
+
+import attr
+import pytest
+
+from ai.backend.agent.accelalloc import (
+    AcceleratorAllocMap, alloc_strategies, from_quanta, to_quanta,
+)
+from ai.backend.agent.accelerator import (
+    AbstractAccelerator, AbstractAcceleratorInfo, accelerator_types,
+)
+
+
+@attr.s(auto_attribs=True)
+class FakeAcceleratorInfo(AbstractAcceleratorInfo):
+    fractional: bool = True
+
+    def is_fractional(self):
+        return self.fractional
+
+    def max_share(self):
+        return Decimal(self.processing_units)
+
+    def share_to_spec(self, share):
+        return (int(self.memory_size * share / self.max_share()),
+                int(self.processing_units * share / self.max_share()))
+
+    def spec_to_share(self, requested_memory, requested_proc_units):
+        return max(Decimal(requested_memory) / self.memory_size,
+                   Decimal(requested_proc_units) / self.processing_units)
+
+
+class FakeAccelerator(AbstractAccelerator):
+
+    slot_key = 'fake'
+
+    @classmethod
+    def list_devices(cls):
+        # 2 nodes x 2 devices of 1 share
+        return [
+            FakeAcceleratorInfo(f'fake{i}', f'00:0{i}', i // 2, 2 ** 30, 1)
+            for i in range(4)
+        ]
+
+    @classmethod
+    def get_hooks(cls, distro, arch):
+        return []
+
+    @classmethod
+    async def generate_docker_args(cls, docker, limit_gpus=None):
+        return {}
+
+
+@pytest.fixture
+def fake_plugin(monkeypatch):
+    monkeypatch.setitem(accelerator_types, 'fake', FakeAccelerator)
+    return FakeAccelerator
+
+
+def create_alloc_map(strategy):
+    devices = accelerator_types['fake'].list_devices()
+    return AcceleratorAllocMap(devices, strategy=strategy)
+
+
+def test_quanta():
+    assert to_quanta(Decimal('1.5')) == 150
+    assert to_quanta(Decimal('0.129')) == 12
+    assert from_quanta(150) == Decimal('1.5')
+
+
+def test_unknown_strategy(fake_plugin):
+    with pytest.raises(ValueError):
+        create_alloc_map('first-fit')
+
+
+def test_worst_fit(fake_plugin):
+    alloc_map = create_alloc_map('worst-fit')
+    assert alloc_map.alloc(Decimal('0.5')) == (0, {'fake0': Decimal('0.5')})
+    assert alloc_map.alloc(Decimal('0.5')) == (1, {'fake2': Decimal('0.5')})
+    # The most free device in the least loaded node
+    assert alloc_map.alloc(Decimal('0.3')) == (0, {'fake1': Decimal('0.3')})
+    assert alloc_map.node_used == {0: 80, 1: 50}
+    assert alloc_map.node_free == {0: 120, 1: 150}
+
+
+def test_best_fit(fake_plugin):
+    alloc_map = create_alloc_map('best-fit')
+    alloc_map.update({'fake0': Decimal('0.5'), 'fake2': Decimal('0.2')})
+    # The tightest device which fits the request
+    assert alloc_map.alloc(Decimal('0.4')) == (0, {'fake0': Decimal('0.4')})
+    assert alloc_map.alloc(Decimal('0.8')) == (1, {'fake2': Decimal('0.8')})
+    # The tighter node among the ones with an idle device
+    assert alloc_map.alloc(Decimal('1.0')) == (1, {'fake3': Decimal('1.0')})
+
+
+def test_numa_affine(fake_plugin):
+    alloc_map = create_alloc_map('numa-affine')
+    alloc_map.update({'fake2': Decimal('0.5')})
+    node, shares = alloc_map.alloc(Decimal('0.5'), cpu_nodes=[1])
+    assert node == 1
+    assert shares == {'fake3': Decimal('0.5')}
+    # Falls back to the other nodes.
+    node, shares = alloc_map.alloc(Decimal('1.5'), cpu_nodes=[1])
+    assert node == 0
+    assert shares == {'fake0': Decimal('1.0'), 'fake1': Decimal('0.5')}
+
+
+def test_whole_device_first(fake_plugin):
+    alloc_map = create_alloc_map('whole-device-first')
+    alloc_map.update({'fake1': Decimal('0.5')})
+    node, shares = alloc_map.alloc(Decimal('1.25'))
+    assert node == 0
+    # The whole part from the idle device, the rest from the used one.
+    assert shares == {'fake0': Decimal('1'), 'fake1': Decimal('0.25')}
+
+
+def test_non_fractional_devices():
+    devices = [
+        FakeAcceleratorInfo('fake0', '00:00', 0, 2 ** 30, 1, fractional=False),
+        FakeAcceleratorInfo('fake1', '00:01', 0, 2 ** 30, 1, fractional=False),
+    ]
+    alloc_map = AcceleratorAllocMap(devices)
+    with pytest.raises(RuntimeError):
+        alloc_map.alloc(Decimal('0.5'))
+    assert alloc_map.alloc(Decimal('1')) == (0, {'fake0': Decimal('1')})
+    with pytest.raises(RuntimeError):
+        alloc_map.alloc(Decimal('1.5'))
+    assert alloc_map.device_shares == {'fake0': 1, 'fake1': 0}
+
+
+@pytest.mark.parametrize('strategy', sorted(alloc_strategies))
+def test_alloc_free_consistency(fake_plugin, strategy):
+    alloc_map = create_alloc_map(strategy)
+    rng = random.Random(42)
+    live = []
+    for _ in range(500):
+        if live and rng.random() < 0.5:
+            alloc_map.free(live.pop(rng.randrange(len(live))))
+            continue
+        try:
+            _, shares = alloc_map.alloc(rng.choice(
+                [Decimal('0.1'), Decimal('0.5'), Decimal('1'), Decimal('1.7')]))
+        except RuntimeError:
+            continue
+        live.append(shares)
+        assert all(q <= alloc_map.capacity[p]
+                   for p, q in alloc_map.used.items())
+    for shares in live:
+        alloc_map.free(shares)
+    assert set(alloc_map.used.values()) == {0}
+    assert alloc_map.node_used == {0: 0, 1: 0}
+    assert alloc_map.node_free == {0: 200, 1: 200}
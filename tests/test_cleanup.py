@@ -0,0 +1,100 @@
+import asyncio
+
+from aiodocker.exceptions import DockerError
+import pytest
+
+from ai.backend.agent.cleanup import ContainerDeleter, KernelCleanupQueue
+from ai.backend.agent.governor import DockerGovernor
+
+
+@pytest.mark.asyncio
+async def test_cleanup_workers_are_bounded():
+    running = 0
+    max_running = 0
+    cleaned = []
+
+    async def clean(kernel_id):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        cleaned.append(kernel_id)
+
+    queue = KernelCleanupQueue(clean, num_workers=3)
+    queue.start()
+    try:
+        for idx in range(20):
+            await queue.submit(f'k{idx}')
+        await queue.submit('k19')  # duplicate submissions are ignored
+        await queue.join()
+    finally:
+        await queue.stop()
+    assert max_running == 3
+    assert sorted(cleaned) == sorted(f'k{idx}' for idx in range(20))
+    assert queue.depth == 0
+
+
+@pytest.mark.asyncio
+async def test_cleanup_back_pressure():
+    release = asyncio.Event()
+
+    async def clean(kernel_id):
+        await release.wait()
+
+    queue = KernelCleanupQueue(clean, num_workers=1, max_pending=2)
+    queue.start()
+    try:
+        await queue.submit('k1')
+        await asyncio.sleep(0)  # let the worker take k1
+        await queue.submit('k2')
+        await queue.submit('k3')
+        blocked = asyncio.ensure_future(queue.submit('k4'))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        assert queue.depth == 4
+        release.set()
+        await blocked
+        await queue.join()
+    finally:
+        await queue.stop()
+    assert queue.depth == 0
+
+
+class FakeContainer:
+
+    def __init__(self, docker, container_id):
+        self.docker = docker
+        self.container_id = container_id
+
+    async def delete(self):
+        await asyncio.sleep(0.01)
+        if self.container_id in self.docker.missing:
+            raise DockerError(404, {'message': 'no such container'})
+        self.docker.deleted.append(self.container_id)
+
+
+class FakeDocker:
+
+    def __init__(self):
+        self.deleted = []
+        self.missing = set()
+        self.containers = self
+
+    def container(self, container_id):
+        return FakeContainer(self, container_id)
+
+    async def _query_json(self, *args, **kwargs):
+        raise AssertionError('no other API calls are expected')
+
+
+@pytest.mark.asyncio
+async def test_container_deleter_deletes_only_requested():
+    docker = FakeDocker()
+    docker.missing.add('c3')
+    deleter = ContainerDeleter(docker, governor=DockerGovernor())
+    await asyncio.gather(
+        deleter.delete(['c1', None]),
+        deleter.delete(['c2', 'c3']),
+    )
+    assert sorted(docker.deleted) == ['c1', 'c2']
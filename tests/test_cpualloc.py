@@ -0,0 +1,120 @@
+import random
+
+import pytest
+
+from ai.backend.agent.cpualloc import (
+    CPUTopology, TopologyAwareCPUAllocMap, parse_cpu_list,
+)
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list('0-3,8,10-11\n') == {0, 1, 2, 3, 8, 10, 11}
+    assert parse_cpu_list('') == set()
+
+
+def test_read_topology(tmp_path, mocker):
+    mocker.patch('ai.backend.agent.cpualloc.libnuma.get_available_cores',
+                 return_value={0, 1, 2, 3})
+    for core in range(4):
+        cpu_path = tmp_path / f'cpu{core}'
+        (cpu_path / 'topology').mkdir(parents=True)
+        (cpu_path / f'node{core // 2}').mkdir()
+        (cpu_path / 'topology' / 'thread_siblings_list').write_text(
+            f'{core % 2},{core % 2 + 2}\n' if core < 2 else f'{core - 2},{core}\n')
+        for index, level in enumerate(['1', '2', '3']):
+            index_path = cpu_path / 'cache' / f'index{index}'
+            index_path.mkdir(parents=True)
+            (index_path / 'level').write_text(level + '\n')
+            (index_path / 'shared_cpu_list').write_text(
+                '0-1\n' if core < 2 else '2-3\n')
+    topo = CPUTopology.read([0, 1, 2], sysfs_path=tmp_path)
+    assert sorted(topo.cores) == [0, 1, 2]
+    assert topo.cores[0].node == 0
+    assert topo.cores[2].node == 1
+    assert topo.cores[0].siblings == {2}
+    assert topo.cores[1].siblings == frozenset()  # core 3 is not available
+    assert topo.l3_domains == {0: [0, 1], 2: [2]}
+
+
+def create_alloc_map(policy):
+    # 2 nodes x 2 L3 domains x 4 cores x 2 threads
+    topo = CPUTopology.synthetic(num_nodes=2, l3_per_node=2, cores_per_l3=4)
+    assert len(topo.cores) == 32
+    assert topo.cores[0].siblings == {16}
+    return TopologyAwareCPUAllocMap(topo, policy=policy)
+
+
+def test_pack_policy():
+    alloc_map = create_alloc_map('pack')
+    node, cores = alloc_map.alloc(4)
+    assert node == 0
+    # The siblings are packed in the first L3 domain.
+    assert cores == {0, 16, 1, 17}
+    node, cores = alloc_map.alloc(2)
+    assert node == 1
+    assert cores == {8, 24}
+
+
+def test_spread_policy():
+    alloc_map = create_alloc_map('spread')
+    node, cores = alloc_map.alloc(4)
+    assert node == 0
+    # Two physical cores from each L3 domain of the node.
+    assert {alloc_map.topology.cores[c].l3 for c in cores} == {0, 4}
+    assert all(not (alloc_map.topology.cores[c].siblings & cores)
+               for c in cores)
+
+
+def test_isolate_policy():
+    alloc_map = create_alloc_map('isolate')
+    alloc_map.update({0, 1})
+    _, cores = alloc_map.alloc(6)
+    # The siblings of the busy cores (16, 17) are avoided.
+    assert cores.isdisjoint({0, 1, 16, 17})
+    assert alloc_map.core_shares[16] == 0
+
+
+@pytest.mark.parametrize('policy', ['pack', 'spread', 'isolate'])
+def test_alloc_free_consistency(policy):
+    alloc_map = create_alloc_map(policy)
+    rng = random.Random(42)
+    allocated = []
+    for _ in range(500):
+        if allocated and rng.random() < 0.5:
+            alloc_map.free(allocated.pop(rng.randrange(len(allocated))))
+        else:
+            _, cores = alloc_map.alloc(rng.randint(1, 16))
+            assert len({alloc_map.topology.cores[c].node for c in cores}) == 1
+            allocated.append(cores)
+    expected = {c: 0 for c in alloc_map.core_shares}
+    for cores in allocated:
+        for c in cores:
+            expected[c] += 1
+    assert alloc_map.core_shares == expected
+    assert sum(alloc_map.alloc_per_node.values()) == sum(expected.values())
+    for cores in allocated:
+        alloc_map.free(cores)
+    assert set(alloc_map.core_shares.values()) == {0}
+
+    # Even after the churn, the least shared cores are picked.
+    alloc_map.update(set(range(15)))
+    _, cores = alloc_map.alloc(1)
+    assert alloc_map.core_shares[next(iter(cores))] == 1
+    _, cores = alloc_map.alloc(16)
+    assert len(cores) == 16
+
+
+def test_alloc_multi_node():
+    alloc_map = create_alloc_map('pack')
+    nodes, cores = alloc_map.alloc_multi_node(8)
+    assert nodes == [0]
+    assert {alloc_map.topology.cores[c].node for c in cores} == {0}
+    # 20 cores do not fit in a node of 16 cores.
+    nodes, cores = alloc_map.alloc_multi_node(20)
+    assert nodes == [0, 1]
+    assert len(cores) == 20
+    per_node = [sum(1 for c in cores if alloc_map.topology.cores[c].node == n)
+                for n in nodes]
+    assert sorted(per_node) == [10, 10]
+    alloc_map.free(cores)
+    assert alloc_map.alloc_per_node == {0: 8, 1: 0}
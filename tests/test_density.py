@@ -0,0 +1,241 @@
+import asyncio
+import errno
+
+from aiodocker.exceptions import DockerError
+import pytest
+
+from ai.backend.agent import density
+from ai.backend.agent.density import (
+    CPUDeflator, IdleCandidate, MemoryReclaimer,
+    default_cpu_shares, deflated_cpu_quota, deflated_cpu_shares, get_cpu_quota,
+    get_memory_cgroup,
+)
+from ai.backend.agent.governor import DockerGovernor
+
+
+class FakeDocker:
+
+    def __init__(self):
+        self.updates = []
+        self.missing = set()
+
+    async def _query_json(self, path, method='GET', *, data=None, **kwargs):
+        container_id = path.split('/')[1]
+        await asyncio.sleep(0.01)
+        if container_id in self.missing:
+            raise DockerError(404, {'message': 'no such container'})
+        self.updates.append((container_id, data))
+        return {'Warnings': None}
+
+
+def create_deflator(docker, **kwargs):
+    return CPUDeflator(docker, governor=DockerGovernor(), idle_threshold=600,
+                       **kwargs)
+
+
+def test_get_cpu_quota():
+    assert get_cpu_quota(2) == 200_000
+
+
+@pytest.mark.asyncio
+async def test_deflate_and_inflate(mocker):
+    docker = FakeDocker()
+    deflator = create_deflator(docker)
+    clock = mocker.patch('ai.backend.agent.density.time').monotonic
+    clock.return_value = 1000.0
+    candidates = [
+        # idle
+        IdleCandidate('k1', 'c1', 200_000, 100.0, cpu_used=1000.0),
+        # busy
+        IdleCandidate('k2', 'c2', 200_000, 100.0, cpu_used=1000.0),
+        # recently used
+        IdleCandidate('k3', 'c3', 200_000, 900.0, cpu_used=1000.0),
+        # no stats yet
+        IdleCandidate('k4', 'c4', 200_000, 100.0),
+    ]
+    # The first check only samples the CPU usage.
+    assert await deflator.deflate_idle(candidates) == []
+    clock.return_value = 1060.0
+    candidates[0].cpu_used = 1100.0    # 0.0017 cores
+    candidates[1].cpu_used = 31000.0   # 0.5 cores
+    candidates[2].cpu_used = 1000.0
+    assert await deflator.deflate_idle(candidates) == ['k1']
+    assert docker.updates == [
+        ('c1', {'CpuQuota': deflated_cpu_quota,
+                'CpuShares': deflated_cpu_shares}),
+    ]
+    assert deflator.is_deflated('k1')
+    assert deflator.reclaimed_cpu == pytest.approx(1.9)
+
+    await deflator.inflate('k1')
+    assert docker.updates[-1] == (
+        'c1', {'CpuQuota': 200_000, 'CpuShares': default_cpu_shares})
+    assert not deflator.is_deflated('k1')
+    assert deflator.reclaimed_cpu == 0
+    # No-op for the kernels not deflated.
+    await deflator.inflate('k2')
+    assert len(docker.updates) == 2
+
+
+@pytest.mark.asyncio
+async def test_inflate_during_deflation(mocker):
+    docker = FakeDocker()
+    deflator = create_deflator(docker)
+    clock = mocker.patch('ai.backend.agent.density.time').monotonic
+    clock.return_value = 1000.0
+    candidate = IdleCandidate('k1', 'c1', 100_000, 0.0, cpu_used=0.0)
+    await deflator.deflate_idle([candidate])
+    clock.return_value = 1060.0
+    deflation = asyncio.ensure_future(deflator.deflate_idle([candidate]))
+    await asyncio.sleep(0)
+    clock.return_value = 1061.0
+    # The execution waits for the ongoing deflation and undoes it.
+    await deflator.inflate('k1')
+    assert await deflation == ['k1']
+    assert [data['CpuQuota'] for _, data in docker.updates] == \
+        [deflated_cpu_quota, 100_000]
+    assert not deflator.is_deflated('k1')
+
+
+@pytest.mark.asyncio
+async def test_inflate_missing_container():
+    docker = FakeDocker()
+    deflator = create_deflator(docker)
+    deflator.adopt('k1', 'c1', 100_000, deflated_cpu_quota)
+    assert deflator.is_deflated('k1')
+    docker.missing.add('c1')
+    await deflator.inflate('k1')
+    assert not deflator.is_deflated('k1')
+
+
+MiB = 2 ** 20
+
+
+def create_cgroup_v2(root, container_id, usage):
+    (root / 'cgroup.controllers').write_text('cpu io memory pids')
+    path = root / 'system.slice' / f'docker-{container_id}.scope'
+    path.mkdir(parents=True)
+    (path / 'memory.current').write_text(str(usage))
+    return path
+
+
+def create_cgroup_v1(root, container_id, usage, cache):
+    path = root / 'memory' / 'docker' / container_id
+    path.mkdir(parents=True)
+    (path / 'memory.usage_in_bytes').write_text(str(usage))
+    (path / 'memory.soft_limit_in_bytes').write_text('-1')
+    (path / 'memory.stat').write_text(f'cache {cache}\nrss {usage - cache}\n')
+    return path
+
+
+def test_get_memory_cgroup(tmp_path):
+    assert get_memory_cgroup('c1', tmp_path) is None
+    path = create_cgroup_v1(tmp_path, 'c1', 0, 0)
+    assert get_memory_cgroup('c1', tmp_path) == (path, 1)
+    path = create_cgroup_v2(tmp_path, 'c2', 0)
+    assert get_memory_cgroup('c2', tmp_path) == (path, 2)
+
+
+async def sample_idle(reclaimer, clock, candidates):
+    # The first run only samples the CPU and I/O usage.
+    clock.return_value = 1000.0
+    assert await reclaimer.reclaim_idle(candidates) == {}
+    clock.return_value = 1060.0
+
+
+@pytest.mark.asyncio
+async def test_reclaim_v2(tmp_path, mocker):
+    path = create_cgroup_v2(tmp_path, 'c1', 800 * MiB)
+    reclaimer = MemoryReclaimer(idle_threshold=600, cgroup_root=tmp_path,
+                                max_reclaim_bytes=256 * MiB)
+    requests = []
+
+    def write_reclaim(p, amount):
+        requests.append((p.name, amount))
+        usage = int((path / 'memory.current').read_text())
+        (path / 'memory.current').write_text(str(usage - int(amount) // 2))
+        raise OSError(errno.EAGAIN, 'partially reclaimed')
+
+    orig_write_text = type(path).write_text
+    mocker.patch.object(
+        type(path), 'write_text',
+        lambda p, s: (write_reclaim(p, s) if p.name == 'memory.reclaim'
+                      else orig_write_text(p, s)))
+    clock = mocker.patch('ai.backend.agent.density.time').monotonic
+    candidates = [IdleCandidate('k1', 'c1', 100_000, 0.0, cpu_used=0.0)]
+    await sample_idle(reclaimer, clock, candidates)
+    # Capped by the per-run budget
+    assert await reclaimer.reclaim_idle(candidates) == {'k1': 128 * MiB}
+    assert requests == [('memory.reclaim', str(256 * MiB))]
+    assert reclaimer.reclaimed_bytes == 128 * MiB
+    # Cooling down
+    clock.return_value = 1120.0
+    assert await reclaimer.reclaim_idle(candidates) == {}
+    # An execution lets it be reclaimed again once idle.
+    reclaimer.activate('k1')
+    clock.return_value = 1800.0
+    assert await reclaimer.reclaim_idle(candidates) == {'k1': 128 * MiB}
+    assert reclaimer.kernel_reclaimed_bytes == {'k1': 256 * MiB}
+
+
+@pytest.mark.asyncio
+async def test_reclaim_v1(tmp_path, mocker):
+    path = create_cgroup_v1(tmp_path, 'c1', 100 * MiB, 40 * MiB)
+    reclaimer = MemoryReclaimer(idle_threshold=600, cgroup_root=tmp_path)
+    clock = mocker.patch('ai.backend.agent.density.time').monotonic
+    candidates = [IdleCandidate('k1', 'c1', 100_000, 0.0, cpu_used=0.0)]
+    await sample_idle(reclaimer, clock, candidates)
+    await reclaimer.reclaim_idle(candidates)
+    assert (path / 'memory.soft_limit_in_bytes').read_text() == str(50 * MiB)
+    # The whole usage fits in the budget.
+    assert (path / 'memory.force_empty').read_text() == '0'
+    reclaimer.activate('k1')
+    assert (path / 'memory.soft_limit_in_bytes').read_text() == '-1'
+
+
+@pytest.mark.asyncio
+async def test_reclaim_v1_force_empty_budget(tmp_path, mocker):
+    path1 = create_cgroup_v1(tmp_path, 'c1', 40 * MiB, 10 * MiB)
+    path2 = create_cgroup_v1(tmp_path, 'c2', 100 * MiB, 10 * MiB)
+    read_int = density._read_int
+
+    def fake_read_int(path):
+        # force_empty drops the whole usage, not only the page cache.
+        if path.name == 'memory.usage_in_bytes' and \
+                (path.parent / 'memory.force_empty').exists():
+            return 0
+        return read_int(path)
+
+    mocker.patch('ai.backend.agent.density._read_int', fake_read_int)
+    reclaimer = MemoryReclaimer(idle_threshold=600, cgroup_root=tmp_path,
+                                max_reclaim_bytes=64 * MiB)
+    clock = mocker.patch('ai.backend.agent.density.time').monotonic
+    candidates = [
+        IdleCandidate('k1', 'c1', 100_000, 0.0, cpu_used=0.0),
+        IdleCandidate('k2', 'c2', 100_000, 0.0, cpu_used=0.0),
+    ]
+    await sample_idle(reclaimer, clock, candidates)
+    assert await reclaimer.reclaim_idle(candidates) == {'k1': 40 * MiB}
+    assert (path1 / 'memory.force_empty').exists()
+    # Only 24 MiB of the budget is left for the second kernel, which is
+    # less than its whole usage.
+    assert (path2 / 'memory.soft_limit_in_bytes').read_text() == str(76 * MiB)
+    assert not (path2 / 'memory.force_empty').exists()
+
+
+@pytest.mark.asyncio
+async def test_reclaim_backs_off(tmp_path, mocker):
+    path = create_cgroup_v1(tmp_path, 'c1', 100 * MiB, 40 * MiB)
+    reclaimer = MemoryReclaimer(idle_threshold=600, cgroup_root=tmp_path,
+                                max_active_io=MiB)
+    clock = mocker.patch('ai.backend.agent.density.time').monotonic
+    candidates = [
+        IdleCandidate('k1', 'c1', 100_000, 0.0, cpu_used=0.0),
+        IdleCandidate('k2', 'c2', 100_000, 0.0, cpu_used=0.0, io_bytes=0.0,
+                      busy=True),
+    ]
+    await sample_idle(reclaimer, clock, candidates)
+    # The busy kernel does 2 MiB/s of I/O.
+    candidates[1].io_bytes = 120.0 * MiB
+    assert await reclaimer.reclaim_idle(candidates) == {}
+    assert (path / 'memory.soft_limit_in_bytes').read_text() == '-1'
@@ -0,0 +1,93 @@
+import asyncio
+
+import aiozmq
+import msgpack
+import pytest
+import zmq
+
+from ai.backend.agent.events import EventOutbox
+
+
+async def create_zmq_pair():
+    pull_sock = await aiozmq.create_zmq_stream(zmq.PULL, bind='tcp://127.0.0.1:*')
+    addr = next(iter(pull_sock.transport.bindings()))
+    push_sock = await aiozmq.create_zmq_stream(zmq.PUSH, connect=addr)
+    return push_sock, pull_sock
+
+
+async def receive_events(pull_sock, count):
+    events = []
+    while len(events) < count:
+        name, instance_id, data = await asyncio.wait_for(pull_sock.read(), 5)
+        assert name == b'event_batch'
+        assert instance_id == b'i-test'
+        stream_id, batch = msgpack.unpackb(data, raw=False)
+        events.extend(batch)
+    return stream_id, events
+
+
+@pytest.mark.asyncio
+async def test_legacy_format():
+    push_sock, pull_sock = await create_zmq_pair()
+    try:
+        outbox = EventOutbox('i-test', flush_interval=0)
+        outbox.start(push_sock)
+        assert outbox.put('kernel_terminated', 'k1', 'self-terminated') == 1
+        name, instance_id, data = await asyncio.wait_for(pull_sock.read(), 5)
+        assert name == b'kernel_terminated'
+        assert instance_id == b'i-test'
+        assert msgpack.unpackb(data, raw=False) == ['k1', 'self-terminated']
+    finally:
+        push_sock.close()
+        pull_sock.close()
+
+
+@pytest.mark.asyncio
+async def test_batches_with_sequence_numbers():
+    push_sock, pull_sock = await create_zmq_pair()
+    try:
+        outbox = EventOutbox('i-test', flush_interval=0.01, max_batch_size=40)
+        outbox.start(push_sock)
+        for idx in range(100):
+            outbox.put('kernel_terminated', f'k{idx}', 'user-requested')
+        stream_id, events = await receive_events(pull_sock, 100)
+        assert stream_id == outbox.stream_id
+        assert [ev[0] for ev in events] == list(range(1, 101))
+        assert events[99][1:3] == ['kernel_terminated', ['k99', 'user-requested']]
+        await outbox.close(timeout=1.0)
+    finally:
+        push_sock.close()
+        pull_sock.close()
+
+
+@pytest.mark.asyncio
+async def test_spill_and_replay(tmp_path):
+    push_sock, pull_sock = await create_zmq_pair()
+    try:
+        spill_path = tmp_path / 'spill'
+        outbox = EventOutbox('i-test', flush_interval=60, max_batch_size=10,
+                             spill_path=spill_path, spill_threshold=-1,
+                             max_spill_size=4096)
+        outbox.start(push_sock)
+        for idx in range(1000):
+            outbox.put('instance_heartbeat', idx)
+        await outbox.flush()
+        assert spill_path.is_file()
+        assert 0 < outbox.spilled_bytes <= 4096
+        assert outbox.num_dropped > 0
+        num_spilled = 1000 - outbox.num_dropped
+
+        # The socket is drained; the spilled events go first.
+        outbox.spill_threshold = 2 ** 20
+        outbox.put('instance_heartbeat', 'last')
+        await outbox.flush()
+        _, events = await receive_events(pull_sock, num_spilled + 1)
+        seqs = [ev[0] for ev in events[:num_spilled]]
+        assert seqs == list(range(1, num_spilled + 1))
+        assert events[-1][0] == 1001
+        assert outbox.spilled_bytes == 0
+        assert not spill_path.exists()
+        await outbox.close(timeout=1.0)
+    finally:
+        push_sock.close()
+        pull_sock.close()
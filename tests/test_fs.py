@@ -0,0 +1,68 @@
+import asyncio
+import os
+from pathlib import Path
+import sys
+
+import pytest
+
+from ai.backend.agent.fs import TmpfsPool, page_size, split_scratch_budget
+
+requires_root = pytest.mark.skipif(
+    not sys.platform.startswith('linux') or os.geteuid() != 0,
+    reason='mounting tmpfs requires the root privilege on Linux')
+
+
+def mounted_size(path: Path) -> int:
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize
+
+
+def is_mount(path: Path) -> bool:
+    return os.path.ismount(str(path))
+
+
+@requires_root
+@pytest.mark.asyncio
+async def test_tmpfs_pool(tmpdir):
+    scratch_root = Path(tmpdir)
+    sizes = (3 * (2 ** 20), 2 ** 20)
+    pool = TmpfsPool(scratch_root / '.tmpfs-pool', sizes=sizes, capacity=2)
+    await pool.start()
+    try:
+        assert all(len(pool._instances[size]) == 2 for size in sizes)
+        target1 = scratch_root / 'kernel1'
+        target1.mkdir()
+        await pool.acquire(target1, 3 * (2 ** 20))
+        assert is_mount(target1)
+        assert mounted_size(target1) == 3 * (2 ** 20)
+        assert len(pool._instances[3 * (2 ** 20)]) == 1
+
+        # The other sizes are mounted on demand.
+        target2 = scratch_root / 'kernel2'
+        target2.mkdir()
+        await pool.acquire(target2, 8 * (2 ** 20))
+        assert mounted_size(target2) == 8 * (2 ** 20)
+        assert all(len(pool._instances[size]) >= 1 for size in sizes)
+
+        # The pool is refilled in the background.
+        await asyncio.sleep(0)
+        assert all(len(pool._instances[size]) == 2 for size in sizes)
+
+        await pool.release(target1)
+        await pool.release(target2)
+        assert not is_mount(target1)
+        assert not is_mount(target2)
+    finally:
+        await pool.stop()
+    assert list((scratch_root / '.tmpfs-pool').iterdir()) == []
+    assert not is_mount(scratch_root / '.tmpfs-pool')
+
+
+def test_split_scratch_budget():
+    work_size, tmp_size = split_scratch_budget(2 ** 30)
+    assert work_size + tmp_size == 2 ** 30
+    assert tmp_size == 2 ** 28
+    # Rounded down to pages, and never unlimited
+    work_size, tmp_size = split_scratch_budget(10 * page_size + 100)
+    assert (work_size, tmp_size) == (8 * page_size, 2 * page_size)
+    assert split_scratch_budget(0) == (page_size, page_size)
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from ai.backend.agent.governor import DockerGovernor
+
+
+class RecordingStatsMonitor:
+
+    def __init__(self):
+        self.records = []
+
+    def report_stats(self, report_type, metric, *args):
+        self.records.append((report_type, metric))
+
+
+@pytest.mark.asyncio
+async def test_lane_limits():
+    governor = DockerGovernor(lane_limits={'create': 2})
+    running = 0
+    max_running = 0
+
+    async def create():
+        nonlocal running, max_running
+        async with governor.lane('create'):
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*[create() for _ in range(6)])
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_kill_goes_first():
+    stats_monitor = RecordingStatsMonitor()
+    governor = DockerGovernor(max_concurrency=1, stats_monitor=stats_monitor)
+    order = []
+    release = asyncio.Event()
+
+    async def call(lane, tag, wait=None):
+        async with governor.lane(lane):
+            order.append(tag)
+            if wait is not None:
+                await wait.wait()
+
+    first = asyncio.ensure_future(call('create', 'create-0', release))
+    await asyncio.sleep(0)
+    waiters = [
+        asyncio.ensure_future(call('create', 'create-1')),
+        asyncio.ensure_future(call('delete', 'delete')),
+        asyncio.ensure_future(call('kill', 'kill')),
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(first, *waiters)
+    assert order == ['create-0', 'kill', 'delete', 'create-1']
+    assert ('timing', 'ai.backend.agent.docker.kill.queue_delay') \
+        in stats_monitor.records
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_releases_slot():
+    governor = DockerGovernor(max_concurrency=1)
+    release = asyncio.Event()
+
+    async def hold():
+        async with governor.lane('inspect'):
+            await release.wait()
+
+    holder = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    waiter = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    release.set()
+    await holder
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    async with governor.lane('kill'):
+        pass
+    assert governor._limiter.active == 0
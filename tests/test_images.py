@@ -0,0 +1,187 @@
+import asyncio
+import time
+
+from aiodocker.exceptions import DockerError
+import pytest
+
+from ai.backend.agent.governor import DockerGovernor
+from ai.backend.agent.images import (
+    ImageCache, ImagePrefetcher, get_desired_images,
+)
+
+
+class FakeImages:
+
+    def __init__(self, existing):
+        self.existing = set(existing)
+        self.pulls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def get(self, image):
+        if image not in self.existing:
+            raise DockerError(404, {'message': 'no such image'})
+        return {'Id': image}
+
+    async def pull(self, image):
+        self.pulls.append(image)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if image.endswith(':broken'):
+            return [{'status': 'Pulling'}, {'error': 'manifest unknown'}]
+        self.existing.add(image)
+        return [{'status': 'Downloaded newer image'}]
+
+
+class FakeContainers:
+
+    def __init__(self, image_ids):
+        self.image_ids = image_ids
+
+    async def list(self, all=False):
+        return [{'ImageID': image_id} for image_id in self.image_ids]
+
+
+class FakeDocker:
+
+    def __init__(self, existing=(), used_images=()):
+        self.images = FakeImages(existing)
+        self.containers = FakeContainers(used_images)
+
+
+def test_get_desired_images():
+    items = [
+        ('images/python/tags/3.6-ubuntu', 'sha256:1234'),
+        ('images/python/tags/latest', ':3.6-ubuntu'),
+        ('images/python/tags/3.6-ubuntu/resource/cpu', '1'),
+        ('images/_aliases/python', 'python:3.6-ubuntu'),
+        ('images/r/tags/3.5-alpine', 'sha256:5678'),
+    ]
+    assert get_desired_images('lablup', items) == [
+        'lablup/kernel-python:3.6-ubuntu',
+        'lablup/kernel-r:3.5-alpine',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_pull():
+    docker = FakeDocker()
+    prefetcher = ImagePrefetcher(docker, governor=DockerGovernor())
+    await asyncio.gather(*[
+        prefetcher.pull('lablup/kernel-python:3.6') for _ in range(5)
+    ])
+    assert docker.images.pulls == ['lablup/kernel-python:3.6']
+    assert prefetcher.progress['pulling'] == []
+
+    with pytest.raises(DockerError):
+        await prefetcher.pull('lablup/kernel-python:broken')
+
+
+@pytest.mark.asyncio
+async def test_prefetch_is_bounded():
+    existing = ['lablup/kernel-c:1']
+    docker = FakeDocker(existing)
+    prefetcher = ImagePrefetcher(docker, governor=DockerGovernor(),
+                                 max_concurrency=2)
+    images = [f'lablup/kernel-python:{v}' for v in range(6)]
+    images += ['lablup/kernel-c:1', 'lablup/kernel-r:broken']
+    pulled = await prefetcher.prefetch(images)
+    assert sorted(pulled) == sorted(images[:6])
+    assert 'lablup/kernel-c:1' not in docker.images.pulls
+    assert docker.images.max_running == 2
+    assert prefetcher.progress == {
+        'queued': 0, 'pulling': [], 'done': 6, 'failed': 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_image_eviction(monkeypatch):
+    now = time.time()
+    docker = FakeDocker(used_images=['sha256:used'])
+    listed = [
+        {'Id': 'sha256:used', 'RepoTags': ['lablup/kernel-c:1'], 'Created': 0},
+        {'Id': 'sha256:old', 'RepoTags': ['lablup/kernel-r:1'], 'Created': 10},
+        {'Id': 'sha256:older', 'RepoTags': ['lablup/kernel-r:0',
+                                            'lablup/kernel-r:legacy'],
+         'Created': 0},
+        {'Id': 'sha256:recent', 'RepoTags': ['lablup/kernel-python:1'],
+         'Created': 0},
+        {'Id': 'sha256:touched', 'RepoTags': ['lablup/kernel-lua:1'],
+         'Created': 0},
+        {'Id': 'sha256:other', 'RepoTags': ['redis:latest'], 'Created': 0},
+    ]
+    deleted = []
+
+    async def list_images():
+        return listed
+
+    async def delete_image(name, force=False):
+        deleted.append(name)
+
+    docker.images.list = list_images
+    docker.images.delete = delete_image
+    cache = ImageCache(docker, governor=DockerGovernor(),
+                       low_watermark=0.1, high_watermark=0.2,
+                       max_evictions=2, min_idle_time=60)
+    cache._last_used['sha256:old'] = now - 3600
+    cache._last_used['sha256:recent'] = now - 1800
+    cache.touch('sha256:touched')
+
+    free_ratios = iter([0.15])
+
+    async def get_free_ratio():
+        return next(free_ratios)
+
+    monkeypatch.setattr(cache, 'get_free_ratio', get_free_ratio)
+    assert await cache.evict() == []
+    assert deleted == []
+
+    # The number of evictions per run is limited.
+    free_ratios = iter([0.05, 0.1, 0.15])
+    assert await cache.evict() == ['sha256:older', 'sha256:old']
+    assert deleted == ['lablup/kernel-r:0', 'lablup/kernel-r:legacy',
+                       'lablup/kernel-r:1']
+
+    # Evict the least recently used ones until the high watermark, keeping
+    # the ones used just now.
+    deleted.clear()
+    listed[1:3] = []
+    free_ratios = iter([0.05, 0.3])
+    assert await cache.evict() == ['sha256:recent']
+    assert deleted == ['lablup/kernel-python:1']
+    assert cache.num_evicted == 3
+
+
+@pytest.mark.asyncio
+async def test_image_eviction_skips_touched_images(monkeypatch):
+    docker = FakeDocker()
+    listed = [
+        {'Id': 'sha256:a', 'RepoTags': ['lablup/kernel-r:1'], 'Created': 0},
+        {'Id': 'sha256:b', 'RepoTags': ['lablup/kernel-lua:1',
+                                        'lablup/kernel-lua:legacy'],
+         'Created': 10},
+    ]
+    deleted = []
+    cache = ImageCache(docker, governor=DockerGovernor(),
+                       low_watermark=0.1, high_watermark=0.2,
+                       max_evictions=2, min_idle_time=60)
+
+    async def list_images():
+        return listed
+
+    async def delete_image(name, force=False):
+        deleted.append(name)
+        # A kernel creation inspects the next candidate meanwhile.
+        cache.touch('sha256:b')
+
+    docker.images.list = list_images
+    docker.images.delete = delete_image
+
+    async def get_free_ratio():
+        return 0.05
+
+    monkeypatch.setattr(cache, 'get_free_ratio', get_free_ratio)
+    assert await cache.evict() == ['sha256:a']
+    assert deleted == ['lablup/kernel-r:1']
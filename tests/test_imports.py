@@ -0,0 +1,17 @@
+import subprocess
+import sys
+
+# The modules which are slow to import and rarely used by the agent.
+lazy_modules = ['aiobotocore', 'botocore', 'pkg_resources']
+
+
+def test_lazy_imports():
+    code = (
+        'import sys\n'
+        'import ai.backend.agent.files, ai.backend.agent.resources\n'
+        'import ai.backend.agent.uploader, ai.backend.agent.krunner\n'
+        f'print(" ".join(m for m in {lazy_modules!r} if m in sys.modules))\n'
+    )
+    result = subprocess.run([sys.executable, '-c', code],
+                            stdout=subprocess.PIPE, check=True)
+    assert result.stdout.decode().split() == []
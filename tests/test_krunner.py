@@ -0,0 +1,63 @@
+import io
+import tarfile
+
+from ai.backend.agent import __version__ as VERSION
+from ai.backend.agent.krunner import (
+    _build_stub_archive, get_krunner_volume_name,
+    krunner_path, ready_marker, stub_dirs, stub_files,
+    RunnerMounts,
+)
+
+
+def test_krunner_volume_name():
+    assert get_krunner_volume_name('alpine3.8') == \
+        f'backendai-krunner.{VERSION}.alpine3.8'
+
+
+def test_stub_archive():
+    with tarfile.open(fileobj=io.BytesIO(_build_stub_archive())) as tar:
+        members = {m.name: m for m in tar.getmembers()}
+    for path in stub_dirs:
+        assert members[path].isdir()
+    for path in stub_files:
+        assert members[path].isfile()
+        assert members[path].size == 0
+    # The marker must come last to mark the completion.
+    assert list(members)[-1] == ready_marker
+
+
+def test_runner_mounts(tmp_path):
+    runner_path = tmp_path / 'runner'
+    runner_path.mkdir()
+    (tmp_path / 'kernel').mkdir()
+    (tmp_path / 'helpers').mkdir()
+    for name in ['entrypoint.sh', 'su-exec.alpine3.8.bin', 'jail.alpine3.8.bin',
+                 'su-exec.ubuntu16.04.bin', 'libbaihook.ubuntu16.04.x86_64.so']:
+        (runner_path / name).touch()
+    mounts = RunnerMounts(base_path=tmp_path, arch='x86_64')
+    assert mounts.known_distros() == ['alpine3.8', 'ubuntu16.04']
+    mounts.prepare()
+
+    table = dict((c, h) for h, c in mounts.get('ubuntu16.04'))
+    assert table['/opt/backend.ai/bin/su-exec'] == \
+        runner_path / 'su-exec.ubuntu16.04.bin'
+    assert table['/opt/backend.ai/hook/libbaihook.so'] == \
+        runner_path / 'libbaihook.ubuntu16.04.x86_64.so'
+    assert '/opt/backend.ai/bin/jail' not in table
+    assert table['/opt/backend.ai/lib/python3.6/site-packages/ai/backend/kernel'] \
+        == tmp_path / 'kernel'
+
+    # The table is resolved only once.
+    (runner_path / 'jail.ubuntu16.04.bin').touch()
+    assert mounts.get('ubuntu16.04') is mounts.get('ubuntu16.04')
+    assert '/opt/backend.ai/bin/jail' not in \
+        dict((c, h) for h, c in mounts.get('ubuntu16.04'))
+
+
+def test_runner_mounts_in_tree():
+    # All mount points must exist as stubs in the read-only krunner volume.
+    mounts = RunnerMounts()
+    for distro in mounts.known_distros():
+        for _, container_path in mounts.get(distro):
+            relpath = container_path[len(krunner_path) + 1:]
+            assert relpath in stub_files or relpath in stub_dirs
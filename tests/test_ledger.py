@@ -0,0 +1,67 @@
+from decimal import Decimal
+import sqlite3
+
+from ai.backend.agent.ledger import Allocation, AllocationLedger
+from ai.backend.agent.resources import KernelResourceSpec
+
+
+def create_spec(cpu_set):
+    return KernelResourceSpec(
+        numa_node=0,
+        cpu_set=set(cpu_set),
+        memory_limit=2 ** 30,
+        scratch_disk_size=2 ** 26,
+        shares={
+            '_cpu': Decimal(len(cpu_set)),
+            '_mem': Decimal('1.0'),
+            '_gpu': Decimal('0.5'),
+            'cuda': {0: Decimal('0.5')},
+        },
+    )
+
+
+def test_replay(tmp_path):
+    ledger = AllocationLedger(tmp_path / 'ledger.db')
+    ledger.open()
+    try:
+        ledger.record_alloc('k1', create_spec([0, 1]), [30000, 30001])
+        ledger.record_container('k1', 'c1')
+        ledger.record_alloc('k2', create_spec([2]), [30002])
+        ledger.record_alloc('k3', create_spec([3]), [30003])
+        ledger.record_free('k2')
+        # A restart reallocates the ports.
+        ledger.record_alloc('k3', create_spec([3]), [30004])
+    finally:
+        ledger.close()
+
+    ledger = AllocationLedger(tmp_path / 'ledger.db')
+    ledger.open()
+    try:
+        allocations = ledger.load()
+        assert sorted(allocations) == ['k1', 'k3']
+        assert allocations['k1'] == Allocation(
+            'k1', create_spec([0, 1]), [30000, 30001], 'c1')
+        assert allocations['k3'].host_ports == [30004]
+        assert allocations['k3'].container_id is None
+
+        ledger.compact([allocations['k1']])
+        assert ledger.load() == {'k1': allocations['k1']}
+    finally:
+        ledger.close()
+
+
+def test_corrupted_records(tmp_path):
+    path = tmp_path / 'ledger.db'
+    ledger = AllocationLedger(path)
+    ledger.open()
+    try:
+        ledger.record_alloc('k1', create_spec([0]), [30000])
+        ledger.record_alloc('k2', create_spec([1]), [30001])
+        conn = sqlite3.connect(str(path))
+        conn.execute("UPDATE journal SET payload = replace(payload, '30001', "
+                     "'30002') WHERE kernel_id = 'k2'")
+        conn.commit()
+        conn.close()
+        assert sorted(ledger.load()) == ['k1']
+    finally:
+        ledger.close()
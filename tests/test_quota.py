@@ -0,0 +1,92 @@
+import os
+from pathlib import Path
+import sys
+
+import pytest
+
+from ai.backend.agent.fs import umount
+from ai.backend.agent.quota import (
+    LoopbackQuotaBackend, ProjectQuotaBackend, find_mount,
+)
+
+requires_loop_devices = pytest.mark.skipif(
+    not sys.platform.startswith('linux') or os.geteuid() != 0 or
+    not LoopbackQuotaBackend.is_available(),
+    reason='loopback images require the root privilege and loop devices')
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='mountinfo is only available on Linux')
+def test_find_mount(tmpdir):
+    device, fstype, mount_point = find_mount(Path(tmpdir))
+    assert mount_point == Path(tmpdir).resolve() or \
+        mount_point in Path(tmpdir).resolve().parents
+    assert fstype
+
+
+@pytest.mark.asyncio
+async def test_project_quota_keeps_leftover_ids(tmpdir, mocker):
+    scratch_root = Path(tmpdir)
+    project_ids = {
+        'running-kernel': 1,
+        'running-kernel_tmp': 1,
+        'old-kernel.1234abcd': 2,
+        'old-kernel_tmp.5678abcd': 2,
+    }
+    for name in project_ids:
+        if name.startswith('old-'):
+            (scratch_root / '.trash' / name).mkdir(parents=True)
+        else:
+            (scratch_root / name).mkdir()
+    mocker.patch('ai.backend.agent.quota.get_project_id',
+                 side_effect=lambda path: project_ids[path.name])
+    set_limit = mocker.patch.object(ProjectQuotaBackend, '_set_limit')
+    backend = ProjectQuotaBackend(scratch_root, '/dev/fake',
+                                  project_id_range=(1, 5))
+    await backend.start()
+    assert sorted(backend._free_ids) == [3, 4]
+
+    # The project ID is in use until both leftovers are deleted.
+    trash_root = scratch_root / '.trash'
+    await backend.release_leftover(trash_root / 'old-kernel.1234abcd')
+    assert sorted(backend._free_ids) == [3, 4]
+    await backend.release_leftover(trash_root / 'old-kernel_tmp.5678abcd')
+    assert sorted(backend._free_ids) == [2, 3, 4]
+    set_limit.assert_called_once_with(2, 0)
+
+    await backend.release('running-kernel')
+    assert sorted(backend._free_ids) == [1, 2, 3, 4]
+
+
+@requires_loop_devices
+@pytest.mark.asyncio
+async def test_loopback_quota(tmpdir):
+    scratch_root = Path(tmpdir)
+    size = 8 * (2 ** 20)
+    backend = LoopbackQuotaBackend(scratch_root / '.scratch-images',
+                                   size=size, capacity=1)
+    await backend.start()
+    try:
+        await backend._refill_task
+        assert len(backend._images) == 1
+        scratch_dir = scratch_root / 'fake-kernel'
+        tmp_dir = scratch_root / 'fake-kernel_tmp'
+        scratch_dir.mkdir()
+        tmp_dir.mkdir()
+
+        await backend.acquire('fake-kernel', scratch_dir, tmp_dir, size)
+        try:
+            assert os.path.ismount(str(scratch_dir))
+            assert os.path.ismount(str(tmp_dir))
+            (scratch_dir / 'work').mkdir()
+            (scratch_dir / 'work' / 'small.bin').write_bytes(b'x' * 1024)
+            # The scratch and tmp directories share the same limit.
+            with pytest.raises(OSError):
+                (tmp_dir / 'large.bin').write_bytes(b'x' * (2 * size))
+        finally:
+            umount(scratch_dir)
+            umount(tmp_dir)
+        await backend.release('fake-kernel')
+        assert not (scratch_root / '.scratch-images' / 'fake-kernel.img').exists()
+    finally:
+        await backend.stop()
@@ -0,0 +1,97 @@
+import pytest
+
+from ai.backend.agent.cpualloc import CPUTopology, TopologyAwareCPUAllocMap
+from ai.backend.agent.rebalance import (
+    CPURebalancer, KernelPlacement, get_core_nodes, plan_moves,
+)
+
+# 2 nodes x 4 cores
+core_nodes = {c: c // 4 for c in range(8)}
+
+
+def test_plan_moves_contended():
+    placements = [
+        KernelPlacement('k1', frozenset({0, 1}), [0]),
+        KernelPlacement('k2', frozenset({0, 1}), [0]),
+        KernelPlacement('k3', frozenset({0, 1}), [0]),
+        KernelPlacement('k4', frozenset({0, 1}), [0], cpu_usage=0.1),
+    ]
+    moves = plan_moves(placements, core_nodes, max_moves=4)
+    # The busy kernels move to the idle cores, within their NUMA node
+    # first, until the rest barely contend.
+    assert [m.kernel_id for m in moves] == ['k1', 'k2']
+    assert moves[0].cpu_set == {2, 3}
+    assert moves[0].numa_nodes == [0]
+    assert moves[1].cpu_set <= {4, 5, 6, 7}
+    assert moves[1].numa_nodes == [1]
+    assert moves[1].old_numa_nodes == [0]
+
+
+def test_plan_moves_hysteresis():
+    placements = [
+        KernelPlacement('k1', frozenset({0}), [0], cpu_usage=0.6),
+        KernelPlacement('k2', frozenset({0}), [0], cpu_usage=0.6),
+    ]
+    # The overload of 0.2 cores is not worth a move.
+    assert plan_moves(placements, core_nodes) == []
+    placements = [
+        KernelPlacement('k1', frozenset({0}), [0]),
+        KernelPlacement('k2', frozenset({0}), [0], movable=False),
+    ]
+    moves = plan_moves(placements, core_nodes)
+    assert [m.kernel_id for m in moves] == ['k1']
+    assert moves[0].gain == pytest.approx(1.0)
+
+
+def test_plan_moves_max_moves():
+    placements = [
+        KernelPlacement(f'k{i}', frozenset({0}), [0]) for i in range(4)
+    ]
+    assert len(plan_moves(placements, core_nodes, max_moves=2)) == 2
+    assert len(plan_moves(placements, core_nodes, max_moves=8)) == 3
+
+
+def test_get_core_nodes():
+    topo = CPUTopology.synthetic(num_nodes=2, l3_per_node=1, cores_per_l3=2,
+                                 threads_per_core=1)
+    cpu_map = TopologyAwareCPUAllocMap(topo)
+    assert get_core_nodes(cpu_map) == {0: 0, 1: 0, 2: 1, 3: 1}
+
+
+@pytest.mark.asyncio
+async def test_rebalancer_cooldown_and_usage(mocker):
+    topo = CPUTopology.synthetic(num_nodes=2, l3_per_node=1, cores_per_l3=4,
+                                 threads_per_core=1)
+    moved = []
+
+    async def repin(move):
+        moved.append(move)
+        return move.kernel_id != 'k3'
+
+    rebalancer = CPURebalancer(repin, cpu_map=TopologyAwareCPUAllocMap(topo),
+                               cooldown=60.0)
+    clock = mocker.patch('ai.backend.agent.rebalance.time').monotonic
+    clock.return_value = 100.0
+    # The first run only samples the usages of k1 and k2.
+    placements = [
+        KernelPlacement('k1', frozenset({0}), [0], cpu_used=0.0),
+        KernelPlacement('k2', frozenset({0}), [0], cpu_used=0.0),
+    ]
+    assert len(await rebalancer.rebalance(placements)) == 1
+    k1_moved = moved[-1].kernel_id
+    # Both are almost idle now, and the moved one is cooling down.
+    clock.return_value = 110.0
+    placements = [
+        KernelPlacement('k1', frozenset({0}), [0], cpu_used=100.0),
+        KernelPlacement('k2', frozenset({0}), [0], cpu_used=100.0),
+    ]
+    assert await rebalancer.rebalance(placements) == []
+    # The failed moves are counted out.
+    placements = [
+        KernelPlacement('k3', frozenset({1}), [0]),
+        KernelPlacement('k4', frozenset({1}), [0], movable=False),
+    ]
+    assert await rebalancer.rebalance(placements) == []
+    assert moved[-1].kernel_id == 'k3'
+    assert rebalancer.num_moved == 1
+    assert k1_moved in ('k1', 'k2')
@@ -8,10 +8,10 @@ import pytest
 import attr
 
 from ai.backend.agent.vendor import linux
+from ai.backend.agent.accelalloc import AcceleratorAllocMap
 from ai.backend.agent.accelerator import AbstractAcceleratorInfo
 from ai.backend.agent.resources import (
-    CPUAllocMap, KernelResourceSpec,
-    AcceleratorAllocMap,
+    CPUAllocMap, KernelResourceSpec, plan_multi_node,
     Mount, MountPermission,
 )
 
@@ -160,6 +160,37 @@ class TestCPUAllocMap:
             assert cpu_alloc_map.alloc_per_node == {0: 0, 1: 5, 2: 2}
             assert cpu_alloc_map.core_shares == ({0: 0, 3: 0}, {1: 5}, {2: 2})
 
+    def test_alloc_multi_node(self):
+        cpu_alloc_map = self.get_cpu_alloc_map(num_nodes=2, num_cores=8)
+
+        assert cpu_alloc_map.alloc_multi_node(3) == ([0], {0, 2, 4})
+        assert cpu_alloc_map.alloc_per_node == {0: 3, 1: 0}
+
+        # Does not fit in a node: balanced across both nodes.
+        assert cpu_alloc_map.alloc_multi_node(6) == ([0, 1], {0, 2, 6, 1, 3, 5})
+        assert cpu_alloc_map.alloc_per_node == {0: 6, 1: 3}
+        assert cpu_alloc_map.core_shares == (
+            {0: 2, 2: 2, 4: 1, 6: 1}, {1: 1, 3: 1, 5: 1, 7: 0})
+
+        with mock.patch.object(linux.libnuma, 'node_of_cpu',
+                               side_effect=lambda c: c % 2):
+            cpu_alloc_map.free({0, 2, 6, 1, 3, 5})
+            assert cpu_alloc_map.alloc_per_node == {0: 3, 1: 0}
+
+
+def test_plan_multi_node():
+    sizes = {0: 8, 1: 8, 2: 8, 3: 4}
+    # Fits in the least loaded node.
+    assert plan_multi_node(4, sizes, {0: 5, 1: 2, 2: 3, 3: 0}) == {3: 4}
+    assert plan_multi_node(6, sizes, {0: 5, 1: 2, 2: 3, 3: 1}) == {1: 6}
+    # Spans the minimum number of nodes, balanced.
+    assert plan_multi_node(12, sizes, {0: 0, 1: 0, 2: 0, 3: 0}) == {0: 6, 1: 6}
+    assert plan_multi_node(17, sizes, {0: 0, 1: 0, 2: 0, 3: 0}) == \
+        {0: 6, 1: 6, 2: 5}
+    # The excess of the smaller node moves to the others.
+    assert plan_multi_node(26, sizes, {0: 0, 1: 0, 2: 0, 3: 0}) == \
+        {0: 8, 1: 7, 2: 7, 3: 4}
+
 
 @attr.s(auto_attribs=True)
 class DummyAcceleratorInfo(AbstractAcceleratorInfo):
@@ -167,6 +198,9 @@ class DummyAcceleratorInfo(AbstractAcceleratorInfo):
     unit_memory = 1 * (2 ** 20)  # 1 MiB
     unit_proc = 3
 
+    def is_fractional(self):
+        return True
+
     def max_share(self):
         q = Decimal('.01')
         return min(Decimal(self.memory_size / type(self).unit_memory).quantize(q),
@@ -270,6 +304,7 @@ class TestKernelResourceSpec:
     def sample_resource_spec(self):
         return KernelResourceSpec(
             numa_node=99,
+            numa_nodes=[99, 100],
             cpu_set={1, 4, 9},
             memory_limit=128 * (2**20),
             scratch_disk_size=91124,
@@ -303,6 +338,7 @@ class TestKernelResourceSpec:
         o = json.loads(sample_resource_spec.to_json())
         assert o['cpu_set'] == [1, 4, 9]
         assert o['numa_node'] == 99
+        assert o['numa_nodes'] == [99, 100]
         assert o['shares']['_cpu'] == '0.47'
         assert o['shares']['_mem'] == '1.21'
         assert o['shares']['_gpu'] == '0.53'
@@ -310,3 +346,7 @@ class TestKernelResourceSpec:
         assert o['shares']['cuda']['5'] == '0.2'
         assert o['mounts'][0] == '/home/user/hello.txt:/home/work/hello.txt:ro'
         assert o['mounts'][1] == '/home/user/world.txt:/home/work/world.txt:rw'
+
+    def test_json_equality(self, sample_resource_spec):
+        read_spec = KernelResourceSpec.from_json(sample_resource_spec.to_json())
+        assert read_spec == sample_resource_spec
@@ -0,0 +1,89 @@
+from pathlib import Path
+
+import pytest
+
+from ai.backend.agent.scratch import ScratchReaper
+
+
+def make_tree(root: Path, num_files: int):
+    (root / 'work' / 'sub').mkdir(parents=True)
+    for idx in range(num_files):
+        (root / 'work' / 'sub' / f'{idx}.txt').write_text('data')
+    (root / 'work' / 'link').symlink_to('/etc')
+
+
+@pytest.mark.asyncio
+async def test_discard_scratch_dir(tmpdir):
+    scratch_root = Path(tmpdir)
+    scratch_dir = scratch_root / 'fake-kernel'
+    make_tree(scratch_dir, 10)
+
+    deleted = []
+
+    async def callback():
+        deleted.append(scratch_dir.name)
+
+    reaper = ScratchReaper(scratch_root, max_unlink_rate=100000)
+    reaper.start()
+    try:
+        await reaper.discard(scratch_dir, callback=callback)
+        # The directory disappears from its original location immediately.
+        assert not scratch_dir.exists()
+        assert reaper.backlog == 1
+        await reaper.join()
+        assert reaper.backlog == 0
+        assert list(reaper.trash_root.iterdir()) == []
+        assert deleted == ['fake-kernel']
+        # Discarding non-existent directories is a no-op.
+        await reaper.discard(scratch_root / 'unknown-kernel')
+        assert reaper.backlog == 0
+    finally:
+        await reaper.stop()
+
+
+@pytest.mark.asyncio
+async def test_reclaim_leftover_trash(tmpdir):
+    scratch_root = Path(tmpdir)
+    make_tree(scratch_root / '.trash' / 'old-kernel.1234abcd', 5)
+    (scratch_root / 'running-kernel').mkdir()
+
+    reclaimed = []
+
+    async def leftover_callback(path):
+        assert not path.exists()
+        reclaimed.append(path.name)
+
+    reaper = ScratchReaper(scratch_root)
+    reaper.start(leftover_callback=leftover_callback)
+    try:
+        assert reaper.backlog == 1
+        await reaper.join()
+        assert list(reaper.trash_root.iterdir()) == []
+        assert (scratch_root / 'running-kernel').is_dir()
+        assert reclaimed == ['old-kernel.1234abcd']
+    finally:
+        await reaper.stop()
+
+
+@pytest.mark.asyncio
+async def test_callback_after_failed_delete(tmpdir, mocker):
+    scratch_root = Path(tmpdir)
+    scratch_dir = scratch_root / 'fake-kernel'
+    make_tree(scratch_dir, 1)
+
+    released = []
+
+    async def callback():
+        released.append(scratch_dir.name)
+
+    reaper = ScratchReaper(scratch_root)
+    mocker.patch.object(reaper, '_delete',
+                        side_effect=PermissionError('busy'))
+    reaper.start()
+    try:
+        await reaper.discard(scratch_dir, callback=callback)
+        await reaper.join()
+        assert released == ['fake-kernel']
+        assert reaper.backlog == 0
+    finally:
+        await reaper.stop()
@@ -1,6 +1,7 @@
 import argparse
 import asyncio
 from datetime import datetime
+import json
 import os
 from pathlib import Path
 import uuid
@@ -9,7 +10,8 @@ import aiodocker
 import pytest
 
 from ai.backend.agent.server import (
-    get_extra_volumes, get_kernel_id_from_container, AgentRPCServer
+    get_docker_event_filters, get_extra_volumes, get_kernel_id_from_container,
+    AgentRPCServer,
 )
 from ai.backend.common import identity
 from ai.backend.common.argparse import host_port_pair
@@ -40,6 +42,14 @@ async def agent(request, tmpdir, event_loop):
     config.debug_hook = None
     config.debug_jail = None
     config.debug_skip_container_deletion = False
+    config.cpu_alloc_policy = 'legacy'
+    config.accelerator_alloc_strategy = 'worst-fit'
+    config.cpu_rebalance_interval = 0
+    config.density_idle_threshold = 0
+    config.memory_reclaim_idle_threshold = 0
+    config.image_prefetch_concurrency = 0
+    config.image_cache_low_watermark = 0
+    config.image_cache_high_watermark = 0
 
     agent = None
 
@@ -88,6 +98,15 @@ async def test_get_kernel_id_from_container(docker, container):
     assert kid == 'test-container'  # defined as in the fixture
 
 
+def test_get_docker_event_filters():
+    filters = json.loads(get_docker_event_filters())
+    assert filters['type'] == ['container']
+    assert filters['event'] == ['die']
+    assert filters['label'] == ['ai.backend.kernel-id']
+    filters = json.loads(get_docker_event_filters(match_label=False))
+    assert 'label' not in filters
+
+
 @pytest.fixture
 async def kernel_info(agent, docker):
     kernel_id = str(uuid.uuid4())
@@ -139,6 +158,20 @@ async def test_scan_running_containers(agent, kernel_info, docker):
     assert agent.container_registry[kernel_info['id']]
 
 
+@pytest.mark.integration
+@pytest.mark.asyncio
+async def test_scan_running_containers_frees_leaked_allocations(
+        agent, kernel_info):
+    leaked_id = str(uuid.uuid4())
+    resource_spec = agent.container_registry[kernel_info['id']]['resource_spec']
+    agent.ledger.record_alloc(leaked_id, resource_spec, [])
+    agent.container_registry.clear()
+    await agent.scan_running_containers()
+    allocations = agent.ledger.load()
+    assert leaked_id not in allocations
+    assert kernel_info['id'] in allocations
+
+
 @pytest.mark.integration
 @pytest.mark.asyncio
 async def test_create_kernel(agent, docker):
@@ -170,6 +203,75 @@ async def test_create_kernel(agent, docker):
     #   assert container_info['mounts'] == config['mounts']
 
 
+@pytest.mark.integration
+@pytest.mark.asyncio
+async def test_create_kernel_releases_resources_on_failure(agent, mocker):
+    kernel_id = str(uuid.uuid4())
+    config = {
+        'lang': 'lablup/lua:5.3-alpine',
+        'limits': {'cpu_slot': 1, 'gpu_slot': 0, 'mem_slot': 1, 'tpu_slot': 0},
+        'mounts': [],
+        'environ': {},
+    }
+    num_free_ports = len(agent.port_pool)
+    mocker.patch.object(agent.runner_mounts, 'get',
+                        side_effect=RuntimeError('no runner mounts'))
+
+    with pytest.raises(RuntimeError):
+        await agent._create_kernel(kernel_id, config)
+
+    assert len(agent.port_pool) == num_free_ports
+    assert kernel_id not in agent.container_registry
+    assert not (agent.config.scratch_root / kernel_id).exists()
+
+
+@pytest.mark.integration
+@pytest.mark.asyncio
+async def test_create_kernel_rejects_duplicate_kernel_id(agent, kernel_info):
+    kernel_id = kernel_info['id']
+    config = {
+        'lang': 'lablup/lua:5.3-alpine',
+        'limits': {'cpu_slot': 1, 'gpu_slot': 0, 'mem_slot': 1, 'tpu_slot': 0},
+        'mounts': [],
+        'environ': {},
+    }
+    num_free_ports = len(agent.port_pool)
+    allocation = agent.ledger.load()[kernel_id]
+
+    with pytest.raises(AssertionError):
+        await agent._create_kernel(kernel_id, config)
+
+    assert len(agent.port_pool) == num_free_ports
+    assert agent.container_registry[kernel_id]['container_id'] == \
+        kernel_info['container_id']
+    assert (agent.config.scratch_root / kernel_id).is_dir()
+    assert (agent.config.scratch_root / f'{kernel_id}_tmp').is_dir()
+    assert agent.ledger.load()[kernel_id].host_ports == allocation.host_ports
+
+
+@pytest.mark.integration
+@pytest.mark.asyncio
+async def test_create_kernels_without_krunner_volume(agent, mocker):
+    config = {
+        'lang': 'lablup/lua:5.3-alpine',
+        'limits': {'cpu_slot': 1, 'gpu_slot': 0, 'mem_slot': 1, 'tpu_slot': 0},
+        'mounts': [],
+        'environ': {},
+    }
+    kernel_ids = [str(uuid.uuid4()) for _ in range(2)]
+    num_free_ports = len(agent.port_pool)
+    mocker.patch.object(agent.krunner_volumes, 'get',
+                        side_effect=RuntimeError('no krunner image'))
+
+    results = await agent.create_kernels([
+        (kernel_id, {**config, 'limits': dict(config['limits'])})
+        for kernel_id in kernel_ids
+    ])
+
+    assert [r['status'] for r in results] == ['error', 'error']
+    assert len(agent.port_pool) == num_free_ports
+
+
 @pytest.mark.integration
 @pytest.mark.asyncio
 async def test_destroy_kernel(agent, kernel_info):
@@ -187,6 +289,47 @@ async def test_destroy_kernel(agent, kernel_info):
     assert 'io_cur_scratch_size' in stat
 
 
+@pytest.mark.integration
+@pytest.mark.asyncio
+async def test_create_and_destroy_kernels(agent, docker):
+    config = {
+        'lang': 'lablup/lua:5.3-alpine',
+        'limits': {'cpu_slot': 1, 'gpu_slot': 0, 'mem_slot': 1, 'tpu_slot': 0},
+        'mounts': [],
+        'environ': {},
+    }
+    kernel_ids = [str(uuid.uuid4()) for _ in range(3)]
+    num_free_ports = len(agent.port_pool)
+
+    results = []
+    try:
+        results = await agent.create_kernels([
+            (kernel_id, {**config, 'limits': dict(config['limits'])})
+            for kernel_id in kernel_ids
+        ])
+        assert [r['id'] for r in results] == kernel_ids
+        assert all(r['status'] == 'ok' for r in results)
+        for kernel_id in kernel_ids:
+            assert kernel_id in agent.container_registry
+
+        touched = await agent.touch_kernels(kernel_ids + ['nonexistent'])
+        assert [r['status'] for r in touched] == ['ok', 'ok', 'ok', 'missing']
+
+        destroyed = await agent.destroy_kernels(kernel_ids)
+        assert [r['id'] for r in destroyed] == kernel_ids
+        assert all(r['status'] == 'ok' for r in destroyed)
+    finally:
+        for result in results:
+            if 'container_id' not in result:
+                continue
+            try:
+                container = docker.containers.container(result['container_id'])
+                await container.delete(force=True)
+            except aiodocker.exceptions.DockerError:
+                pass
+    assert len(agent.port_pool) <= num_free_ports
+
+
 @pytest.mark.integration
 @pytest.mark.asyncio
 async def test_restart_kernel(agent, kernel_info):
@@ -203,6 +346,57 @@ async def test_restart_kernel(agent, kernel_info):
     assert container_id != ret['container_id']
 
 
+@pytest.mark.integration
+@pytest.mark.asyncio
+async def test_restart_kernel_fast(agent, kernel_info):
+    kernel_id = kernel_info['id']
+    new_config = {
+        'lang': 'lablup/lua:5.3-alpine',
+        'limits': {'cpu_slot': 1, 'gpu_slot': 0, 'mem_slot': 1, 'tpu_slot': 0},
+        'mounts': [],
+        'fast': True,
+    }
+
+    ret = await agent.restart_kernel(kernel_id, new_config)
+
+    assert ret['container_id'] == kernel_info['container_id']
+    assert ret['repl_in_port'] == kernel_info['repl_in_port']
+    assert ret['repl_out_port'] == kernel_info['repl_out_port']
+    await asyncio.sleep(1)  # the stale die event should be ignored
+    assert kernel_id in agent.container_registry
+
+
+@pytest.mark.integration
+@pytest.mark.asyncio
+async def test_restart_kernel_fast_ignores_early_die_event(
+        agent, kernel_info, mocker):
+    kernel_id = kernel_info['id']
+    new_config = {
+        'lang': 'lablup/lua:5.3-alpine',
+        'limits': {'cpu_slot': 1, 'gpu_slot': 0, 'mem_slot': 1, 'tpu_slot': 0},
+        'mounts': [],
+        'fast': True,
+    }
+    orig_wait = aiodocker.containers.DockerContainer.wait
+
+    async def slow_wait(self, *args, **kwargs):
+        ret = await orig_wait(self, *args, **kwargs)
+        # Let monitor() process the die event before wait() returns.
+        await asyncio.sleep(1)
+        return ret
+
+    mocker.patch.object(aiodocker.containers.DockerContainer, 'wait', slow_wait)
+    submit = mocker.spy(agent.cleanup_queue, 'submit')
+
+    ret = await agent.restart_kernel(kernel_id, new_config)
+
+    assert ret['container_id'] == kernel_info['container_id']
+    await asyncio.sleep(1)
+    assert kernel_id in agent.container_registry
+    assert kernel_id not in agent.restarting_kernels
+    submit.assert_not_called()
+
+
 @pytest.mark.integration
 @pytest.mark.asyncio
 async def test_restart_kernel_cancel_code_execution(
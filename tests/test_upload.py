@@ -0,0 +1,126 @@
+import asyncio
+import os
+from pathlib import Path
+import threading
+import zlib
+
+import pytest
+
+from ai.backend.agent.upload import UploadSessionManager
+
+
+@pytest.fixture
+def scratch_root(tmpdir):
+    root = Path(tmpdir)
+    (root / 'fake-kernel' / 'work').mkdir(parents=True)
+    return root
+
+
+@pytest.mark.asyncio
+async def test_chunked_upload(scratch_root):
+    manager = UploadSessionManager(scratch_root, chunk_size=4)
+    content = b'hello, world!'
+    info = await manager.begin('fake-kernel', 'sub/hello.txt', len(content))
+    assert info['offset'] == 0
+    assert info['chunk_size'] == 4
+    upload_id = info['upload_id']
+
+    # Chunks may arrive out of order.
+    for offset in (8, 0, 4, 12):
+        chunk = content[offset:offset + 4]
+        await manager.write_chunk('fake-kernel', upload_id, offset, chunk,
+                                  zlib.crc32(chunk))
+    ret = await manager.commit('fake-kernel', upload_id)
+    assert ret['size'] == len(content)
+
+    dest = scratch_root / 'fake-kernel' / 'work' / 'sub' / 'hello.txt'
+    assert dest.read_bytes() == content
+    assert not list((scratch_root / 'fake-kernel' / '.uploads').iterdir())
+    assert upload_id not in manager.sessions
+
+
+@pytest.mark.asyncio
+async def test_resume_upload(scratch_root):
+    manager = UploadSessionManager(scratch_root, chunk_size=4)
+    content = b'0123456789'
+    info = await manager.begin('fake-kernel', 'data.bin', len(content))
+    upload_id = info['upload_id']
+    ret = await manager.write_chunk('fake-kernel', upload_id, 0, content[:4],
+                                    zlib.crc32(content[:4]))
+    assert ret['offset'] == 4
+
+    # A reconnecting client gets the same session and the resume offset.
+    info = await manager.begin('fake-kernel', 'data.bin', len(content))
+    assert info['upload_id'] == upload_id
+    assert info['offset'] == 4
+
+    with pytest.raises(AssertionError):
+        await manager.commit('fake-kernel', upload_id)
+    for offset in (4, 8):
+        chunk = content[offset:offset + 4]
+        await manager.write_chunk('fake-kernel', upload_id, offset, chunk,
+                                  zlib.crc32(chunk))
+    await manager.commit('fake-kernel', upload_id)
+    assert (scratch_root / 'fake-kernel' / 'work' / 'data.bin').read_bytes() \
+        == content
+
+
+@pytest.mark.asyncio
+async def test_upload_rejects_bad_chunks(scratch_root):
+    manager = UploadSessionManager(scratch_root, chunk_size=4)
+    info = await manager.begin('fake-kernel', 'data.bin', 8)
+    upload_id = info['upload_id']
+    with pytest.raises(AssertionError):
+        await manager.write_chunk('fake-kernel', upload_id, 0, b'abcd', 1234)
+    with pytest.raises(AssertionError):
+        await manager.write_chunk('fake-kernel', upload_id, 0, b'abcde',
+                                  zlib.crc32(b'abcde'))
+    with pytest.raises(AssertionError):
+        await manager.write_chunk('fake-kernel', upload_id, 6, b'abcd',
+                                  zlib.crc32(b'abcd'))
+    with pytest.raises(AssertionError):
+        await manager.write_chunk('other-kernel', upload_id, 0, b'abcd',
+                                  zlib.crc32(b'abcd'))
+    assert manager.sessions[upload_id].offset == 0
+
+    manager.discard_kernel('fake-kernel')
+    assert not manager.sessions
+
+
+@pytest.mark.asyncio
+async def test_upload_rejects_path_escape(scratch_root):
+    manager = UploadSessionManager(scratch_root)
+    with pytest.raises(AssertionError):
+        await manager.begin('fake-kernel', '../config/environ.txt', 10)
+    with pytest.raises(AssertionError):
+        await manager.begin('fake-kernel', '/etc/passwd', 10)
+
+
+@pytest.mark.asyncio
+async def test_discard_during_write(scratch_root, mocker):
+    manager = UploadSessionManager(scratch_root, chunk_size=4)
+    info = await manager.begin('fake-kernel', 'data.bin', 8)
+    upload_id = info['upload_id']
+    session = manager.sessions[upload_id]
+    fd = session.fd
+    resume = threading.Event()
+    orig_pwrite = os.pwrite
+
+    def slow_pwrite(*args):
+        resume.wait()
+        return orig_pwrite(*args)
+
+    mocker.patch('ai.backend.agent.upload.os.pwrite', slow_pwrite)
+    write = asyncio.ensure_future(manager.write_chunk(
+        'fake-kernel', upload_id, 0, b'abcd', zlib.crc32(b'abcd')))
+    await asyncio.sleep(0.05)
+    manager.discard_kernel('fake-kernel')
+    assert not manager.sessions
+    # The fd stays open until the pending write finishes.
+    os.fstat(fd)
+    assert session.part_path.exists()
+    resume.set()
+    with pytest.raises(AssertionError):
+        await write
+    assert session.fd == -1
+    assert not session.part_path.exists()
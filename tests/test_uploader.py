@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+from pathlib import Path
+
+import botocore
+import pytest
+
+from ai.backend.agent.dedup import ContentIndex
+from ai.backend.agent.uploader import S3UploadEngine, OutputUploadQueue
+
+
+def client_error(code, status):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code},
+         'ResponseMetadata': {'HTTPStatusCode': status}},
+        'UploadPart')
+
+
+class FakeS3Client:
+    '''
+    An in-memory stand-in of S3-compatible storages.
+    '''
+
+    def __init__(self):
+        self.objects = {}
+        self.multiparts = {}
+        self.aborted = set()
+        self.part_failures = {}  # part number -> list of exceptions to raise
+        self.concurrency = 0
+        self.max_concurrency = 0
+        self.closed = False
+
+    async def _enter(self):
+        self.concurrency += 1
+        self.max_concurrency = max(self.max_concurrency, self.concurrency)
+        await asyncio.sleep(0.01)
+        self.concurrency -= 1
+
+    async def put_object(self, *, Bucket, Key, Body, ACL):
+        await self._enter()
+        self.objects[Key] = bytes(Body)
+
+    async def create_multipart_upload(self, *, Bucket, Key, ACL):
+        upload_id = f'upload-{len(self.multiparts)}'
+        self.multiparts[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    async def upload_part(self, *, Bucket, Key, UploadId, PartNumber, Body):
+        await self._enter()
+        failures = self.part_failures.get(PartNumber)
+        if failures:
+            raise failures.pop(0)
+        self.multiparts[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'etag-{PartNumber}'}
+
+    async def complete_multipart_upload(self, *, Bucket, Key, UploadId,
+                                        MultipartUpload):
+        parts = self.multiparts.pop(UploadId)
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        self.objects[Key] = b''.join(parts[n] for n in numbers)
+
+    async def abort_multipart_upload(self, *, Bucket, Key, UploadId):
+        self.multiparts.pop(UploadId, None)
+        self.aborted.add(UploadId)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_s3():
+    return FakeS3Client()
+
+
+def create_engine(fake_s3, content_index=None):
+    return S3UploadEngine(bucket='test-bucket', bucket_path='bucket',
+                          endpoint_url='http://127.0.0.1:9000',
+                          max_concurrency=2,
+                          multipart_threshold=10, part_size=4,
+                          retry_delay=0,
+                          client_factory=lambda: fake_s3,
+                          content_index=content_index)
+
+
+@pytest.mark.asyncio
+async def test_upload_small_files_concurrently(fake_s3, tmpdir):
+    engine = create_engine(fake_s3)
+    base_dir = Path(tmpdir)
+    paths = []
+    for idx in range(5):
+        path = base_dir / f'file{idx}.txt'
+        path.write_bytes(b'x' * idx)
+        paths.append(path)
+
+    results = await engine.upload_files(paths, base_dir, 'kernel-id')
+    engine.close()
+
+    assert len(results) == 5
+    assert results[1] == {
+        'name': 'file1.txt',
+        'url': 'http://127.0.0.1:9000/test-bucket/bucket/kernel-id/file1.txt',
+    }
+    assert fake_s3.objects['bucket/kernel-id/file3.txt'] == b'xxx'
+    assert fake_s3.max_concurrency == 2
+
+
+@pytest.mark.asyncio
+async def test_upload_multipart_with_retries(fake_s3, tmpdir):
+    engine = create_engine(fake_s3)
+    base_dir = Path(tmpdir)
+    (base_dir / 'sub').mkdir()
+    path = base_dir / 'sub' / 'large.bin'
+    content = bytes(range(30))
+    path.write_bytes(content)
+    fake_s3.part_failures[2] = [client_error('SlowDown', 503)]
+
+    results = await engine.upload_files([path], base_dir, 'kernel-id')
+
+    assert [r['name'] for r in results] == ['sub/large.bin']
+    assert fake_s3.objects['bucket/kernel-id/sub/large.bin'] == content
+    assert not fake_s3.multiparts
+
+
+@pytest.mark.asyncio
+async def test_upload_multipart_aborts_on_failure(fake_s3, tmpdir):
+    engine = create_engine(fake_s3)
+    base_dir = Path(tmpdir)
+    path = base_dir / 'large.bin'
+    path.write_bytes(b'y' * 20)
+    fake_s3.part_failures[3] = [client_error('AccessDenied', 403)]
+
+    results = await engine.upload_files([path], base_dir, 'kernel-id')
+
+    assert results == []
+    assert fake_s3.aborted == {'upload-0'}
+    assert 'bucket/kernel-id/large.bin' not in fake_s3.objects
+
+
+@pytest.mark.asyncio
+async def test_upload_deduplicates_contents(fake_s3, tmpdir):
+    engine = create_engine(fake_s3, ContentIndex())
+    base_dir = Path(tmpdir)
+    small = base_dir / 'small.csv'
+    small.write_bytes(b'a,b,c')
+    large = base_dir / 'large.png'
+    large.write_bytes(bytes(range(30)))
+
+    results = await engine.upload_files([small, large], base_dir, 'k1')
+    assert len(results) == 2
+    assert len(fake_s3.objects) == 2
+    small_key = f'bucket/sha256/{hashlib.sha256(b"a,b,c").hexdigest()}'
+    large_key = f'bucket/sha256/{hashlib.sha256(bytes(range(30))).hexdigest()}'
+    assert fake_s3.objects[small_key] == b'a,b,c'
+    assert fake_s3.objects[large_key] == bytes(range(30))
+
+    # Rewriting the same contents does not upload them again.
+    fake_s3.objects.clear()
+    small.write_bytes(b'a,b,c')
+    large.write_bytes(bytes(range(30)))
+    copied = base_dir / 'copied.csv'
+    copied.write_bytes(b'a,b,c')
+    results = await engine.upload_files([small, large, copied], base_dir, 'k1')
+    assert not fake_s3.objects
+    url = f'http://127.0.0.1:9000/test-bucket/{small_key}'
+    assert results[0]['url'] == url
+    assert results[2] == {'name': 'copied.csv', 'url': url}
+
+    # Other kernels refer to the existing objects as well.
+    engine.content_index.discard_kernel('k1')
+    results = await engine.upload_files([large], base_dir, 'k2')
+    assert not fake_s3.objects
+    assert results[0]['url'].endswith(large_key)
+
+    # Changed contents are uploaded as a new object, leaving the objects
+    # referred to by the other files intact.
+    small.write_bytes(b'a,b,d')
+    results = await engine.upload_files([small], base_dir, 'k1')
+    new_key = f'bucket/sha256/{hashlib.sha256(b"a,b,d").hexdigest()}'
+    assert fake_s3.objects == {new_key: b'a,b,d'}
+    results = await engine.upload_files([copied], base_dir, 'k1')
+    assert results[0]['url'] == url
+
+
+@pytest.mark.asyncio
+async def test_upload_deduplicated_file_changed(fake_s3, tmpdir, mocker):
+    engine = create_engine(fake_s3, ContentIndex())
+    base_dir = Path(tmpdir)
+    large = base_dir / 'large.png'
+    large.write_bytes(bytes(range(30)))
+    orig_read_part = engine._read_part
+
+    async def read_part(fd, offset, size, hasher):
+        if offset == 4:
+            large.write_bytes(bytes(range(1, 31)))
+        return await orig_read_part(fd, offset, size, hasher)
+
+    mocker.patch.object(engine, '_read_part', read_part)
+    results = await engine.upload_files([large], base_dir, 'k1')
+    assert results == []
+    assert not fake_s3.objects
+    assert fake_s3.aborted == {'upload-0'}
+    assert not len(engine.content_index)
+
+
+class RecordingStatsMonitor:
+
+    def __init__(self):
+        self.records = []
+
+    def report_stats(self, report_type, metric, *args):
+        self.records.append((report_type, metric))
+
+
+@pytest.mark.asyncio
+async def test_output_upload_queue(tmpdir):
+    base_dir = Path(tmpdir)
+    paths = [base_dir / 'a.txt', base_dir / 'b.txt']
+    for path in paths:
+        path.write_text('data')
+    release = asyncio.Event()
+    uploaded = []
+    notified = []
+    stats_monitor = RecordingStatsMonitor()
+
+    async def upload(paths, base_dir, prefix):
+        await release.wait()
+        uploaded.append(prefix)
+        return [{'name': p.name, 'url': f'url/{p.name}'} for p in paths]
+
+    async def notify(kernel_id, run_id, files):
+        notified.append((kernel_id, run_id, files))
+
+    queue = OutputUploadQueue(upload, notify_func=notify,
+                              stats_monitor=stats_monitor, num_workers=2)
+    queue.start()
+    try:
+        pending = queue.submit('k1', 'run1', paths, base_dir)
+        assert pending == [{'name': 'a.txt', 'url': None},
+                           {'name': 'b.txt', 'url': None}]
+        queue.submit('k2', 'run2', paths[:1], base_dir)
+        queue.discard_kernel('k2')
+        await asyncio.sleep(0)
+        assert queue.pop_results('k1') == []
+
+        release.set()
+        await queue.join()
+        assert uploaded == ['k1']
+        assert notified == [('k1', 'run1', [
+            {'name': 'a.txt', 'url': 'url/a.txt', 'runId': 'run1'},
+            {'name': 'b.txt', 'url': 'url/b.txt', 'runId': 'run1'},
+        ])]
+        assert len(queue.pop_results('k1')) == 2
+        assert queue.pop_results('k1') == []
+        metrics = {metric for _, metric in stats_monitor.records}
+        assert 'ai.backend.agent.output_uploads.queue_depth' in metrics
+        assert 'ai.backend.agent.output_uploads.latency' in metrics
+    finally:
+        await queue.stop()
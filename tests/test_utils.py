@@ -44,3 +44,15 @@ def test_update_nested_dict():
     utils.update_nested_dict(o, {'a': [4, 5], 'b': 6})
     assert o['a'] == [1, 2, 4, 5]
     assert o['b'] == 6
+
+
+def test_recent_keys():
+    keys = utils.RecentKeys(capacity=2)
+    assert not keys.add('a')
+    assert keys.add('a')
+    assert not keys.add('b')
+    assert not keys.add('c')
+    assert len(keys) == 2
+    assert 'a' not in keys
+    assert keys.add('b')
+    assert keys.add('c')
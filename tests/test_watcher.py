@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+import sys
+
+import pytest
+
+from ai.backend.agent import watcher
+from ai.backend.agent.watcher import OutputChangeTracker
+
+requires_inotify = pytest.mark.skipif(
+    not (sys.platform.startswith('linux') and watcher.inotify_available()),
+    reason='inotify is only available on Linux')
+
+
+@requires_inotify
+@pytest.mark.asyncio
+async def test_tracker_collects_changes(tmpdir):
+    root = Path(tmpdir)
+    existing = root / 'existing.txt'
+    existing.write_text('old')
+    untouched = root / 'untouched.txt'
+    untouched.write_text('old')
+
+    tracker = OutputChangeTracker(root, 1000)
+    try:
+        tracker.begin_run()
+        assert tracker.is_armed
+
+        existing.write_text('new')
+        created = root / 'created.txt'
+        created.write_text('data')
+        subdir = root / 'sub' / 'deep'
+        subdir.mkdir(parents=True)
+        nested = subdir / 'nested.txt'
+        nested.write_text('data')
+        (root / '.hidden').write_text('data')
+        (root / 'large.bin').write_bytes(b'x' * 2000)
+
+        changed = tracker.end_run()
+        assert changed == {existing, created, nested}
+
+        # The next run only reports the changes made during itself.
+        tracker.begin_run()
+        nested.write_text('again')
+        assert tracker.end_run() == {nested}
+    finally:
+        tracker.close()
+
+
+@requires_inotify
+@pytest.mark.asyncio
+async def test_tracker_falls_back_on_watch_limit(tmpdir):
+    root = Path(tmpdir)
+    (root / 'sub').mkdir()
+    first = root / 'first.txt'
+    first.write_text('first')
+
+    tracker = OutputChangeTracker(root, 1000, max_watches=1)
+    try:
+        tracker.begin_run()
+        assert not tracker.is_armed
+        second = root / 'sub' / 'second.txt'
+        second.write_text('second')
+        new_time = first.stat().st_mtime + 5
+        os.utime(first, (new_time, new_time))
+        assert tracker.end_run() == {first, second}
+    finally:
+        tracker.close()
+
+
+@pytest.mark.asyncio
+async def test_tracker_without_output_dir(tmpdir):
+    root = Path(tmpdir) / '.output'
+    tracker = OutputChangeTracker(root, 1000)
+    try:
+        tracker.begin_run()
+        assert not tracker.is_armed
+        root.mkdir()
+        created = root / 'created.txt'
+        created.write_text('data')
+        assert tracker.end_run() == {created}
+    finally:
+        tracker.close()